@@ -7,14 +7,19 @@ from sqlalchemy import pool
 
 from alembic import context
 
-# Correctly set up sys.path to find modules in the 'backend' directory
-# Assuming env.py is in backend/alembic, '..' goes to backend/
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# The app modules are the `backend` package (they use relative imports), so put the directory
+# that contains backend/ on sys.path: env.py is in backend/alembic, '../..' is the repository root
+# (/app in the Docker image).
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 
-# Import Base from your database module and all models
-from database import Base, DATABASE_URL # Assuming database.py is in backend/
+# The alembic command is an entry point of its own: load .env before database.py reads DATABASE_URL
+from backend.config import load_env_file
+load_env_file()
+
+# Import Base from the database module and all models
+from backend.database import Base, DATABASE_URL
 # Option 1: Import all models explicitly if you have a central models module
-import models # Assuming models.py is in backend/
+from backend import models  # noqa: F401  # registers the tables on Base.metadata
 
 # Option 2: If models are scattered or you want to be explicit (less common with Base)
 # from models.user import User # Example
@@ -27,13 +32,22 @@ config = context.config
 
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
+# Existing loggers (uvicorn's, when migrating from inside the app) are left enabled.
 if config.config_file_name is not None:
-    fileConfig(config.config_file_name)
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
 target_metadata = Base.metadata # Point to your Base.metadata
 
+
+def include_object(object, name, type_, reflected, compare_to):
+    # The full-text search objects are created by DDL, not mapped (models.MESSAGE_SEARCH_DDL);
+    # keep autogenerate from dropping them.
+    if type_ == "table" and name.startswith("messages_fts"):
+        return False
+    return name not in ("search_vector", "ix_messages_search_vector")
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -60,6 +74,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -93,7 +108,7 @@ def run_migrations_online() -> None:
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection, target_metadata=target_metadata, include_object=include_object
         )
 
         with context.begin_transaction():
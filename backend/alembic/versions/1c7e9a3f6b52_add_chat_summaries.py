@@ -0,0 +1,42 @@
+"""add_chat_summaries
+
+Revision ID: 1c7e9a3f6b52
+Revises: 5e2b8c7a1d46
+Create Date: 2026-10-18 19:12:36.402117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '1c7e9a3f6b52'
+down_revision: Union[str, None] = '5e2b8c7a1d46'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # One row per chat, keyed (and looked up) by chat_id.
+    op.create_table('chat_summaries',
+    sa.Column('chat_id', sa.Integer(), nullable=False),
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.Column('covers_message_id', sa.Integer(), nullable=False),
+    sa.Column('covered_tokens', sa.Integer(), nullable=False),
+    sa.Column('summary_tokens', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('chat_id')
+    )
+    # Nullable / constant default: metadata-only on PostgreSQL (also on the partitioned usage
+    # table, where the column is added to every partition).
+    op.add_column('usage', sa.Column('prompt_tokens_saved', sa.Integer(), nullable=True))
+    op.add_column('usage_rollups', sa.Column('prompt_tokens_saved', sa.BigInteger(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('usage_rollups', 'prompt_tokens_saved')
+    op.drop_column('usage', 'prompt_tokens_saved')
+    op.drop_table('chat_summaries')
@@ -0,0 +1,37 @@
+"""add_usage_rollups
+
+Revision ID: 3b8e5d1f0a27
+Revises: 7c1f2a9d3e4b
+Create Date: 2026-10-18 11:40:02.518836
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b8e5d1f0a27'
+down_revision: Union[str, None] = '7c1f2a9d3e4b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The primary key (user_id, period, bucket_start) is both the upsert target and the index
+    # the usage summary reads from. Existing usage rows are rolled up with
+    # `python -m backend.usage_rollup backfill`.
+    op.create_table('usage_rollups',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('period', sa.String(), nullable=False),
+    sa.Column('bucket_start', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('tokens_used', sa.BigInteger(), nullable=False),
+    sa.Column('requests', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'period', 'bucket_start')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('usage_rollups')
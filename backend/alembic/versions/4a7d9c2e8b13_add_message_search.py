@@ -0,0 +1,80 @@
+"""add_message_search
+
+Revision ID: 4a7d9c2e8b13
+Revises: 8f3d2b6c4a91
+Create Date: 2026-10-19 09:05:44.210386
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4a7d9c2e8b13'
+down_revision: Union[str, None] = '8f3d2b6c4a91'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# PostgreSQL: a nullable tsvector column (metadata-only, unlike a STORED generated column, which
+# rewrites the whole table under an exclusive lock), set by a trigger on insert and on content
+# updates, and a GIN index built CONCURRENTLY. Existing messages keep a NULL vector, so they are
+# not found until `python -m backend.search backfill` has indexed them in batches.
+# SQLite: an external-content FTS5 table over messages, kept in sync by triggers and built from
+# the existing rows here.
+POSTGRES_TRIGGER = (
+    "CREATE TRIGGER messages_search_vector BEFORE INSERT OR UPDATE OF content ON messages "
+    "FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger(search_vector, 'pg_catalog.english', content)"
+)
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); END",
+    "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+]
+
+
+def create_index_concurrently(name: str, table: str, columns: list, **kw) -> None:
+    # Same as in revision 7c1f2a9d3e4b: an INVALID index left by an interrupted build is rebuilt
+    valid = op.get_bind().execute(
+        sa.text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {"name": name}
+    ).scalar()
+    if valid is False:
+        print(f"Index {name} is INVALID (an earlier concurrent build failed); building it again.")
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
+    op.create_index(name, table, columns, unique=False, postgresql_concurrently=True, if_not_exists=True, **kw)
+
+
+def upgrade() -> None:
+    if op.get_context().dialect.name == 'postgresql':
+        op.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector")
+        op.execute("DROP TRIGGER IF EXISTS messages_search_vector ON messages")
+        op.execute(POSTGRES_TRIGGER)
+        # Bulk imports with session_replication_role = replica still index their rows
+        op.execute("ALTER TABLE messages ENABLE ALWAYS TRIGGER messages_search_vector")
+        with op.get_context().autocommit_block():
+            create_index_concurrently('ix_messages_search_vector', 'messages', ['search_vector'], postgresql_using='gin')
+    else:
+        for statement in SQLITE_DDL:
+            op.execute(statement)
+
+
+def downgrade() -> None:
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index('ix_messages_search_vector', table_name='messages', postgresql_concurrently=True,
+                          if_exists=True)
+        op.execute("DROP TRIGGER IF EXISTS messages_search_vector ON messages")
+        op.execute("ALTER TABLE messages DROP COLUMN IF EXISTS search_vector")
+    else:
+        for name in ('messages_fts_update', 'messages_fts_delete', 'messages_fts_insert'):
+            op.execute(f"DROP TRIGGER IF EXISTS {name}")
+        op.execute("DROP TABLE IF EXISTS messages_fts")
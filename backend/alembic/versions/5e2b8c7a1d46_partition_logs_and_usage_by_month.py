@@ -0,0 +1,111 @@
+"""partition_logs_and_usage_by_month
+
+Revision ID: 5e2b8c7a1d46
+Revises: 9d4a6e2c5f18
+Create Date: 2026-10-18 16:40:12.518903
+
+"""
+from datetime import date, datetime, timezone
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e2b8c7a1d46'
+down_revision: Union[str, None] = '9d4a6e2c5f18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Append-only, time-ordered tables rebuilt as PostgreSQL range partitions by calendar month (UTC)
+# of their timestamp column, named <table>_y<YYYY>m<MM>, plus a <table>_default partition that
+# catches rows outside the pre-created months. `python -m backend.partitions maintain` keeps
+# future months created and applies retention afterwards.
+#
+# A partitioned table's primary key must include the partition key, so the key becomes
+# (id, timestamp); ids still come from the table's own sequence and stay unique.
+# `messages` is deliberately not partitioned: history cursors, list pages and write-behind
+# retries look messages up by id alone, which needs a global unique index on id.
+#
+# The existing rows are copied into the new table in one statement; on a large database run this
+# in a maintenance window (the tables are locked for writes while they are copied).
+TABLES = {
+    # table: (partition column, [(index name, columns)], [(foreign key column, referenced table)])
+    'logs': ('timestamp', [('ix_logs_id', ['id']), ('ix_logs_timestamp', ['timestamp'])], []),
+    'usage': ('timestamp', [('ix_usage_id', ['id']), ('ix_usage_user_id_timestamp', ['user_id', 'timestamp'])],
+              [('user_id', 'users')]),
+}
+PREMAKE_MONTHS = 3
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _create_month(table: str, key: str, month: date) -> None:
+    upper = _add_months(month, 1)
+    op.execute(
+        f'CREATE TABLE {table}_y{month.year:04d}m{month.month:02d} PARTITION OF {table} '
+        f"FOR VALUES FROM ('{month.isoformat()} 00:00:00+00') TO ('{upper.isoformat()} 00:00:00+00')"
+    )
+
+
+def _rebuild(table: str, partitioned: bool) -> None:
+    # Copies `table` into a new table of the same columns (partitioned or plain) under the same
+    # name, moving the id sequence, primary key, indexes and foreign keys across.
+    key, indexes, foreign_keys = TABLES[table]
+    conn = op.get_bind()
+    sequence = conn.execute(sa.text("SELECT pg_get_serial_sequence(:t, 'id')"), {'t': table}).scalar()
+    old = f'{table}_old'
+    op.execute(f'ALTER TABLE {table} RENAME TO {old}')
+    op.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')  # Keep it when the old table is dropped
+
+    if partitioned:
+        op.execute(f'CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS) PARTITION BY RANGE ("{key}")')
+        op.execute(f'ALTER TABLE {table} ALTER COLUMN "{key}" SET NOT NULL')
+        oldest = conn.execute(sa.text(f'SELECT min("{key}") FROM {old}')).scalar()
+        now = datetime.now(timezone.utc)
+        oldest = (oldest or now).astimezone(timezone.utc)
+        month = date(oldest.year, oldest.month, 1)
+        last = _add_months(date(now.year, now.month, 1), PREMAKE_MONTHS)
+        while month <= last:
+            _create_month(table, key, month)
+            month = _add_months(month, 1)
+        op.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+    else:
+        op.execute(f'CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS)')
+        op.execute(f'ALTER TABLE {table} ALTER COLUMN "{key}" DROP NOT NULL')
+
+    names = [c['name'] for c in sa.inspect(conn).get_columns(old)]
+    columns = ', '.join(f'"{name}"' for name in names)
+    # A row without a timestamp (the column defaults to now()) is filed under the time of the copy.
+    select_columns = ', '.join(
+        f'coalesce("{name}", now())' if partitioned and name == key else f'"{name}"' for name in names
+    )
+    op.execute(f'INSERT INTO {table} ({columns}) SELECT {select_columns} FROM {old}')
+    op.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}.id')
+    op.execute(f'DROP TABLE {old}')
+
+    op.create_primary_key(f'{table}_pkey', table, ['id', key] if partitioned else ['id'])
+    for name, index_columns in indexes:
+        op.create_index(name, table, index_columns, unique=False)
+    for column, referenced in foreign_keys:
+        op.create_foreign_key(f'{table}_{column}_fkey', table, referenced, [column], ['id'])
+
+
+def upgrade() -> None:
+    if op.get_context().dialect.name != 'postgresql':
+        return  # SQLite (local development) has no table partitioning
+    for table in TABLES:
+        _rebuild(table, partitioned=True)
+
+
+def downgrade() -> None:
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    for table in TABLES:
+        # Dropping the partitioned table afterwards drops every partition with it.
+        _rebuild(table, partitioned=False)
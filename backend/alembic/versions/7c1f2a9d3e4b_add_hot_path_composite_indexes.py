@@ -0,0 +1,65 @@
+"""add_hot_path_composite_indexes
+
+Revision ID: 7c1f2a9d3e4b
+Revises: 48646cce3ddd
+Create Date: 2026-10-18 09:12:31.402117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c1f2a9d3e4b'
+down_revision: Union[str, None] = '48646cce3ddd'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# (index name, table, columns) for the queries the chat endpoints actually run:
+# history windows (newest messages of a chat), a user's chats, usage and log scans by time.
+INDEXES = [
+    ('ix_messages_chat_id_created_at', 'messages', ['chat_id', 'created_at', 'id']),
+    ('ix_chats_user_id_created_at', 'chats', ['user_id', 'created_at']),
+    ('ix_usage_user_id_timestamp', 'usage', ['user_id', 'timestamp']),
+    ('ix_logs_timestamp', 'logs', ['timestamp']),
+]
+
+
+def create_index_concurrently(name: str, table: str, columns: list, **kw) -> None:
+    # Inside op.get_context().autocommit_block(). Defined in the revision, not imported from the app,
+    # so the revision keeps doing what it did when it was written. A failed or interrupted
+    # CREATE INDEX CONCURRENTLY leaves an INVALID index of that name behind, which the planner never
+    # uses and IF NOT EXISTS would skip on the next run; it is dropped and built again.
+    valid = op.get_bind().execute(
+        sa.text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {"name": name}
+    ).scalar()
+    if valid is False:
+        print(f"Index {name} is INVALID (an earlier concurrent build failed); building it again.")
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
+    op.create_index(name, table, columns, unique=False, postgresql_concurrently=True, if_not_exists=True, **kw)
+
+
+def upgrade() -> None:
+    if op.get_context().dialect.name == 'postgresql':
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block, and avoids
+        # holding a write lock on the tables while the index builds. Re-runs rebuild an index
+        # left INVALID by an interrupted build.
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                create_index_concurrently(name, table, columns)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade() -> None:
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, _ in reversed(INDEXES):
+                op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    else:
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table)
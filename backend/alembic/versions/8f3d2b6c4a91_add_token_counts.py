@@ -0,0 +1,37 @@
+"""add_token_counts
+
+Revision ID: 8f3d2b6c4a91
+Revises: 1c7e9a3f6b52
+Create Date: 2026-10-18 20:31:08.664170
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f3d2b6c4a91'
+down_revision: Union[str, None] = '1c7e9a3f6b52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Nullable or constant defaults only: metadata-only on PostgreSQL, no table rewrite.
+    # Existing messages keep a NULL count until `python -m backend.tokens backfill` (they are
+    # counted on read meanwhile); existing usage rows keep only their total.
+    op.add_column('messages', sa.Column('token_count', sa.Integer(), nullable=True))
+    op.add_column('usage', sa.Column('prompt_tokens', sa.Integer(), nullable=True))
+    op.add_column('usage', sa.Column('completion_tokens', sa.Integer(), nullable=True))
+    op.add_column('usage_rollups', sa.Column('prompt_tokens', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('usage_rollups', sa.Column('completion_tokens', sa.BigInteger(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('usage_rollups', 'completion_tokens')
+    op.drop_column('usage_rollups', 'prompt_tokens')
+    op.drop_column('usage', 'completion_tokens')
+    op.drop_column('usage', 'prompt_tokens')
+    op.drop_column('messages', 'token_count')
@@ -0,0 +1,28 @@
+"""add_message_model
+
+Revision ID: 9d4a6e2c5f18
+Revises: 3b8e5d1f0a27
+Create Date: 2026-10-18 14:05:47.930214
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4a6e2c5f18'
+down_revision: Union[str, None] = '3b8e5d1f0a27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Nullable with no default: a metadata-only change on PostgreSQL, no table rewrite.
+    # Rows written before the model router existed keep NULL.
+    op.add_column('messages', sa.Column('model', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('messages', 'model')
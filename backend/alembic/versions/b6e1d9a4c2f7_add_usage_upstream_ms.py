@@ -0,0 +1,27 @@
+"""add_usage_upstream_ms
+
+Revision ID: b6e1d9a4c2f7
+Revises: 4a7d9c2e8b13
+Create Date: 2026-10-18 23:41:08.517302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6e1d9a4c2f7'
+down_revision: Union[str, None] = '4a7d9c2e8b13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Nullable: metadata-only on PostgreSQL, also on the partitioned usage table.
+    op.add_column('usage', sa.Column('upstream_ms', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('usage', 'upstream_ms')
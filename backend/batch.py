@@ -0,0 +1,208 @@
+# Batch chat completions (POST /api/v1/chat/batch, see main.py).
+#
+# Offline jobs (evaluation runs, bulk summarization) send many messages in one request instead of
+# one POST /chat each. The endpoint resolves the users and chats of all items with one IN (...)
+# query each, then runs the items with at most BATCH_CONCURRENCY upstream calls in flight. Items
+# for the same chat run one after another, in the order given, each seeing the turns before it;
+# everything else runs concurrently.
+#
+# Finished turns are written in groups: one transaction per group, with one multi-row INSERT per
+# table (chats, messages, usage) and the usage rollups. A group is whatever has finished while
+# the previous group was being written (up to BATCH_FLUSH_SIZE turns), so writes batch up as the
+# load grows without holding back a lone turn. Ids come from the table sequences in one round
+# trip per table (on SQLite, from max(id) under the write lock). With write-behind enabled
+# (write_behind.py) a group is handed to its writer as one turn instead.
+#
+# The response is NDJSON, one line per item in the order the items finish (once stored):
+#   {"index": 3, "status_code": 200, "result": {"reply", "chat_id", "user_message_id", "ai_message_id", "model"}}
+#   {"index": 5, "status_code": 429, "detail": "Rate limit exceeded (tokens_per_minute)."}
+# then {"done": true, "succeeded": ..., "failed": ...}. A failed item does not stop the others.
+# When the client disconnects, the items still running are cancelled and their turns discarded.
+#
+# The batch counts as one request against the request rate limits (rate_limit.RateLimiter.check_batch);
+# each item is checked against the token buckets and the daily quota as it starts. An item's token
+# reservation is settled once its turn is stored, and released if it fails or is discarded.
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from . import models
+from .database import IS_SQLITE, async_engine
+from .transfer import allocate_ids
+from .usage_rollup import rollup_rows, rollup_upsert, utcnow
+from .write_behind import WRITE_ORDER, row_values, write_behind
+
+# --- Batch Chat Configuration ---
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))  # Items per request
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))  # Upstream calls in flight per batch
+BATCH_FLUSH_SIZE = int(os.getenv("BATCH_FLUSH_SIZE", "200"))  # Turns per write transaction
+
+RESULT_FIELDS = ("reply", "chat_id", "user_message_id", "ai_message_id", "model")  # schemas.ChatCompletionResponse
+
+
+async def _new_ids(conn, model, count: int) -> List[int]:
+    if not count:
+        return []
+    if write_behind.enabled:
+        # On SQLite the write-behind allocator is the only source of ids in this process
+        return [await write_behind.ids.allocate(model) for _ in range(count)]
+    return await allocate_ids(conn, model.__table__.name, count)
+
+
+async def _turn_rows(conn, turns: List[dict]) -> list:
+    # The new chats, messages and usage rows of `turns`, with their ids; fills in each turn's
+    # chat_id (for a new chat), user_message_id and ai_message_id.
+    now = utcnow()
+    new_chats = sum(1 for turn in turns if turn["chat_id"] is None)
+    charged = sum(1 for turn in turns if turn["counts"]["tokens"] > 0 or turn["from_cache"])
+    chat_ids = iter(await _new_ids(conn, models.Chat, new_chats))
+    message_ids = iter(await _new_ids(conn, models.Message, 2 * len(turns)))
+    usage_ids = iter(await _new_ids(conn, models.Usage, charged))
+    rows = []
+    for turn in turns:
+        if turn["chat_id"] is None:
+            turn["chat_id"] = next(chat_ids)
+            rows.append(models.Chat(id=turn["chat_id"], user_id=turn["user_id"], title=turn["title"], created_at=now))
+        turn["user_message_id"], turn["ai_message_id"] = next(message_ids), next(message_ids)
+        counts = turn["counts"]
+        rows.append(models.Message(id=turn["user_message_id"], chat_id=turn["chat_id"], content=turn["message"],
+                                   sender_type="user", token_count=turn["message_tokens"], created_at=now))
+        rows.append(models.Message(id=turn["ai_message_id"], chat_id=turn["chat_id"], content=turn["reply"],
+                                   sender_type="ai", token_usage=counts["tokens"], model=turn["model"],
+                                   token_count=turn["reply_tokens"], created_at=now))
+        if counts["tokens"] > 0 or turn["from_cache"]:
+            rows.append(models.Usage(id=next(usage_ids), user_id=turn["user_id"], tokens_used=counts["tokens"],
+                                     prompt_tokens=counts["prompt_tokens"],
+                                     completion_tokens=counts["completion_tokens"],
+                                     prompt_tokens_saved=turn["tokens_saved"] or None,
+                                     upstream_ms=turn["upstream_ms"], timestamp=now))
+    return rows
+
+
+async def write_turns(turns: List[dict]) -> None:
+    # turns: dicts with user_id, chat_id (None for a new chat), title (of a new chat), message,
+    # message_tokens, reply, reply_tokens, model, counts (main.usage_counts), tokens_saved, upstream_ms,
+    # from_cache
+    if write_behind.enabled:
+        await write_behind.submit(await _turn_rows(None, turns))
+        return
+    async with async_engine.begin() as conn:
+        if IS_SQLITE:
+            # Hold the write lock from reading max(id) until the rows using those ids are inserted
+            await conn.exec_driver_sql("BEGIN IMMEDIATE")
+        rows = await _turn_rows(conn, turns)
+        for model in WRITE_ORDER:
+            values = [row_values(row) for row in rows if type(row) is model]
+            if values:
+                await conn.execute(model.__table__.insert(), values)
+            if model is models.Usage and values:
+                await conn.execute(rollup_upsert(additive=True), rollup_rows(values))
+
+
+def _line(payload: dict) -> bytes:
+    return (json.dumps(payload) + "\n").encode()
+
+
+async def run_batch(chains: List[list], run_item: Callable[[object], Awaitable[dict]],
+                    on_stored: Callable[[dict], Awaitable[None]], on_discarded: Callable[[dict], Awaitable[None]],
+                    concurrency: int,
+                    rejected: Optional[List[Tuple[int, int, str]]] = None,
+                    flush_size: int = BATCH_FLUSH_SIZE) -> AsyncIterator[bytes]:
+    # chains: lists of (index, item). The items of a chain run one after another, chains run
+    # concurrently, with at most `concurrency` run_item calls at once.
+    # run_item(item) -> the turn to store (see write_turns); an HTTPException fails only that item.
+    # on_stored(turn): called once the turn is written; on_discarded(turn): for a turn that is
+    # not (its write failed, or the client went away before it was written).
+    # rejected: (index, status_code, detail) of items that failed before the batch started.
+    # Yields the NDJSON result lines.
+    semaphore = asyncio.Semaphore(concurrency)
+    finished: asyncio.Queue = asyncio.Queue()  # (index, turn, None) or (index, None, (status_code, detail))
+    for index, status_code, detail in rejected or []:
+        finished.put_nowait((index, None, (status_code, detail)))
+
+    async def run_chain(chain: list) -> None:
+        for index, item in chain:
+            try:
+                async with semaphore:
+                    turn = await run_item(item)
+            except HTTPException as e:
+                finished.put_nowait((index, None, (e.status_code, e.detail)))
+                continue
+            except Exception as e:
+                print(f"Batch: item {index} failed unexpectedly: {e}")
+                finished.put_nowait((index, None, (500, "An unexpected server error occurred.")))
+                continue
+            finished.put_nowait((index, turn, None))
+
+    total = finished.qsize() + sum(len(chain) for chain in chains)
+    batch_stats.batches += 1
+    batch_stats.items += total
+    tasks = [asyncio.create_task(run_chain(chain)) for chain in chains]
+    remaining, succeeded = total, 0
+    unwritten: list = []  # Turns taken off the queue and not yet written
+    try:
+        while remaining:
+            group = [await finished.get()]
+            while len(group) < flush_size and not finished.empty():
+                group.append(finished.get_nowait())
+            remaining -= len(group)
+            turns = [turn for _, turn, _ in group if turn is not None]
+            write_error = None
+            if turns:
+                unwritten = turns
+                try:
+                    await write_turns(turns)
+                except Exception as e:
+                    print(f"Batch: failed to store {len(turns)} turns: {e}")
+                    write_error = (500, "An unexpected server error occurred.")
+                    unwritten = []
+                    for turn in turns:
+                        await on_discarded(turn)
+                else:
+                    unwritten = []
+                    batch_stats.groups_written += 1
+                    batch_stats.max_group_turns = max(batch_stats.max_group_turns, len(turns))
+                    for turn in turns:
+                        await on_stored(turn)
+            lines = []
+            for index, turn, error in group:
+                if turn is not None and write_error is None:
+                    succeeded += 1
+                    result = {field: turn[field] for field in RESULT_FIELDS}
+                    lines.append(_line({"index": index, "status_code": 200, "result": result}))
+                else:
+                    status_code, detail = error or write_error
+                    lines.append(_line({"index": index, "status_code": status_code, "detail": detail}))
+            yield b"".join(lines)
+        yield _line({"done": True, "succeeded": succeeded, "failed": total - succeeded})
+    finally:
+        batch_stats.succeeded += succeeded
+        batch_stats.failed += total - remaining - succeeded
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        while not finished.empty():  # Finished after the client went away
+            _, turn, _ = finished.get_nowait()
+            if turn is not None:
+                unwritten.append(turn)
+        for turn in unwritten:
+            await on_discarded(turn)
+
+
+class BatchStats:
+    def __init__(self):
+        self.batches = 0
+        self.items = 0
+        self.succeeded = 0
+        self.failed = 0  # Items reported with an error status
+        self.groups_written = 0  # Transactions, or write-behind turns
+        self.max_group_turns = 0
+
+    def stats(self) -> dict:
+        return dict(vars(self))
+
+
+batch_stats = BatchStats()
@@ -0,0 +1,222 @@
+# Assertion checks for the chat API's limits and idempotency keys, against the stub upstream.
+#
+# Usage (from the repository root):
+#   python -m backend.bench.api_checks [--database-url postgresql://localhost/chat_bench]
+#
+# Starts the stub OpenRouter server and the app (as chat_load.py does, on a throwaway SQLite
+# database unless --database-url is given) with tight per-user limits, then checks:
+#   reservations   turns that fail (missing chat, upstream error, stream error) give their token
+#                  reservation back, so a user's next message still fits in the token bucket
+#   all or nothing a request the token bucket rejects does not use up the request bucket
+#   quota refund   requests the daily quota rejects give back what the buckets took
+#   quota          the quota counts the tokens recorded for the user's turns
+#   idempotency    concurrent and later retries replay the first response (one stored turn),
+#                  a different body is refused, keys are per user, a failed turn releases its key
+#                  and a completed stream is replayed
+# Prints one line per check and exits with status 1 if any fails.
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from typing import List
+
+import httpx
+
+from backend.bench.chat_load import _create_schema, _start, _wait_for
+
+TOKENS_PER_MIN = 600  # Per-user token bucket (capacity); refills at 10 tokens/s
+REQUEST_BURST = 20  # Per-user request bucket, which hardly refills during a run
+DAILY_QUOTA = 400
+COMPLETION_TOKENS = 50  # Per stub reply, on top of the prompt
+SETTINGS = {
+    "OPENROUTER_API_KEY": "stub-key",
+    "RATE_LIMIT_ENABLED": "true",
+    "RATE_LIMIT_USER_RPS": "0.01",
+    "RATE_LIMIT_USER_BURST": str(REQUEST_BURST),
+    "RATE_LIMIT_USER_TOKENS_PER_MIN": str(TOKENS_PER_MIN),
+    "QUOTA_DAILY_TOKENS": str(DAILY_QUOTA),
+    "TOKENIZER": "approx",
+    "STUB_LATENCY_MS": "50",
+    "STUB_COMPLETION_TOKENS": str(COMPLETION_TOKENS),
+    "UPSTREAM_MAX_RETRIES": "0",
+    "UPSTREAM_BREAKER_MIN_CALLS": "1000",  # Injected errors must reach the app, not open the breaker
+    "COMPLETION_CACHE_ENABLED": "false",  # Every turn goes upstream
+}
+QUOTA_DETAIL = "Daily token quota exceeded."
+TOKENS_DETAIL = "Rate limit exceeded (user_tokens)."
+
+
+def message(tokens: int) -> str:
+    # About `tokens` tokens for the approx tokenizer (four bytes per token)
+    return "word " * (tokens * 4 // 5)
+
+
+class Checks:
+    def __init__(self):
+        self.failures: List[str] = []
+
+    def expect(self, label: str, ok: bool, detail="") -> None:
+        print(f"{'OK  ' if ok else 'FAIL'} {label}" + ("" if ok else f": {detail}"))
+        if not ok:
+            self.failures.append(label)
+
+
+async def _stream(client: httpx.AsyncClient, body: dict, headers: dict = None):
+    # (status, Idempotent-Replayed header, [(event, payload)])
+    events = []
+    async with client.stream("POST", "/api/v1/chat/stream", json=body, headers=headers or {}) as response:
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                events.append((event, json.loads(line[len("data:"):])))
+    return response.status_code, response.headers.get("idempotent-replayed"), events
+
+
+async def check_reservations(client: httpx.AsyncClient, faults, checks: Checks) -> None:
+    user, big = 1, message(TOKENS_PER_MIN // 3)  # Three of these fill the token bucket
+    statuses = []
+    for _ in range(2):
+        statuses.append((await client.post("/api/v1/chat", json={"message": big, "user_id": user, "chat_id": 10**9})).status_code)
+        statuses.append((await _stream(client, {"message": big, "user_id": user, "chat_id": 10**9}))[0])
+    await faults({"error_rate": 1.0})
+    statuses.append((await client.post("/api/v1/chat", json={"message": big, "user_id": user})).status_code)
+    _, _, events = await _stream(client, {"message": big, "user_id": user})
+    statuses.append(events[-1][0] if events else None)
+    await faults({"error_rate": 0})
+    checks.expect("failed turns fail as expected", statuses == [404, 404, 404, 404, 503, "error"], statuses)
+    response = await client.post("/api/v1/chat", json={"message": big, "user_id": user})
+    checks.expect("token reservations of failed turns are released", response.status_code == 200,
+                  f"{response.status_code} {response.text[:100]}")
+
+
+async def check_all_or_nothing(client: httpx.AsyncClient, faults, checks: Checks) -> None:
+    # A slow turn holds most of the token bucket while the follow-ups arrive
+    user, held = 2, message(DAILY_QUOTA - 50)
+    await faults({"slow_rate": 1.0, "slow_ms": 3000})
+    slow_turn = asyncio.create_task(client.post("/api/v1/chat", json={"message": held, "user_id": user}))
+    await asyncio.sleep(1.0)
+    await faults({"slow_rate": 0})
+    details = {(await client.post("/api/v1/chat", json={"message": message(TOKENS_PER_MIN // 2), "user_id": user}))
+               .json().get("detail") for _ in range(REQUEST_BURST)}
+    checks.expect("token bucket rejects follow-ups while a turn holds its reservation",
+                  details == {TOKENS_DETAIL}, details)
+    response = await client.post("/api/v1/chat", json={"message": "hi", "user_id": user})
+    checks.expect("rejected requests did not use up the request bucket", response.status_code == 200,
+                  f"{response.status_code} {response.text[:100]}")
+    slow = await slow_turn
+    checks.expect("the slow turn completes", slow.status_code == 200, f"{slow.status_code} {slow.text[:100]}")
+
+
+async def check_quota_refund(client: httpx.AsyncClient, checks: Checks) -> None:
+    user = 3
+    details = {(await client.post("/api/v1/chat", json={"message": message(DAILY_QUOTA + 100), "user_id": user}))
+               .json().get("detail") for _ in range(REQUEST_BURST + 5)}
+    checks.expect("quota rejects a message larger than the quota", details == {QUOTA_DETAIL}, details)
+    response = await client.post("/api/v1/chat", json={"message": "hi", "user_id": user})
+    checks.expect("quota rejections gave back what the buckets took", response.status_code == 200,
+                  f"{response.status_code} {response.text[:100]}")
+
+
+async def check_quota(client: httpx.AsyncClient, checks: Checks) -> None:
+    user, text = 4, message(20)
+    turns, last = 0, None
+    while turns < REQUEST_BURST - 1:
+        last = await client.post("/api/v1/chat", json={"message": text, "user_id": user})
+        if last.status_code != 200:
+            break
+        turns += 1
+    used = (await client.get(f"/api/v1/usage/{user}")).json()["daily_tokens_used"]
+    checks.expect("quota stops the user's turns", turns > 0 and last.json().get("detail") == QUOTA_DETAIL,
+                  f"{turns} turns, then {last.status_code} {last.text[:60]}")
+    # The quota counts the usage recorded for each turn (prompt and reply), not the prompt estimates
+    checks.expect("quota counted the tokens recorded for the turns",
+                  used >= turns * COMPLETION_TOKENS and used + 20 > DAILY_QUOTA,
+                  f"rejected after {turns} turns with {used} of {DAILY_QUOTA} tokens used")
+
+
+async def check_idempotency(client: httpx.AsyncClient, faults, checks: Checks) -> None:
+    user, body, headers = 5, {"message": "retry me", "user_id": 5}, {"Idempotency-Key": "check-1"}
+    responses = await asyncio.gather(*(client.post("/api/v1/chat", json=body, headers=headers) for _ in range(3)))
+    ids = {r.json().get("user_message_id") for r in responses}
+    replayed = sorted(str(r.headers.get("idempotent-replayed")) for r in responses)
+    checks.expect("concurrent retries get the first response", len(ids) == 1 and replayed == ["None", "true", "true"],
+                  f"ids {ids}, replayed {replayed}")
+    later = await client.post("/api/v1/chat", json=body, headers=headers)
+    checks.expect("a later retry is replayed", later.headers.get("idempotent-replayed") == "true"
+                  and later.json().get("user_message_id") in ids, later.text[:100])
+    chat_id = later.json().get("chat_id")
+    stored = (await client.get(f"/api/v1/chats/{chat_id}/messages", params={"user_id": user})).json().get("items", [])
+    checks.expect("the turn was stored once", len(stored) == 2, f"{len(stored)} messages in chat {chat_id}")
+    mismatch = await client.post("/api/v1/chat", json={**body, "message": "other"}, headers=headers)
+    checks.expect("reusing a key for a different body is refused", mismatch.status_code == 422, mismatch.status_code)
+    other_user = await client.post("/api/v1/chat", json={**body, "user_id": 6}, headers=headers)
+    checks.expect("keys are per user", other_user.status_code == 200 and "idempotent-replayed" not in other_user.headers
+                  and other_user.json()["user_message_id"] not in ids, other_user.text[:100])
+
+    failing = {"Idempotency-Key": "check-2"}
+    await faults({"error_rate": 1.0})
+    failed = await client.post("/api/v1/chat", json=body, headers=failing)
+    await faults({"error_rate": 0})
+    retried = await client.post("/api/v1/chat", json=body, headers=failing)
+    checks.expect("a failed turn releases its key", failed.status_code == 503 and retried.status_code == 200
+                  and "idempotent-replayed" not in retried.headers, f"{failed.status_code}, then {retried.status_code}")
+
+    stream_headers = {"Idempotency-Key": "check-3"}
+    first = await _stream(client, body, stream_headers)
+    again = await _stream(client, body, stream_headers)
+    reply = "".join(payload.get("content", "") for event, payload in first[2] if event == "delta")
+    checks.expect("a completed stream is replayed", again[1] == "true" and again[2] == [
+        ("delta", {"content": reply}), ("done", first[2][-1][1])], again[2][-1:])
+
+
+async def run_checks(app_url: str, stub_url: str) -> List[str]:
+    checks = Checks()
+    async with httpx.AsyncClient(base_url=app_url, timeout=30.0) as client:
+        async def faults(settings: dict) -> None:
+            await client.put(f"{stub_url}/stub/faults", json=settings)
+
+        await check_reservations(client, faults, checks)
+        await check_all_or_nothing(client, faults, checks)
+        await check_quota_refund(client, checks)
+        await check_quota(client, checks)
+        await check_idempotency(client, faults, checks)
+    return checks.failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Assertion checks for limits and idempotency keys")
+    parser.add_argument("--database-url", help="Defaults to a throwaway SQLite database")
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--stub-port", type=int, default=9100)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='api_checks_'), 'checks.db')}"
+    _create_schema(database_url)
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    env = dict(os.environ, **SETTINGS, DATABASE_URL=database_url,
+               OPENROUTER_API_URL=f"{stub_url}/api/v1/chat/completions")
+    stub = _start("backend.bench.stub_openrouter:app", args.stub_port, env)
+    app = _start("backend.main:app", args.app_port, env)
+    try:
+        _wait_for(f"{stub_url}/docs")
+        _wait_for(f"http://127.0.0.1:{args.app_port}/")
+        failures = asyncio.run(run_checks(f"http://127.0.0.1:{args.app_port}", stub_url))
+    finally:
+        app.terminate()
+        stub.terminate()
+        app.wait()
+        stub.wait()
+
+    if failures:
+        sys.exit(1)
+    print("Checks passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# Throughput of an offline job: one POST /api/v1/chat per message vs. POST /api/v1/chat/batch.
+#
+# Usage (from the repository root):
+#   python -m backend.bench.batch_bench [--messages 1000] [--concurrency 16] [--database-url ...] [--json results/batch.json]
+#
+# Starts the stub upstream and the app as in chat_load.py, then sends --messages new-chat messages
+# (spread over --users users) twice, each run on its own users:
+#   per_message  POST /api/v1/chat per message, --concurrency requests at a time over kept-alive
+#                connections (how the offline jobs call the API today)
+#   batch        POST /api/v1/chat/batch with --batch-size items per request and "concurrency":
+#                --concurrency, one batch at a time
+# and prints messages/sec, the latency of each message to its reply (to its NDJSON line for the
+# batch), and the rows stored.
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import text
+
+from backend.bench.chat_load import _create_schema, _start, _wait_for, latency_summary, write_results
+
+USER_ID_BASE = 3000
+
+
+async def _per_message(url: str, messages: int, users: int, concurrency: int, first_user: int) -> dict:
+    samples = []
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(timeout=60.0, limits=httpx.Limits(max_connections=concurrency)) as client:
+
+        async def one(i: int) -> None:
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(f"{url}/api/v1/chat",
+                                             json={"message": f"message {i}", "user_id": first_user + i % users})
+                if response.status_code == 200:
+                    samples.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(messages)))
+        elapsed = time.perf_counter() - started
+    return {"name": "per_message", "elapsed_s": round(elapsed, 2), "messages_per_s": round(len(samples) / elapsed, 1),
+            "succeeded": len(samples), "latency": latency_summary(samples, 1000)}
+
+
+async def _batch(url: str, messages: int, users: int, concurrency: int, batch_size: int, first_user: int) -> dict:
+    samples = []
+    async with httpx.AsyncClient(timeout=600.0) as client:
+        started = time.perf_counter()
+        for start in range(0, messages, batch_size):
+            items = [{"message": f"message {i}", "user_id": first_user + i % users}
+                     for i in range(start, min(start + batch_size, messages))]
+            sent = time.perf_counter()
+            async with client.stream("POST", f"{url}/api/v1/chat/batch",
+                                     json={"items": items, "concurrency": concurrency}) as response:
+                async for line in response.aiter_lines():
+                    if line and json.loads(line).get("status_code") == 200:
+                        samples.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - started
+        stats = (await client.get(f"{url}/api/v1/stats")).json()["batch"]
+    return {"name": "batch", "elapsed_s": round(elapsed, 2), "messages_per_s": round(len(samples) / elapsed, 1),
+            "succeeded": len(samples), "latency": latency_summary(samples, 1000),
+            "write_groups": stats["groups_written"], "max_group_turns": stats["max_group_turns"]}
+
+
+def _count_rows(first_user: int, last_user: int) -> dict:
+    from backend.database import engine
+
+    with engine.connect() as conn:
+        messages = conn.execute(text(
+            "SELECT count(*) FROM messages m JOIN chats c ON c.id = m.chat_id WHERE c.user_id BETWEEN :first AND :last"
+        ), {"first": first_user, "last": last_user}).scalar()
+        usage_rows = conn.execute(text(
+            "SELECT count(*) FROM usage WHERE user_id BETWEEN :first AND :last"
+        ), {"first": first_user, "last": last_user}).scalar()
+    return {"messages_stored": messages, "usage_rows": usage_rows}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline job throughput: per-message requests vs. the batch endpoint")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=16, help="Upstream calls in flight")
+    parser.add_argument("--batch-size", type=int, default=500, help="Items per batch request")
+    parser.add_argument("--stub-latency-ms", default="100")
+    parser.add_argument("--database-url", help="Defaults to a throwaway SQLite database")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--stub-port", type=int, default=9100)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='batch_bench_'), 'batch.db')}"
+    _create_schema(database_url)
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        OPENROUTER_API_KEY="stub-key",
+        OPENROUTER_API_URL=f"http://127.0.0.1:{args.stub_port}/api/v1/chat/completions",
+        STUB_LATENCY_MS=args.stub_latency_ms,
+        RATE_LIMIT_ENABLED="false",
+        BATCH_CONCURRENCY=str(args.concurrency),
+    )
+    stub = _start("backend.bench.stub_openrouter:app", args.stub_port, env)
+    app = _start("backend.main:app", args.app_port, env)
+    results = []
+    try:
+        _wait_for(f"http://127.0.0.1:{args.stub_port}/docs")
+        _wait_for(f"http://127.0.0.1:{args.app_port}/")
+        url = f"http://127.0.0.1:{args.app_port}"
+        for offset, mode in enumerate(("per_message", "batch")):
+            first_user = USER_ID_BASE + offset * args.users
+            if mode == "per_message":
+                result = asyncio.run(_per_message(url, args.messages, args.users, args.concurrency, first_user))
+            else:
+                result = asyncio.run(_batch(url, args.messages, args.users, args.concurrency, args.batch_size,
+                                            first_user))
+            result.update(_count_rows(first_user, first_user + args.users - 1))
+            print(result)
+            results.append(result)
+    finally:
+        app.terminate()
+        stub.terminate()
+        app.wait()
+        stub.wait()
+
+    if args.json:
+        settings = {"messages": args.messages, "users": args.users, "concurrency": args.concurrency,
+                    "batch_size": args.batch_size, "stub_latency_ms": args.stub_latency_ms,
+                    "database": database_url.split(":", 1)[0]}
+        write_results(args.json, "batch", settings, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+# Concurrency load test for POST /api/v1/chat against a local stub OpenRouter server.
+#
+# Usage (from the repository root):
+#   python -m backend.bench.chat_load --levels 1,8,32,128 --requests 256
+#   python -m backend.bench.chat_load --database-url postgresql://localhost/chat_bench \
+#       --env WRITE_BEHIND_ENABLED=true --json results/write_behind.json
+#
+# The script starts the stub upstream and the FastAPI app as uvicorn subprocesses
+# (single worker each) on a throwaway SQLite database (or --database-url; its tables are created
+# if missing), then fires requests at each concurrency level and prints throughput and latency
+# percentiles. Each of 50 users opens a chat and continues it, and the app runs with the context
+# cache off, so a turn reads its history from the database before the upstream call (override
+# with --env CONTEXT_CACHE_MAX_ENTRIES=...). The app runs with SERVER_TIMING_ENABLED, so each level also reports percentiles
+# per request stage (limits, resolve, history, upstream, persist; see backend/timing.py).
+# With --json the results, together with the commit and settings, are written to a file that can
+# be compared across commits. With a non-blocking upstream client the requests/sec should grow
+# roughly linearly with concurrency until the stub latency is no longer the bottleneck.
+#
+# The run fails (exit status 1) when
+#   - a request held a database connection while it waited on the upstream call (from the app's
+#     chat_stage_db_connections metric), which caps in-flight chats at the pool size;
+#   - a level's requests/sec is below --min-scaling (default 0.5) of linear scaling from the
+#     previous level. A level that kept the host's CPUs busy (90%+, from /proc/stat) is exempt:
+#     it measures the machine, not the request path;
+#   - any request failed.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import httpx
+from sqlalchemy.engine import make_url
+
+from backend import timing
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+CPU_SATURATED = 0.9  # Host CPU busy fraction above which a level is not held to the scaling check
+
+
+def _wait_for(url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server at {url} did not come up in {timeout}s")
+
+
+def _start(module: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module, "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT,
+        env=env,
+    )
+
+
+def _create_schema(database_url: str) -> None:
+    # The Alembic migrations target PostgreSQL; for SQLite we build the schema from the models.
+    os.environ["DATABASE_URL"] = database_url
+    sys.path.insert(0, REPO_ROOT)
+    from backend import models
+    from backend.database import engine
+
+    models.Base.metadata.create_all(bind=engine)
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(p / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def latency_summary(values: list, scale: float = 1.0) -> dict:
+    values = sorted(v * scale for v in values)
+    return {f"p{p}_ms": round(percentile(values, p), 2) for p in (50, 95, 99)}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def write_results(path: str, benchmark: str, settings: dict, results: list) -> None:
+    # One JSON document per run; compare runs with e.g. `jq` or a small diff script.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({
+            "benchmark": benchmark,
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "settings": settings,
+            "results": results,
+        }, f, indent=2)
+    print(f"Wrote {path}")
+
+
+def host_cpu_times() -> Optional[Tuple[int, int]]:
+    # (total, idle) jiffies of all CPUs since boot; None where /proc/stat is not available
+    try:
+        with open("/proc/stat") as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    return sum(values), values[3] + values[4]  # idle + iowait
+
+
+def cpu_busy(before: Optional[Tuple[int, int]], after: Optional[Tuple[int, int]]) -> Optional[float]:
+    if before is None or after is None or after[0] == before[0]:
+        return None
+    return round(1 - (after[1] - before[1]) / (after[0] - before[0]), 2)
+
+
+def upstream_connection_counts(app_url: str) -> Optional[Tuple[int, int]]:
+    # (requests that reached the upstream stage, those holding a database connection when they
+    # did) from the app's chat_stage_db_connections histogram; None when metrics are off.
+    response = httpx.get(f"{app_url}/metrics", timeout=5.0)
+    if response.status_code != 200:
+        return None
+    counts = {}
+    for name in ("bucket", "count"):
+        match = re.search(r'^chat_stage_db_connections_%s\{stage="upstream"(?:,le="0")?\} (\d+)' % name,
+                          response.text, re.MULTILINE)
+        counts[name] = int(match.group(1)) if match else 0
+    return counts["count"], counts["count"] - counts["bucket"]
+
+
+def check_results(results: List[dict], min_scaling: float) -> List[str]:
+    failures = []
+    for result in results:
+        if result["errors"]:
+            failures.append(f"concurrency {result['concurrency']}: {result['errors']} requests failed")
+        if result.get("upstream_with_connection"):
+            failures.append(f"concurrency {result['concurrency']}: {result['upstream_with_connection']} requests "
+                            f"held a database connection during the upstream call")
+    for previous, result in zip(results, results[1:]):
+        expected = min_scaling * previous["rps"] * result["concurrency"] / previous["concurrency"]
+        saturated = (result.get("host_cpu_busy") or 0) >= CPU_SATURATED
+        if result["rps"] < expected and not saturated:
+            failures.append(f"concurrency {result['concurrency']}: {result['rps']} requests/s, expected at least "
+                            f"{expected:.1f} ({min_scaling:g} of linear scaling from concurrency "
+                            f"{previous['concurrency']}, host CPU {result.get('host_cpu_busy')} busy)")
+    return failures
+
+
+async def _run_level(app_url: str, concurrency: int, total: int, chats: dict) -> dict:
+    # chats: user_id -> chat_id, carried across levels so later turns continue the users' chats
+    latencies = []
+    stages = {}  # stage -> list of milliseconds, from the Server-Timing header
+    errors = 0
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async with httpx.AsyncClient(base_url=app_url, timeout=60.0,
+                                 limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker():
+            nonlocal errors
+            while True:
+                try:
+                    i = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                started = time.perf_counter()
+                user_id = 1 + i % 50
+                body = {"message": f"hello {i}", "user_id": user_id}
+                if user_id in chats:
+                    body["chat_id"] = chats[user_id]
+                response = await client.post("/api/v1/chat", json=body)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    errors += 1
+                    continue
+                chats.setdefault(user_id, response.json()["chat_id"])
+                for name, ms in timing.parse_header(response.headers.get("server-timing", "")).items():
+                    stages.setdefault(name, []).append(ms)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(total / elapsed, 1),
+        **latency_summary(latencies, 1000),
+        "stages": {name: latency_summary(values) for name, values in stages.items()},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Concurrency load test for /api/v1/chat")
+    parser.add_argument("--levels", default="1,8,32,128")
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--stub-latency-ms", default="200")
+    parser.add_argument("--stub-tokens", default="32", help="Tokens in each stub reply")
+    parser.add_argument("--database-url", help="Defaults to a throwaway SQLite database")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra app setting, e.g. WRITE_BEHIND_ENABLED=true (repeatable)")
+    parser.add_argument("--min-scaling", type=float, default=0.5,
+                        help="Least requests/sec per level, as a fraction of linear scaling from the previous "
+                             "level (0 disables the check)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--stub-port", type=int, default=9100)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        tmpdir = tempfile.mkdtemp(prefix="chat_load_")
+        database_url = f"sqlite:///{os.path.join(tmpdir, 'load.db')}"
+    _create_schema(database_url)
+
+    settings = {
+        "DATABASE_URL": database_url,
+        "OPENROUTER_API_KEY": "stub-key",
+        "OPENROUTER_API_URL": f"http://127.0.0.1:{args.stub_port}/api/v1/chat/completions",
+        "STUB_LATENCY_MS": args.stub_latency_ms,
+        "STUB_COMPLETION_TOKENS": args.stub_tokens,
+        "RATE_LIMIT_ENABLED": "false",  # Measure the request path, not the limiter's 429s
+        "SERVER_TIMING_ENABLED": "true",
+        "METRICS_ENABLED": "true",  # For the connections held during the upstream stage
+        "CONTEXT_CACHE_MAX_ENTRIES": "0",  # Every turn reads its history from the database
+    }
+    settings.update(item.split("=", 1) for item in args.env)
+    env = dict(os.environ, **settings)
+    stub = _start("backend.bench.stub_openrouter:app", args.stub_port, env)
+    app = _start("backend.main:app", args.app_port, env)
+    try:
+        _wait_for(f"http://127.0.0.1:{args.stub_port}/docs")
+        _wait_for(f"http://127.0.0.1:{args.app_port}/")
+        app_url = f"http://127.0.0.1:{args.app_port}"
+        results = []
+        chats = {}
+        for level in (int(x) for x in args.levels.split(",")):
+            connections_before, cpu_before = upstream_connection_counts(app_url), host_cpu_times()
+            result = asyncio.run(_run_level(app_url, level, max(args.requests, level), chats))
+            result["host_cpu_busy"] = cpu_busy(cpu_before, host_cpu_times())
+            connections_after = upstream_connection_counts(app_url)
+            if connections_before is not None and connections_after is not None:
+                result["upstream_with_connection"] = connections_after[1] - connections_before[1]
+            print(result)
+            results.append(result)
+        if args.json:
+            settings.pop("OPENROUTER_API_KEY")
+            settings["DATABASE_URL"] = repr(make_url(database_url))  # Password masked
+            write_results(args.json, "chat_load", {**settings, "requests": args.requests}, results)
+    finally:
+        app.terminate()
+        stub.terminate()
+        app.wait()
+        stub.wait()
+
+    failures = check_results(results, args.min_scaling)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+    print("Checks passed: no connection held across the upstream call, requests/sec scaled with concurrency.")
+
+
+if __name__ == "__main__":
+    main()
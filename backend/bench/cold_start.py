@@ -0,0 +1,144 @@
+# Cold-start time and requests/sec of the server launch modes.
+#
+# Usage (from the repository root):
+#   python -m backend.bench.cold_start [--database-url postgresql://localhost/chat_bench] \
+#       [--runs 5] [--workers 2] [--concurrency 32] [--requests 512] [--json results/cold_start.json]
+#
+# Modes:
+#   dev    `uvicorn backend.main:app` with MIGRATE_ON_STARTUP=true: one process that runs the
+#          migrations from its startup hook on every boot (how the Docker image used to start)
+#   serve  `python -m backend.serve --workers N`: migrations once as a leader step, then N workers
+#          with uvloop and httptools (backend/serve.py)
+#   worker `python -m backend.serve --no-migrate --workers N`: migrations run as a separate deploy
+#          job, so a boot (or a replacement after a crash) only starts workers
+# Cold start is the time from spawning the server to its first successful `GET /`, over --runs
+# boots against a database already at head; the import time of backend.main is measured in a
+# fresh interpreter. Requests/sec is then measured at --concurrency against the stub upstream, as
+# in chat_load.py. More workers only pay off with as many free CPUs as workers.
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from backend.bench.chat_load import REPO_ROOT, _run_level, _start, write_results
+
+
+def _boot(command: list, env: dict, url: str, timeout: float = 60.0):
+    # Returns (seconds until the first 200, the running process)
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while time.perf_counter() - started < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(command)} exited with {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return time.perf_counter() - started, process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.01)
+    process.kill()
+    raise RuntimeError(f"{' '.join(command)} did not answer within {timeout}s")
+
+
+def _stop(process: subprocess.Popen) -> float:
+    # Graceful stop (SIGTERM); returns how long the drain took
+    started = time.perf_counter()
+    process.terminate()
+    process.wait(timeout=60)
+    return time.perf_counter() - started
+
+
+def import_seconds(env: dict) -> float:
+    code = "import time; t = time.perf_counter(); import backend.main; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, env=env, capture_output=True, text=True,
+                            check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Cold start and throughput of the launch modes")
+    parser.add_argument("--database-url", help="Defaults to a throwaway SQLite database")
+    parser.add_argument("--runs", type=int, default=5, help="Boots per mode")
+    parser.add_argument("--workers", type=int, default=2, help="Workers in serve mode")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--stub-latency-ms", default="50")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--stub-port", type=int, default=9100)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='cold_start_'), 'cold.db')}"
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        OPENROUTER_API_KEY="stub-key",
+        OPENROUTER_API_URL=f"http://127.0.0.1:{args.stub_port}/api/v1/chat/completions",
+        STUB_LATENCY_MS=args.stub_latency_ms,
+        RATE_LIMIT_ENABLED="false",
+    )
+    # Bring the database to head once, so every boot below measures a no-op migration
+    subprocess.run([sys.executable, "-m", "backend.migrations"], cwd=REPO_ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    port = str(args.app_port)
+    modes = {
+        "dev": ([sys.executable, "-m", "uvicorn", "backend.main:app", "--port", port, "--log-level", "warning"],
+                {"MIGRATE_ON_STARTUP": "true"}),
+        "serve": ([sys.executable, "-m", "backend.serve", "--port", port, "--workers", str(args.workers)],
+                  {"SERVER_LOG_LEVEL": "warning"}),
+        "worker": ([sys.executable, "-m", "backend.serve", "--no-migrate", "--port", port, "--workers", str(args.workers)],
+                   {"SERVER_LOG_LEVEL": "warning"}),
+    }
+    url = f"http://127.0.0.1:{args.app_port}/"
+    stub = _start("backend.bench.stub_openrouter:app", args.stub_port, env)
+    results = []
+    try:
+        print(f"import backend.main: {import_seconds(env) * 1000:.0f} ms")
+        for mode, (command, extra_env) in modes.items():
+            mode_env = dict(env, **extra_env)
+            boots, drains = [], []
+            for _ in range(args.runs):
+                seconds, process = _boot(command, mode_env, url)
+                boots.append(seconds)
+                drains.append(_stop(process))
+            _, process = _boot(command, mode_env, url)
+            try:
+                time.sleep(1)  # Let every worker finish starting
+                load = asyncio.run(_run_level(url.rstrip("/"), args.concurrency, args.requests))
+            finally:
+                _stop(process)
+            result = {
+                "name": mode,
+                "workers": 1 if mode == "dev" else args.workers,
+                "cold_start_ms": round(statistics.median(boots) * 1000, 1),
+                "cold_start_max_ms": round(max(boots) * 1000, 1),
+                "shutdown_ms": round(statistics.median(drains) * 1000, 1),
+                "rps": load["rps"],
+                "p50_ms": load["p50_ms"],
+                "p99_ms": load["p99_ms"],
+                "errors": load["errors"],
+            }
+            print(result)
+            results.append(result)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    if args.json:
+        settings = {"runs": args.runs, "workers": args.workers, "concurrency": args.concurrency,
+                    "requests": args.requests, "cpus": len(os.sched_getaffinity(0)),
+                    "database": database_url.split(":", 1)[0]}
+        write_results(args.json, "cold_start", settings, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Compares two result files written with --json by chat_load.py, micro.py or transfer_bench.py.
+#
+# Usage (from the repository root):
+#   python -m backend.bench.compare results/before.json results/after.json [--threshold 10]
+#
+# Prints the change of every metric and exits non-zero when one got worse by more than
+# --threshold percent: higher latency or time per operation, or lower throughput.
+import argparse
+import json
+import sys
+
+# Metrics where a higher value is better; every other *_ms / us_per_op metric is better lower.
+HIGHER_IS_BETTER = ("rps", "ops_per_s")
+
+
+def _metrics(document: dict) -> dict:
+    # Flattens results into {"<case>.<metric>": value}; chat_load cases are keyed by concurrency.
+    metrics = {}
+    for result in document["results"]:
+        case = result.get("name") or f"c{result['concurrency']}"
+        for key, value in result.items():
+            if key in HIGHER_IS_BETTER or key.endswith("_ms") or key == "us_per_op":
+                metrics[f"{case}.{key}"] = value
+        for stage, summary in (result.get("stages") or {}).items():
+            for key, value in summary.items():
+                metrics[f"{case}.{stage}.{key}"] = value
+    return metrics
+
+
+def compare(before: dict, after: dict, threshold: float) -> list:
+    # Returns (metric, before, after, change %, regressed) for every metric present in both runs.
+    rows = []
+    old, new = _metrics(before), _metrics(after)
+    for metric in sorted(old.keys() & new.keys()):
+        if not old[metric]:
+            continue
+        change = (new[metric] - old[metric]) / old[metric] * 100
+        worse = -change if metric.rsplit(".", 1)[-1] in HIGHER_IS_BETTER else change
+        rows.append((metric, old[metric], new[metric], change, worse > threshold))
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Percent worse that counts as a regression")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before["benchmark"] != after["benchmark"]:
+        sys.exit(f"Cannot compare a {before['benchmark']} run with a {after['benchmark']} run.")
+
+    print(f"{before['benchmark']}: {before['commit']} -> {after['commit']}")
+    rows = compare(before, after, args.threshold)
+    for metric, old, new, change, regressed in rows:
+        print(f"{'REGRESSION ' if regressed else '           '}{metric:45s} {old:>12} {new:>12} {change:+8.1f}%")
+    regressions = sum(1 for row in rows if row[4])
+    if regressions:
+        sys.exit(f"{regressions} metric(s) regressed by more than {args.threshold}%.")
+
+
+if __name__ == "__main__":
+    main()
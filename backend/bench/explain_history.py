@@ -0,0 +1,102 @@
+# EXPLAIN-based regression check for the history window query.
+#
+# Usage (from the repository root, against a PostgreSQL DATABASE_URL):
+#   python -m backend.bench.explain_history --messages 1000000 --chats 10000
+#
+# Builds the schema in a scratch `explain_check` schema, seeds it with generate_series,
+# runs ANALYZE and then EXPLAINs the exact queries history.load_recent_messages issues
+# (first page and a keyset page). Exits non-zero if PostgreSQL plans a sequential scan
+# on messages instead of using an index. The scratch schema is dropped afterwards
+# unless --keep is given.
+import argparse
+import sys
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from backend.config import load_env_file
+
+if __name__ == "__main__":
+    load_env_file()  # Before backend.database reads DATABASE_URL
+
+from backend import history, models
+from backend.database import engine
+
+SCHEMA = "explain_check"
+HISTORY_INDEX = "ix_messages_chat_id_created_at"
+
+
+def _seed(conn, messages: int, chats: int) -> None:
+    conn.execute(text("INSERT INTO users (id, username) VALUES (1, 'explain_user')"))
+    conn.execute(text(
+        "INSERT INTO chats (id, user_id, title, created_at) "
+        "SELECT g, 1, 'chat ' || g, now() - interval '30 days' FROM generate_series(1, :chats) AS g"
+    ), {"chats": chats})
+    conn.execute(text(
+        "INSERT INTO messages (id, chat_id, content, sender_type, created_at) "
+        "SELECT g, 1 + (g % :chats), repeat('lorem ipsum ', 8), "
+        "       CASE WHEN g % 2 = 0 THEN 'user' ELSE 'ai' END, "
+        "       now() - make_interval(secs => :messages - g) "
+        "FROM generate_series(1, :messages) AS g"
+    ), {"chats": chats, "messages": messages})
+    conn.execute(text("ANALYZE users, chats, messages"))
+
+
+def _plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def _explain(conn, query) -> list:
+    sql = str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+    return list(_plan_nodes(plan[0]["Plan"]))
+
+
+def _check(conn, label: str, query) -> bool:
+    nodes = _explain(conn, query)
+    seq_scans = [n for n in nodes if n["Node Type"] == "Seq Scan" and n.get("Relation Name") == "messages"]
+    indexes = sorted({n["Index Name"] for n in nodes if n.get("Index Name")})
+    ok = HISTORY_INDEX in indexes and not seq_scans
+    print(f"{'OK  ' if ok else 'FAIL'} {label}: indexes={indexes} seq scans on messages={len(seq_scans)}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="EXPLAIN regression check for the history window query")
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--chats", type=int, default=10_000)
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded scratch schema")
+    args = parser.parse_args()
+
+    if engine.dialect.name != "postgresql":
+        sys.exit("explain_history needs a PostgreSQL DATABASE_URL")
+
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        conn.execute(text(f"SET search_path TO {SCHEMA}"))
+        models.Base.metadata.create_all(bind=conn)
+        print(f"Seeding {args.messages} messages across {args.chats} chats...")
+        _seed(conn, args.messages, args.chats)
+
+        chat_id = args.chats // 2
+        last_page_id = conn.execute(
+            text("SELECT id FROM messages WHERE chat_id = :c ORDER BY created_at DESC, id DESC OFFSET 20 LIMIT 1"),
+            {"c": chat_id},
+        ).scalar()
+        results = [
+            _check(conn, "history first page", history.history_page_query(chat_id, history.HISTORY_PAGE_SIZE)),
+            _check(conn, "history keyset page", history.history_page_query(chat_id, history.HISTORY_PAGE_SIZE, last_page_id)),
+        ]
+
+        if not args.keep:
+            conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# Micro-benchmarks for the chat hot path: history assembly, token counting, log writes, response
+# serialization and the cost of the request instrumentation (backend/metrics.py).
+#
+# Usage (from the repository root):
+#   python -m backend.bench.micro [--database-url postgresql://...] [--json results/micro.json]
+#
+# Runs in-process against a throwaway SQLite database (or --database-url; tables are created if
+# missing and a scratch chat is seeded). Each benchmark is timed over several rounds and reports
+# the median time per operation. With --json the results are written in the same format as
+# chat_load.py, so runs can be compared across commits.
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from backend.bench.chat_load import _create_schema, write_results
+
+
+ROUNDS = 5
+
+
+def case(name: str, fn, iterations: int, ops_per_call: int = 1) -> dict:
+    # fn is a plain or async callable; async ones are awaited on the running loop.
+    return {"name": name, "fn": fn, "iterations": iterations, "ops_per_call": ops_per_call}
+
+
+async def _run(benchmark: dict) -> dict:
+    fn = benchmark["fn"]
+    is_async = asyncio.iscoroutinefunction(fn)
+    samples = []
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        for _ in range(benchmark["iterations"]):
+            if is_async:
+                await fn()
+            else:
+                fn()
+        elapsed = time.perf_counter() - started
+        samples.append(elapsed / (benchmark["iterations"] * benchmark["ops_per_call"]))
+    per_op = statistics.median(samples)
+    return {
+        "name": benchmark["name"],
+        "us_per_op": round(per_op * 1e6, 3),
+        "ops_per_s": round(1 / per_op, 1),
+        "spread_pct": round((max(samples) - min(samples)) / per_op * 100, 1),
+    }
+
+
+async def _seed_chat(messages: int) -> int:
+    from backend import models
+    from backend.database import AsyncSessionLocal
+    from backend.tokens import count_tokens
+
+    async with AsyncSessionLocal() as db:
+        user = models.User(username=f"micro_{time.time_ns()}")
+        db.add(user)
+        await db.flush()
+        chat = models.Chat(user_id=user.id, title="micro-benchmark")
+        db.add(chat)
+        await db.flush()
+        now = datetime.now(timezone.utc)
+        contents = [f"message {i} " + "lorem ipsum dolor sit amet " * 8 for i in range(messages)]
+        db.add_all([
+            models.Message(chat_id=chat.id, sender_type="user" if i % 2 == 0 else "ai", content=content,
+                           token_count=count_tokens(content), created_at=now)
+            for i, content in enumerate(contents)
+        ])
+        await db.commit()
+        return chat.id
+
+
+async def _benchmarks(args) -> list:
+    from fastapi.encoders import jsonable_encoder
+    from sqlalchemy import select
+    from starlette.requests import Request
+
+    from backend import history, metrics, models, schemas, tokens
+    from backend.timing import stage
+    from backend.database import AsyncSessionLocal, async_engine
+    from backend.log_sink import LogSink
+    from backend.main import page_response
+
+    chat_id = await _seed_chat(args.messages)
+    context = [history.context_message("user" if i % 2 == 0 else "ai", "lorem ipsum dolor sit amet " * 8)
+               for i in range(args.messages)]
+    history.context_cache.put(chat_id, history.trim_window(context))
+    new_message = history.context_message("user", "and one more question")
+
+    def history_assemble():
+        # Cached prior turns + the new message -> trimmed window -> OpenRouter messages
+        prior = history.context_cache.get(chat_id)
+        history.to_api_messages(history.trim_window(prior + [new_message]))
+
+    window = history.context_cache.get(chat_id)
+
+    def count_message_tokens():
+        tokens.count_tokens(response["reply"])
+
+    def budget_stored_counts():
+        # Prompt size of a cached window: integer sums over the stored counts
+        tokens.prompt_tokens(window)
+
+    def budget_recount():
+        # The same, re-tokenizing every message as a window without stored counts would need
+        sum(tokens.count_tokens(m["content"]) for m in window)
+
+    async def history_db_load():
+        # Cache miss: walk the chat newest-first through ix_messages_chat_id_created_at
+        async with AsyncSessionLocal() as db:
+            await history.load_recent_messages(db, chat_id)
+
+    response = {"reply": "lorem ipsum dolor sit amet " * 20, "chat_id": chat_id, "user_message_id": 1,
+                "ai_message_id": 2, "model": "gryphe/mythomax-l2-13b"}
+
+    sink = LogSink(max_queue=args.iterations * ROUNDS)
+    await sink.start()
+    sink._task.cancel()  # Keep the queue, stop the background flusher: measure emit() alone
+    await asyncio.sleep(0)
+
+    def log_emit():
+        sink.emit("INFO", f"Stored AI message for chat {chat_id}, user 1.")
+
+    log_rows = [{"level": "INFO", "message": f"Stored AI message for chat {chat_id}, user 1.",
+                 "timestamp": datetime.utcnow()} for _ in range(args.log_batch)]
+
+    async def log_flush():
+        await sink._flush(log_rows)
+
+    def serialize_chat_response():
+        # What FastAPI does for response_model endpoints
+        schemas.ChatCompletionResponse(**response).json()
+        jsonable_encoder(schemas.ChatCompletionResponse(**response))
+
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(
+            select(models.Message.id, models.Message.sender_type, models.Message.content, models.Message.created_at,
+                   models.Message.token_usage, models.Message.model)
+            .where(models.Message.chat_id == chat_id).limit(51)
+        )).all()
+    columns = ["id", "sender_type", "content", "created_at", "token_usage", "model"]
+    request = Request({"type": "http", "method": "GET", "path": "/", "headers": []})
+
+    def serialize_message_page_pydantic():
+        schemas.MessagePage(items=[dict(zip(columns, row)) for row in rows[:50]], next_cursor="NTA").json()
+
+    def serialize_message_page_direct():
+        page_response(request, rows, 50, columns)
+
+    def instrumented_stage():
+        # What each timed stage of a chat request adds: two clock reads and a histogram update
+        with stage("micro"):
+            pass
+
+    benchmarks = [
+        case("history_assemble_cached", history_assemble, args.iterations),
+        case("history_load_db", history_db_load, max(1, args.iterations // 100)),
+        case(f"count_tokens_{tokens.tokenizer.name}", count_message_tokens, args.iterations),
+        case("prompt_budget_stored_counts", budget_stored_counts, args.iterations),
+        case(f"prompt_budget_recount_{tokens.tokenizer.name}", budget_recount, max(1, args.iterations // 10)),
+        case("log_emit", log_emit, args.iterations),
+        case("log_flush_per_row", log_flush, max(1, args.iterations // 1000), ops_per_call=args.log_batch),
+        case("serialize_chat_response", serialize_chat_response, args.iterations),
+        case("serialize_message_page_pydantic", serialize_message_page_pydantic, max(1, args.iterations // 10)),
+        case("serialize_message_page_direct", serialize_message_page_direct, max(1, args.iterations // 10)),
+        case("instrumented_stage", instrumented_stage, args.iterations),
+        case("metrics_render", metrics.registry.render, max(1, args.iterations // 100)),
+    ]
+    results = []
+    for benchmark in benchmarks:
+        result = await _run(benchmark)
+        print(result)
+        results.append(result)
+    await async_engine.dispose()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the chat hot path")
+    parser.add_argument("--iterations", type=int, default=10000, help="Per round for the cheapest benchmarks")
+    parser.add_argument("--messages", type=int, default=200, help="Messages in the seeded chat")
+    parser.add_argument("--log-batch", type=int, default=500, help="Rows per log flush")
+    parser.add_argument("--database-url", help="Defaults to a throwaway SQLite database")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='micro_'), 'micro.db')}"
+    _create_schema(database_url)
+    results = asyncio.run(_benchmarks(args))
+    if args.json:
+        settings = {"iterations": args.iterations, "messages": args.messages, "log_batch": args.log_batch,
+                    "database": database_url.split(":", 1)[0]}
+        write_results(args.json, "micro", settings, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# Seeded test of the index check that runs after migrating (backend/migrations.py).
+#
+# Usage (from the repository root, against a scratch PostgreSQL database):
+#   python -m backend.bench.migration_check --database-url postgresql://localhost/migration_check
+#
+# Migrates the database to head and smoke-tests the migrations on it while it is still empty:
+#   - the database is at the head revision, and upgrading again changes nothing,
+#   - every revision downgrades (to base, which drops the tables) and upgrades again, and
+#   - no index is left INVALID by a failed CREATE INDEX CONCURRENTLY.
+# It then seeds the database with generate_series (users, chats and messages, whose search vectors
+# the trigger fills in), runs ANALYZE and asserts that
+#   - every hot-path query uses its index (migrations.index_plan_failures), and
+#   - the check notices a missing index: with ix_chats_user_id_created_at dropped in a transaction
+#     that is rolled back afterwards, the chat list query, and only that one, is reported.
+# Exits non-zero if an assertion fails. Refuses to seed a database that already has users.
+import argparse
+import os
+import sys
+
+from sqlalchemy import inspect, text
+
+DROPPED_INDEX = "ix_chats_user_id_created_at"
+WORDS = ["hello", "weather", "python", "billing", "travel", "recipe"]
+
+
+def _seed(conn, messages: int, chats: int, users: int) -> None:
+    conn.execute(text(
+        "INSERT INTO users (id, username) SELECT g, 'check_user_' || g FROM generate_series(1, :users) AS g"
+    ), {"users": users})
+    conn.execute(text(
+        "INSERT INTO chats (id, user_id, title, created_at) "
+        "SELECT g, 1 + g % :users, 'chat ' || g, now() - interval '30 days' FROM generate_series(1, :chats) AS g"
+    ), {"users": users, "chats": chats})
+    conn.execute(text(
+        "INSERT INTO messages (id, chat_id, content, sender_type, created_at) "
+        "SELECT g, 1 + g % :chats, 'message ' || g || ' about ' || (:words)[1 + g % :word_count], "
+        "       CASE WHEN g % 2 = 0 THEN 'user' ELSE 'ai' END, now() - make_interval(secs => :messages - g) "
+        "FROM generate_series(1, :messages) AS g"
+    ), {"chats": chats, "messages": messages, "words": WORDS, "word_count": len(WORDS)})
+    for table in ("users", "chats", "messages"):
+        conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"))
+    conn.execute(text("ANALYZE users, chats, messages"))
+
+
+def _revision(engine) -> str:
+    from alembic.runtime.migration import MigrationContext
+
+    with engine.connect() as conn:
+        return MigrationContext.configure(conn).get_current_revision()
+
+
+def _invalid_indexes(engine) -> list:
+    with engine.connect() as conn:
+        return list(conn.execute(text(
+            "SELECT indexrelid::regclass::text FROM pg_index WHERE NOT indisvalid"
+        )).scalars())
+
+
+def _smoke_test(engine) -> list:
+    # Assertions on the freshly migrated, still empty database; returns their outcomes
+    from alembic import command as alembic_command
+    from alembic.config import Config as AlembicConfig
+    from alembic.script import ScriptDirectory
+
+    from backend import migrations
+
+    config = AlembicConfig(migrations.ALEMBIC_INI)
+    head = ScriptDirectory.from_config(config).get_current_head()
+    results = [_report("database is at the head revision", _revision(engine) == head, [])]
+    migrations.upgrade_to_head()
+    results.append(_report("upgrading at head changes nothing", _revision(engine) == head, []))
+
+    alembic_command.downgrade(config, "base")
+    left = sorted(set(inspect(engine).get_table_names()) - {"alembic_version"})
+    results.append(_report("every revision downgrades to base", _revision(engine) is None and not left,
+                           [f"tables left: {', '.join(left)}"] if left else []))
+    migrations.upgrade_to_head()
+    results.append(_report("and upgrades back to head", _revision(engine) == head, []))
+    invalid = _invalid_indexes(engine)
+    results.append(_report("no index is left invalid", not invalid, invalid))
+    return results
+
+
+def _report(label: str, ok: bool, failures: list) -> bool:
+    print(f"{'OK  ' if ok else 'FAIL'} {label}" + (f": {'; '.join(failures)}" if failures else ""))
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Seeded test of the post-migration index check")
+    parser.add_argument("--database-url", help="Scratch PostgreSQL database (default: DATABASE_URL)")
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--chats", type=int, default=2_000)
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    from backend.config import load_env_file
+
+    load_env_file()
+    from backend import migrations
+    from backend.database import engine
+
+    if engine.dialect.name != "postgresql":
+        sys.exit("migration_check needs a PostgreSQL database")
+
+    migrations.upgrade_to_head()
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT EXISTS (SELECT 1 FROM users)")).scalar():
+            sys.exit("The database already has users; run migration_check against a scratch database")
+    results = _smoke_test(engine)
+
+    with engine.begin() as conn:
+        print(f"Seeding {args.messages} messages across {args.chats} chats of {args.users} users...")
+        _seed(conn, args.messages, args.chats, args.users)
+
+    with engine.begin() as conn:
+        failures = migrations.index_plan_failures(conn)
+    results.append(_report("hot-path queries use their indexes", not failures, failures))
+
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            conn.execute(text(f"DROP INDEX {DROPPED_INDEX}"))
+            failures = migrations.index_plan_failures(conn)
+        finally:
+            transaction.rollback()
+    caught = len(failures) == 1 and failures[0].startswith("chat list") and DROPPED_INDEX in failures[0]
+    results.append(_report(f"check reports the chat list once {DROPPED_INDEX} is dropped", caught,
+                           [] if caught else failures or ["nothing reported"]))
+    engine.dispose()
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
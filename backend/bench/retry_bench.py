@@ -0,0 +1,138 @@
+# Duplicate work caused by client retries, with and without Idempotency-Key (idempotency.py).
+#
+# Usage (from the repository root):
+#   python -m backend.bench.retry_bench [--messages 200] [--concurrency 20] [--slow-rate 0.3] [--json results/retry.json]
+#
+# Starts the stub upstream and the app as in chat_load.py, with a fraction (--slow-rate) of
+# upstream calls taking STUB_SLOW_MS longer than the client's --client-timeout. Each message is a
+# POST /api/v1/chat that the client retries on timeout (up to --retries times), like a mobile
+# client on a flaky network. Runs once without and once with an Idempotency-Key per message (each
+# run on its own users), then counts the upstream calls the app made, the user messages stored,
+# the usage rows and tokens recorded, and the client's latency to a reply.
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+import httpx
+from sqlalchemy import text
+
+from backend.bench.chat_load import _create_schema, _start, _wait_for, latency_summary, write_results
+
+USER_ID_BASE = 2000
+
+
+async def _send(client: httpx.AsyncClient, url: str, user_id: int, message: str, use_key: bool, retries: int,
+                timeout: float, samples: list) -> int:
+    # Returns the attempts made
+    headers = {"Idempotency-Key": uuid.uuid4().hex} if use_key else {}
+    started = time.perf_counter()
+    for attempt in range(1, retries + 2):
+        try:
+            response = await client.post(f"{url}/api/v1/chat", json={"message": message, "user_id": user_id},
+                                         headers=headers, timeout=timeout)
+            if response.status_code == 200:
+                samples.append(time.perf_counter() - started)
+                return attempt
+        except httpx.TimeoutException:
+            pass
+    return retries + 1
+
+
+async def _run(url: str, messages: int, concurrency: int, use_key: bool, user_offset: int, retries: int,
+               timeout: float) -> dict:
+    samples, attempts = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency * 2)) as client:
+        before = (await client.get(f"{url}/api/v1/stats")).json()["upstream"]["calls"]
+
+        async def one(i: int) -> None:
+            async with semaphore:
+                attempts.append(await _send(client, url, USER_ID_BASE + user_offset + i % concurrency,
+                                            f"message {i}", use_key, retries, timeout, samples))
+
+        await asyncio.gather(*(one(i) for i in range(messages)))
+        await asyncio.sleep(3)  # Let abandoned requests finish on the server
+        calls = (await client.get(f"{url}/api/v1/stats")).json()["upstream"]["calls"] - before
+    return {
+        "name": "idempotency_key" if use_key else "no_key",
+        "client_attempts": sum(attempts),
+        "replied": len(samples),
+        "upstream_calls": calls,
+        "latency": latency_summary(samples, 1000),
+        "users": (USER_ID_BASE + user_offset, USER_ID_BASE + user_offset + concurrency - 1),
+    }
+
+
+def _count_writes(first_user: int, last_user: int) -> dict:
+    from backend.database import engine
+
+    with engine.connect() as conn:
+        stored = conn.execute(text(
+            "SELECT count(*) FROM messages m JOIN chats c ON c.id = m.chat_id "
+            "WHERE c.user_id BETWEEN :first AND :last AND m.sender_type = 'user'"
+        ), {"first": first_user, "last": last_user}).scalar()
+        usage_rows, tokens_used = conn.execute(text(
+            "SELECT count(*), coalesce(sum(tokens_used), 0) FROM usage WHERE user_id BETWEEN :first AND :last"
+        ), {"first": first_user, "last": last_user}).one()
+    return {"user_messages_stored": stored, "usage_rows": usage_rows, "tokens_recorded": int(tokens_used)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Duplicate work from client retries, with and without idempotency keys")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--slow-rate", default="0.3", help="Fraction of upstream calls slower than the client timeout")
+    parser.add_argument("--slow-ms", default="1500")
+    parser.add_argument("--client-timeout", type=float, default=1.0, help="Seconds before the client retries")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--database-url", help="Defaults to a throwaway SQLite database")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--stub-port", type=int, default=9100)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='retry_bench_'), 'retry.db')}"
+    _create_schema(database_url)
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        OPENROUTER_API_KEY="stub-key",
+        OPENROUTER_API_URL=f"http://127.0.0.1:{args.stub_port}/api/v1/chat/completions",
+        STUB_LATENCY_MS="100",
+        STUB_SLOW_RATE=args.slow_rate,
+        STUB_SLOW_MS=args.slow_ms,
+        RATE_LIMIT_ENABLED="false",
+    )
+    stub = _start("backend.bench.stub_openrouter:app", args.stub_port, env)
+    app = _start("backend.main:app", args.app_port, env)
+    results = []
+    try:
+        _wait_for(f"http://127.0.0.1:{args.stub_port}/docs")
+        _wait_for(f"http://127.0.0.1:{args.app_port}/")
+        url = f"http://127.0.0.1:{args.app_port}"
+        for offset, use_key in enumerate((False, True)):
+            result = asyncio.run(_run(url, args.messages, args.concurrency, use_key, offset * args.concurrency,
+                                      args.retries, args.client_timeout))
+            result.update(_count_writes(*result.pop("users")))
+            print(result)
+            results.append(result)
+    finally:
+        app.terminate()
+        stub.terminate()
+        app.wait()
+        stub.wait()
+
+    if args.json:
+        settings = {"messages": args.messages, "concurrency": args.concurrency, "slow_rate": args.slow_rate,
+                    "slow_ms": args.slow_ms, "client_timeout": args.client_timeout, "retries": args.retries,
+                    "database": database_url.split(":", 1)[0]}
+        write_results(args.json, "retry", settings, results)
+
+
+if __name__ == "__main__":
+    main()
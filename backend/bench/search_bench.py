@@ -0,0 +1,187 @@
+# Latency of full-text message search (search.py) over a large synthetic history.
+#
+# Usage (from the repository root, against a PostgreSQL DATABASE_URL):
+#   python -m backend.bench.search_bench --messages 2000000 --users 2000 --queries 200 [--budget-ms 50]
+#
+# Builds the schema in a scratch `search_bench` schema and seeds it with generate_series:
+# messages of 8-31 words drawn from a synthetic vocabulary with a skewed (Zipf-like) frequency,
+# spread over --users users with --chats-per-user chats each, plus one heavy user with
+# --heavy-user-messages in 100 chats (above SEARCH_SCAN_MAX_MESSAGES). The GIN index is built
+# after seeding and its build time reported. Then, for several kinds of query (a very common
+# word, a mid-frequency word, a rare word, two words, a phrase, `or`), searches random users'
+# messages, and the heavy user's, through the app's own async path and prints p50/p95/p99
+# latency of the first page and of the next keyset page. Exits non-zero if a regular user's p95
+# is above --budget-ms. The scratch schema is dropped afterwards unless --keep is given.
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from sqlalchemy import text
+
+from backend.bench.chat_load import latency_summary, write_results
+
+SCHEMA = "search_bench"
+VOCABULARY_SIZE = 20000
+SKEW = 3  # Word index = VOCABULARY_SIZE * random()^SKEW: low indexes are the common words
+PAGE_SIZE = 20
+# Word i is three consonant-vowel syllables spelling i in base 70, computed the same way in SQL
+SYLLABLES = [c + v for c in "bdfgklmnprstvz" for v in "aeiou"]
+_SQL_WORD = ("(:syllables)[1 + {i} % 70] || (:syllables)[1 + {i} / 70 % 70] || "
+             "(:syllables)[1 + {i} / 4900 % 70]")
+
+
+def word(i: int) -> str:
+    return SYLLABLES[i % 70] + SYLLABLES[i // 70 % 70] + SYLLABLES[i // 4900 % 70]
+
+
+def queries() -> dict:
+    # Query kind -> query text; word frequency falls with its index
+    return {
+        "common word": word(0),
+        "mid word": word(200),
+        "rare word": word(8000),
+        "two words": f"{word(3)} {word(40)}",
+        "phrase": f'"{word(0)} {word(1)}"',
+        "or": f"{word(500)} or {word(900)}",
+    }
+
+
+def _seed_messages(conn, first_id: int, messages: int, first_chat: int, chats: int) -> None:
+    conn.execute(text(
+        "INSERT INTO messages (id, chat_id, content, sender_type, created_at) "
+        "SELECT :first_id + g, :first_chat + (g % :chats), "
+        f"      (SELECT string_agg({_SQL_WORD.format(i='w.i')}, ' ') "
+        "        FROM (SELECT floor(:size * power(random(), :skew))::int AS i "
+        "              FROM generate_series(1, 8 + (g % 24))) AS w), "
+        "       CASE WHEN g % 2 = 0 THEN 'user' ELSE 'ai' END, "
+        "       now() - make_interval(secs => :messages - g) "
+        "FROM generate_series(0, :messages - 1) AS g"
+    ), {"first_id": first_id, "first_chat": first_chat, "chats": chats, "messages": messages,
+        "syllables": SYLLABLES, "size": VOCABULARY_SIZE, "skew": SKEW})
+
+
+def _seed(conn, messages: int, users: int, chats_per_user: int, heavy_messages: int) -> int:
+    # Returns the id of the heavy user: user `users + 1`, with heavy_messages in 100 chats
+    chats = users * chats_per_user
+    heavy_user = users + 1
+    conn.execute(text("INSERT INTO users (id, username) SELECT g, 'user ' || g FROM generate_series(1, :users) AS g"),
+                 {"users": heavy_user})
+    conn.execute(text(
+        "INSERT INTO chats (id, user_id, title, created_at) "
+        "SELECT g, 1 + (g % :users), 'chat ' || g, now() - interval '30 days' FROM generate_series(1, :chats) AS g"
+    ), {"users": users, "chats": chats})
+    conn.execute(text(
+        "INSERT INTO chats (id, user_id, title, created_at) "
+        "SELECT :chats + g, :user_id, 'chat ' || g, now() - interval '30 days' FROM generate_series(1, 100) AS g"
+    ), {"chats": chats, "user_id": heavy_user})
+    _seed_messages(conn, 1, messages, 1, chats)
+    _seed_messages(conn, messages + 1, heavy_messages, chats + 1, 100)
+    return heavy_user
+
+
+async def _measure(conn, user_ids: list, query: str, runs: int) -> dict:
+    from backend import search
+
+    first, second = [], []
+    matches = 0
+    for _ in range(runs):
+        user_id = random.choice(user_ids)
+        started = time.perf_counter()
+        rows = await search.search_messages(conn, user_id, query, None, PAGE_SIZE + 1)
+        first.append(time.perf_counter() - started)
+        matches += len(rows)
+        if len(rows) > PAGE_SIZE:
+            last = rows[PAGE_SIZE - 1]
+            started = time.perf_counter()
+            await search.search_messages(conn, user_id, query, (last.rank, last.id), PAGE_SIZE + 1)
+            second.append(time.perf_counter() - started)
+    return {
+        "first_page": latency_summary(first, 1000),
+        "next_page": latency_summary(second, 1000) if second else None,
+        "avg_hits_first_page": round(min(matches / runs, PAGE_SIZE), 1),
+    }
+
+
+async def _measure_all(users: int, heavy_user: int, runs: int) -> list:
+    from backend.database import async_engine
+
+    random.seed(7)
+    audiences = {"": list(range(1, users + 1)), "heavy user, ": [heavy_user]}
+    results = []
+    async with async_engine.connect() as conn:
+        await conn.execute(text(f"SET search_path TO {SCHEMA}"))
+        for audience, user_ids in audiences.items():
+            for kind, query in queries().items():
+                result = {"name": audience + kind, "query": query, **await _measure(conn, user_ids, query, runs)}
+                print(result)
+                results.append(result)
+    await async_engine.dispose()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Full-text search latency over a large history")
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--chats-per-user", type=int, default=10)
+    parser.add_argument("--heavy-user-messages", type=int, default=100_000,
+                        help="Messages of one extra user, searched separately")
+    parser.add_argument("--queries", type=int, default=200, help="Searches per query kind")
+    parser.add_argument("--budget-ms", type=float, default=50.0, help="Fail if a regular user's p95 is above this")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded scratch schema")
+    args = parser.parse_args()
+
+    from backend.config import load_env_file
+
+    load_env_file()
+    from backend import models, search  # Here, so --help works without a DATABASE_URL
+    from backend.database import engine
+
+    if engine.dialect.name != "postgresql":
+        sys.exit("search_bench needs a PostgreSQL DATABASE_URL")
+
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        conn.execute(text(f"SET search_path TO {SCHEMA}"))
+        models.Base.metadata.create_all(bind=conn)
+        conn.execute(text("DROP INDEX ix_messages_search_vector"))  # Built once after seeding, below
+        print(f"Seeding {args.messages} messages for {args.users} users...")
+        started = time.perf_counter()
+        heavy_user = _seed(conn, args.messages, args.users, args.chats_per_user, args.heavy_user_messages)
+        seed_seconds = time.perf_counter() - started
+    with engine.begin() as conn:
+        conn.execute(text(f"SET search_path TO {SCHEMA}"))
+        started = time.perf_counter()
+        conn.execute(text("CREATE INDEX ix_messages_search_vector ON messages USING gin (search_vector)"))
+        index_seconds = time.perf_counter() - started
+        conn.execute(text("ANALYZE users, chats, messages"))
+        index_size = conn.execute(text("SELECT pg_size_pretty(pg_relation_size('ix_messages_search_vector'))")).scalar()
+    print(f"Seeded in {seed_seconds:.0f}s (with the trigger); GIN index built in {index_seconds:.0f}s, {index_size}.")
+
+    results = asyncio.run(_measure_all(args.users, heavy_user, args.queries))
+
+    if not args.keep:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+    if args.json:
+        settings = {"messages": args.messages, "users": args.users, "chats_per_user": args.chats_per_user,
+                    "heavy_user_messages": args.heavy_user_messages, "scan_max_messages": search.SEARCH_SCAN_MAX_MESSAGES,
+                    "queries": args.queries, "index_build_s": round(index_seconds, 1), "index_size": index_size}
+        write_results(args.json, "search", settings, results)
+
+    # Results are ranked over all of a user's matches, so the heavy user's searches for common
+    # words cost more; they are reported but not held to the budget.
+    over = [r["name"] for r in results if not r["name"].startswith("heavy user")
+            and max(r["first_page"]["p95_ms"], (r["next_page"] or {}).get("p95_ms", 0)) > args.budget_ms]
+    if over:
+        print(f"p95 above {args.budget_ms:.0f} ms: {', '.join(over)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
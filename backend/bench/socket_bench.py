@@ -0,0 +1,157 @@
+# Per-message latency of a chat conversation over HTTP streaming vs. the chat WebSocket.
+#
+# Usage (from the repository root):
+#   python -m backend.bench.socket_bench [--conversations 16] [--turns 20] [--database-url ...] [--json results/socket.json]
+#
+# Starts the stub upstream and the app as in chat_load.py, then runs --conversations concurrent
+# conversations of --turns messages each (one chat per conversation, a message after the previous
+# reply is done) in three modes:
+#   http_new        POST /api/v1/chat/stream on a new connection per message (what the Flutter
+#                   client's HTTP path does)
+#   http_keepalive  POST /api/v1/chat/stream over one kept-alive connection per conversation
+#   socket          one WS /api/v1/chat/ws connection per conversation
+# and prints p50/p95/p99 of the time to the first reply token and to the stored reply, and
+# messages/sec. The first message of each conversation (which creates its chat) is not counted.
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import httpx
+import websockets
+
+from backend.bench.chat_load import _create_schema, _start, _wait_for, latency_summary, write_results
+
+USER_ID_BASE = 1000  # Conversation i is user USER_ID_BASE + i
+
+
+async def _http_turn(client: httpx.AsyncClient, url: str, user_id: int, chat_id, text: str):
+    # Returns (seconds to the first delta, seconds to done, chat_id)
+    started = time.perf_counter()
+    first = None
+    body = {"message": text, "user_id": user_id, "chat_id": chat_id}
+    async with client.stream("POST", f"{url}/api/v1/chat/stream", json=body) as response:
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                if event == "delta" and first is None:
+                    first = time.perf_counter() - started
+                elif event == "done":
+                    return first, time.perf_counter() - started, json.loads(line[5:])["chat_id"]
+                elif event == "error":
+                    raise RuntimeError(line)
+    raise RuntimeError(f"stream ended without a reply ({response.status_code})")
+
+
+async def _http_conversation(url: str, user_id: int, turns: int, keepalive: bool, samples: dict) -> None:
+    chat_id = None
+    shared = httpx.AsyncClient(timeout=30.0) if keepalive else None
+    try:
+        for turn in range(turns + 1):
+            if keepalive:
+                first, done, chat_id = await _http_turn(shared, url, user_id, chat_id, f"message {turn}")
+            else:
+                async with httpx.AsyncClient(timeout=30.0) as client:
+                    first, done, chat_id = await _http_turn(client, url, user_id, chat_id, f"message {turn}")
+            if turn:
+                samples["first_token"].append(first)
+                samples["done"].append(done)
+    finally:
+        if shared is not None:
+            await shared.aclose()
+
+
+async def _socket_conversation(url: str, user_id: int, turns: int, samples: dict) -> None:
+    async with websockets.connect(f"{url.replace('http', 'ws', 1)}/api/v1/chat/ws?user_id={user_id}") as ws:
+        await ws.recv()  # ready
+        for turn in range(turns + 1):
+            started = time.perf_counter()
+            first = None
+            await ws.send(json.dumps({"type": "message", "id": turn, "message": f"message {turn}"}))
+            while True:
+                frame = json.loads(await ws.recv())
+                if frame["type"] == "delta" and first is None:
+                    first = time.perf_counter() - started
+                elif frame["type"] == "done":
+                    break
+                elif frame["type"] == "error":
+                    raise RuntimeError(frame)
+                elif frame["type"] == "ping":
+                    await ws.send(json.dumps({"type": "pong"}))
+            if turn:
+                samples["first_token"].append(first)
+                samples["done"].append(time.perf_counter() - started)
+
+
+async def _run_mode(mode: str, url: str, conversations: int, turns: int, user_offset: int) -> dict:
+    samples = {"first_token": [], "done": []}
+    if mode == "socket":
+        runs = [_socket_conversation(url, USER_ID_BASE + user_offset + i, turns, samples) for i in range(conversations)]
+    else:
+        runs = [_http_conversation(url, USER_ID_BASE + user_offset + i, turns, mode == "http_keepalive", samples)
+                for i in range(conversations)]
+    started = time.perf_counter()
+    await asyncio.gather(*runs)
+    elapsed = time.perf_counter() - started
+    return {
+        "name": mode,
+        "messages_per_s": round(conversations * (turns + 1) / elapsed, 1),
+        "first_token": latency_summary(samples["first_token"], 1000),
+        "done": latency_summary(samples["done"], 1000),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Chat latency over HTTP streaming vs. WebSocket")
+    parser.add_argument("--conversations", type=int, default=16)
+    parser.add_argument("--turns", type=int, default=20, help="Measured messages per conversation")
+    parser.add_argument("--stub-latency-ms", default="50")
+    parser.add_argument("--stub-tokens", default="32", help="Tokens in each stub reply")
+    parser.add_argument("--database-url", help="Defaults to a throwaway SQLite database")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--stub-port", type=int, default=9100)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='socket_bench_'), 'socket.db')}"
+    _create_schema(database_url)
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        OPENROUTER_API_KEY="stub-key",
+        OPENROUTER_API_URL=f"http://127.0.0.1:{args.stub_port}/api/v1/chat/completions",
+        STUB_LATENCY_MS=args.stub_latency_ms,
+        STUB_COMPLETION_TOKENS=args.stub_tokens,
+        RATE_LIMIT_ENABLED="false",
+    )
+    stub = _start("backend.bench.stub_openrouter:app", args.stub_port, env)
+    app = _start("backend.main:app", args.app_port, env)
+    results = []
+    try:
+        _wait_for(f"http://127.0.0.1:{args.stub_port}/docs")
+        _wait_for(f"http://127.0.0.1:{args.app_port}/")
+        url = f"http://127.0.0.1:{args.app_port}"
+        for offset, mode in enumerate(("http_new", "http_keepalive", "socket")):
+            result = asyncio.run(_run_mode(mode, url, args.conversations, args.turns, offset * args.conversations))
+            print(result)
+            results.append(result)
+    finally:
+        app.terminate()
+        stub.terminate()
+        app.wait()
+        stub.wait()
+
+    if args.json:
+        settings = {"conversations": args.conversations, "turns": args.turns, "stub_latency_ms": args.stub_latency_ms,
+                    "stub_tokens": args.stub_tokens, "database": database_url.split(":", 1)[0]}
+        write_results(args.json, "socket", settings, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+# Stand-in for an OpenTelemetry collector, for checking trace export without running one.
+# Run with: uvicorn backend.bench.stub_collector:app --port 4318
+# and start the app with OTEL_TRACING_ENABLED=true (OTEL_EXPORTER_OTLP_ENDPOINT defaults to
+# http://localhost:4318). Accepts OTLP/HTTP export requests and counts them; GET /stub/traces
+# reports how many batches and bytes arrived.
+from fastapi import FastAPI, Request, Response
+
+COUNTS = {"batches": 0, "bytes": 0}
+
+app = FastAPI(title="Stub OTLP collector")
+
+
+@app.post("/v1/traces")
+async def export_traces(request: Request):
+    body = await request.body()
+    COUNTS["batches"] += 1
+    COUNTS["bytes"] += len(body)
+    return Response(status_code=200, media_type=request.headers.get("content-type", "application/x-protobuf"))
+
+
+@app.get("/stub/traces")
+async def trace_counts():
+    return COUNTS
@@ -0,0 +1,112 @@
+# Minimal stand-in for the OpenRouter chat completions API, used by the load tests.
+# Run with: uvicorn backend.bench.stub_openrouter:app --port 9100
+#
+# STUB_LATENCY_MS        simulated generation time per completion (default 200)
+# STUB_COMPLETION_TOKENS number of tokens in each fake reply (default 32)
+#
+# Fault injection (fractions of requests, 0..1), also adjustable at runtime with PUT /stub/faults:
+# STUB_ERROR_RATE        answer 503
+# STUB_RATE_LIMIT_RATE   answer 429 with Retry-After: 1
+# STUB_SLOW_RATE         add STUB_SLOW_MS of extra latency (a brownout / long tail)
+# STUB_FAILING_MODELS    comma-separated model ids that always answer 503 (model router fallback)
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "200"))
+STUB_COMPLETION_TOKENS = int(os.getenv("STUB_COMPLETION_TOKENS", "32"))
+
+FAULTS = {
+    "error_rate": float(os.getenv("STUB_ERROR_RATE", "0")),
+    "rate_limit_rate": float(os.getenv("STUB_RATE_LIMIT_RATE", "0")),
+    "slow_rate": float(os.getenv("STUB_SLOW_RATE", "0")),
+    "slow_ms": float(os.getenv("STUB_SLOW_MS", "2000")),
+    "failing_models": [m for m in os.getenv("STUB_FAILING_MODELS", "").split(",") if m],
+}
+COUNTS = {"requests": 0, "errors": 0, "rate_limited": 0, "slow": 0}
+
+app = FastAPI(title="Stub OpenRouter")
+
+
+@app.put("/stub/faults")
+async def set_faults(request: Request):
+    for key, value in (await request.json()).items():
+        if key in FAULTS:
+            FAULTS[key] = list(value) if key == "failing_models" else float(value)
+    for key in COUNTS:
+        COUNTS[key] = 0
+    return FAULTS
+
+
+@app.get("/stub/faults")
+async def get_faults():
+    return {"faults": FAULTS, "counts": COUNTS}
+
+
+async def _inject_faults(model):
+    # Returns an error response to send instead of a completion, or None.
+    COUNTS["requests"] += 1
+    if model in FAULTS["failing_models"]:
+        COUNTS["errors"] += 1
+        return JSONResponse({"error": {"message": f"injected failure for {model}"}}, status_code=503)
+    if random.random() < FAULTS["error_rate"]:
+        COUNTS["errors"] += 1
+        return JSONResponse({"error": {"message": "injected upstream error"}}, status_code=503)
+    if random.random() < FAULTS["rate_limit_rate"]:
+        COUNTS["rate_limited"] += 1
+        return JSONResponse({"error": {"message": "injected rate limit"}}, status_code=429, headers={"Retry-After": "1"})
+    if random.random() < FAULTS["slow_rate"]:
+        COUNTS["slow"] += 1
+        await asyncio.sleep(FAULTS["slow_ms"] / 1000.0)
+    return None
+
+
+def _prompt_tokens(messages) -> int:
+    return sum(len(str(m.get("content", ""))) // 4 + 1 for m in messages)
+
+
+async def _stream(model, prompt_tokens: int):
+    # Spread the simulated generation time across the tokens, like a real streamed completion.
+    per_token = STUB_LATENCY_MS / 1000.0 / max(STUB_COMPLETION_TOKENS, 1)
+    for i in range(STUB_COMPLETION_TOKENS):
+        await asyncio.sleep(per_token)
+        chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": "token" if i == 0 else " token"}}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": STUB_COMPLETION_TOKENS,
+        "total_tokens": prompt_tokens + STUB_COMPLETION_TOKENS,
+    }
+    yield f"data: {json.dumps({'model': model, 'choices': [], 'usage': usage})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/api/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    prompt_tokens = _prompt_tokens(messages)
+    fault = await _inject_faults(body.get("model"))
+    if fault is not None:
+        return fault
+    if body.get("stream"):
+        return StreamingResponse(_stream(body.get("model"), prompt_tokens), media_type="text/event-stream")
+
+    await asyncio.sleep(STUB_LATENCY_MS / 1000.0)
+    reply = " ".join(["token"] * STUB_COMPLETION_TOKENS)
+    return {
+        "id": f"stub-{time.time_ns()}",
+        "object": "chat.completion",
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": STUB_COMPLETION_TOKENS,
+            "total_tokens": prompt_tokens + STUB_COMPLETION_TOKENS,
+        },
+    }
@@ -0,0 +1,119 @@
+# Throughput of the bulk export and import in backend/transfer.py, in messages per second.
+#
+# Usage (from the repository root):
+#   python -m backend.bench.transfer_bench --database-url postgresql://localhost/transfer_bench \
+#       [--messages 1000000] [--json results/transfer.json]
+#
+# Writes a synthetic export (users, chats of --per-chat messages each) to a temporary file, imports
+# it (COPY on PostgreSQL), then exports the whole database uncompressed and with each available
+# compression, discarding the output. Runs in-process against a throwaway SQLite database unless
+# --database-url is given (tables are created if missing); the target of 100k messages/sec is for
+# PostgreSQL. Each phase reports messages/sec and bytes; with --json the results are written in the
+# same format as chat_load.py, so runs can be compared across commits with compare.py.
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from backend.bench.chat_load import _create_schema, write_results
+
+CONTENT = "lorem ipsum dolor sit amet, consectetur adipiscing elit " * 4
+
+
+def write_dataset(path: str, messages: int, per_chat: int, chats_per_user: int) -> int:
+    # A synthetic export file; returns its size in bytes.
+    chats = max(1, messages // per_chat)
+    users = max(1, chats // chats_per_user)
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    first_user = time.time_ns() % 1_000_000_000  # Fresh user ids on a reused database
+    message_id = 0
+    with open(path, "w") as f:
+        for u in range(users):
+            f.write(json.dumps({"type": "user", "id": first_user + u, "username": f"bench_{first_user + u}",
+                                "created_at": start.isoformat()}) + "\n")
+        for c in range(chats):
+            created = start + timedelta(minutes=c)
+            f.write(json.dumps({"type": "chat", "id": c + 1, "user_id": first_user + c % users,
+                                "title": f"chat {c}", "created_at": created.isoformat()}) + "\n")
+            for m in range(per_chat if c < chats - 1 else messages - per_chat * (chats - 1)):
+                message_id += 1
+                ai = m % 2 == 1
+                f.write(json.dumps({
+                    "type": "message", "id": message_id, "chat_id": c + 1, "sender_type": "ai" if ai else "user",
+                    "content": f"{m} {CONTENT}", "created_at": (created + timedelta(seconds=m)).isoformat(),
+                    "token_usage": 120 if ai else None, "model": "gryphe/mythomax-l2-13b" if ai else None,
+                }) + "\n")
+    return os.path.getsize(path)
+
+
+def _result(name: str, messages: int, seconds: float, size: int) -> dict:
+    result = {"name": name, "messages": messages, "seconds": round(seconds, 3), "bytes": size,
+              "ops_per_s": round(messages / seconds, 1)}
+    print(f"{name:15s} {messages:>10} messages in {seconds:7.2f}s = {result['ops_per_s']:>12,.0f} messages/s "
+          f"({size / seconds / 1e6:.1f} MB/s)")
+    return result
+
+
+async def _benchmarks(args, dataset: str, size: int) -> list:
+    from sqlalchemy import func, select
+
+    from backend import models, transfer
+    from backend.database import async_engine
+
+    results = []
+    started = time.perf_counter()
+    counts = await transfer.import_stream(transfer._read_file(dataset))
+    results.append(_result("import", counts["messages"], time.perf_counter() - started, size))
+
+    async with async_engine.connect() as conn:
+        total = (await conn.execute(select(func.count()).select_from(models.Message))).scalar()
+    for compression in (None, "gzip", "zstd"):
+        try:
+            transfer.compressor(compression)
+        except RuntimeError as e:
+            print(f"skip export_{compression}: {e}")
+            continue
+        written = 0
+        started = time.perf_counter()
+        async for chunk in transfer.export_stream(compression=compression):
+            written += len(chunk)
+        results.append(_result(f"export_{compression or 'plain'}", total, time.perf_counter() - started, written))
+    await async_engine.dispose()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bulk export/import throughput")
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--per-chat", type=int, default=40, help="Messages per chat")
+    parser.add_argument("--chats-per-user", type=int, default=20)
+    parser.add_argument("--database-url", help="Defaults to a throwaway SQLite database")
+    parser.add_argument("--target", type=float, default=100000, help="Messages/sec every phase should reach")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="transfer_")
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'transfer.db')}"
+    _create_schema(database_url)
+    dataset = os.path.join(workdir, "dataset.ndjson")
+    size = write_dataset(dataset, args.messages, args.per_chat, args.chats_per_user)
+    print(f"Dataset: {args.messages} messages, {size / 1e6:.1f} MB")
+    try:
+        results = asyncio.run(_benchmarks(args, dataset, size))
+    finally:
+        os.remove(dataset)
+
+    slow = [r["name"] for r in results if r["ops_per_s"] < args.target]
+    print(f"Below {args.target:,.0f} messages/s: {', '.join(slow)}" if slow else
+          f"Every phase reached {args.target:,.0f} messages/s.")
+    if args.json:
+        settings = {"messages": args.messages, "per_chat": args.per_chat, "chats_per_user": args.chats_per_user,
+                    "database": database_url.split(":", 1)[0]}
+        write_results(args.json, "transfer", settings, results)
+
+
+if __name__ == "__main__":
+    main()
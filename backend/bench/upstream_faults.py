@@ -0,0 +1,157 @@
+# Fault-injection check for the resilient upstream layer (backend/upstream.py).
+#
+# Usage (from the repository root):
+#   python -m backend.bench.upstream_faults --requests 200 --concurrency 20
+#
+# Starts the stub OpenRouter server and drives upstream.post_json directly (no app, no database)
+# through a set of scenarios, printing success rate, latency percentiles and attempt counts:
+#   errors     30% injected 503s, without and with retries
+#   slow tail  5% of calls take 2s longer, without and with hedging
+#   outage     every call fails; the circuit breaker should open and fail fast
+#   recovery   the stub is healthy again; after the cooldown a half-open probe closes the breaker
+#   deadline   every call is slow; a short request deadline bounds the latency
+# Each scenario asserts what it is there to show (e.g. retries lift the success rate, the breaker
+# opens and then closes again, no call outlives its deadline by much); the run exits with status 1
+# if any assertion fails.
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+
+from backend import upstream
+from backend.bench.chat_load import _start, _wait_for
+
+
+def _reset(keep_breakers: bool = False, **settings) -> None:
+    # Fresh breaker / latency history / counters, and per-scenario tuning of the module settings.
+    # keep_breakers: carry the breakers (and their state) over from the previous scenario.
+    for name, value in settings.items():
+        setattr(upstream, name, value)
+    if not keep_breakers:
+        upstream.breakers.clear()  # Re-created with the settings above
+    upstream.latencies = upstream.LatencyTracker()
+    for key in upstream.counters:
+        upstream.counters[key] = 0
+
+
+async def _drive(url: str, total: int, concurrency: int, hedge: bool, deadline_s: float) -> dict:
+    outcomes = {}
+    latencies = []
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            body = {"model": "stub", "messages": [{"role": "user", "content": f"hello {i}"}]}
+            started = time.monotonic()
+            try:
+                response = await upstream.post_json(url, {}, body, time.monotonic() + deadline_s, hedge=hedge)
+                outcome = str(response.status_code)
+            except upstream.CircuitOpenError:
+                outcome = "circuit_open"
+            except httpx.HTTPError as e:
+                outcome = type(e).__name__
+            latencies.append(time.monotonic() - started)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    await upstream.close_client()
+    latencies.sort()
+    return {
+        "ok": round(outcomes.get("200", 0) / total, 3),
+        "outcomes": outcomes,
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p99_ms": round(latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000, 1),
+        "attempts": upstream.counters["attempts"],
+        "retries": upstream.counters["retries"],
+        "hedges": upstream.counters["hedges"],
+        "hedge_wins": upstream.counters["hedge_wins"],
+        "breaker_opened": sum(breaker.times_opened for breaker in upstream.breakers.values()),
+        "breaker_states": sorted({breaker.state for breaker in upstream.breakers.values()}),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fault-injection check for the resilient upstream layer")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--stub-latency-ms", default="100")
+    parser.add_argument("--stub-port", type=int, default=9100)
+    args = parser.parse_args()
+
+    env = dict(os.environ, STUB_LATENCY_MS=args.stub_latency_ms)
+    stub = _start("backend.bench.stub_openrouter:app", args.stub_port, env)
+    base = f"http://127.0.0.1:{args.stub_port}"
+    url = f"{base}/api/v1/chat/completions"
+    no_faults = {"error_rate": 0, "rate_limit_rate": 0, "slow_rate": 0}
+    total, cooldown, slow_ms, deadline_s = args.requests, 1.0, 2000, 0.5
+    # The error scenarios keep the breaker out of the way: a 30% error rate can cross its 50%
+    # threshold over the first 20 calls by chance.
+    no_breaker = {"UPSTREAM_BREAKER_MIN_CALLS": 10 * total}
+    # (label, stub faults, upstream settings, hedge, request deadline in seconds, keep breakers,
+    #  seconds to wait first, [(expectation, check on the result)])
+    scenarios = [
+        ("errors 30%, no retries", {"error_rate": 0.3}, {"UPSTREAM_MAX_RETRIES": 0, **no_breaker}, False, 30, False, 0,
+         [("no retries", lambda r: r["retries"] == 0),
+          ("about 70% succeed", lambda r: 0.5 <= r["ok"] <= 0.9)]),
+        ("errors 30%, 2 retries", {"error_rate": 0.3}, {"UPSTREAM_MAX_RETRIES": 2, **no_breaker}, False, 30, False, 0,
+         [("retried", lambda r: r["retries"] > 0),
+          ("at least 93% succeed (1 - 0.3^3 = 97%)", lambda r: r["ok"] >= 0.93)]),
+        ("slow tail 5%, no hedging", {"slow_rate": 0.05, "slow_ms": slow_ms}, {}, False, 30, False, 0,
+         [("no hedges", lambda r: r["hedges"] == 0),
+          ("all succeed", lambda r: r["ok"] == 1)]),
+        ("slow tail 5%, hedging", {"slow_rate": 0.05, "slow_ms": slow_ms},
+         {"UPSTREAM_HEDGE_MIN_DELAY": 0.15}, True, 30, False, 0,
+         [("hedged and some hedges won", lambda r: r["hedges"] > 0 and r["hedge_wins"] > 0),
+          ("all succeed", lambda r: r["ok"] == 1),
+          (f"p99 below the {slow_ms} ms slow tail", lambda r: r["p99_ms"] < slow_ms)]),
+        ("outage 100%, breaker", {"error_rate": 1.0},
+         {"UPSTREAM_MAX_RETRIES": 2, "UPSTREAM_BREAKER_MIN_CALLS": 20, "UPSTREAM_BREAKER_COOLDOWN": cooldown},
+         False, 30, False, 0,
+         [("breaker opened", lambda r: r["breaker_opened"] >= 1 and "open" in r["breaker_states"]),
+          ("calls failed fast", lambda r: r["outcomes"].get("circuit_open", 0) > 0),
+          ("fewer attempts than calls", lambda r: r["attempts"] < total)]),
+        # Calls made while the single probe is in flight still fail fast
+        ("recovery, half-open probe", {}, {"UPSTREAM_MAX_RETRIES": 0}, False, 30, True, cooldown,
+         [("one probe, which succeeded", lambda r: r["attempts"] == 1 and r["outcomes"].get("200") == 1),
+          ("breaker closed again", lambda r: r["breaker_states"] == ["closed"])]),
+        ("after recovery", {}, {"UPSTREAM_MAX_RETRIES": 0}, False, 30, True, 0,
+         [("all succeed", lambda r: r["ok"] == 1)]),
+        (f"all slow, {deadline_s * 1000:.0f}ms deadline", {"slow_rate": 1.0, "slow_ms": slow_ms}, no_breaker, False,
+         deadline_s, False, 0,
+         [("none succeed", lambda r: r["ok"] == 0),
+          ("p99 within 250 ms of the deadline", lambda r: r["p99_ms"] <= deadline_s * 1000 + 250)]),
+    ]
+    defaults = {name: getattr(upstream, name) for name in (
+        "UPSTREAM_MAX_RETRIES", "UPSTREAM_HEDGE_MIN_DELAY", "UPSTREAM_BREAKER_MIN_CALLS", "UPSTREAM_BREAKER_COOLDOWN")}
+    failures = []
+    try:
+        _wait_for(f"{base}/docs")
+        for label, faults, settings, hedge, deadline, keep_breakers, wait_s, checks in scenarios:
+            httpx.put(f"{base}/stub/faults", json={**no_faults, **faults})
+            _reset(keep_breakers, **{**defaults, **settings})
+            time.sleep(wait_s)
+            result = asyncio.run(_drive(url, total, args.concurrency, hedge, deadline))
+            print(f"{label:28s} {result}")
+            failures += [f"{label}: expected {expectation}" for expectation, check in checks if not check(result)]
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"Checks passed: {sum(len(scenario[-1]) for scenario in scenarios)} expectations in {len(scenarios)} scenarios.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# Persistent WebSocket channel for one chat session (WS /api/v1/chat/ws, see main.py).
+#
+# The user and chat are resolved once when the socket opens, and the chat's context window stays
+# pinned to the connection, so a message costs the rate-limit check, storing the user message and
+# the upstream call; no lookups or history reads. Replies are pushed over the same socket.
+#
+# Frames are JSON text. Client -> server:
+#   {"type": "message", "id": ..., "message": ..., [model, temperature, top_p, max_tokens, deadline_ms]}
+#   {"type": "cancel", "id": ...}    stop generating that reply
+#   {"type": "ping"} / {"type": "pong"}
+# Server -> client:
+#   {"type": "ready", "user_id": ..., "chat_id": ...}    chat_id is null until a new chat's first message
+#   {"type": "delta", "id": ..., "content": ...}
+#   {"type": "done", "id": ..., "chat_id": ..., "user_message_id": ..., "ai_message_id": ..., "model": ...}
+#   {"type": "error", "id": ..., "status_code": ..., "detail": ...}    id is null for connection errors
+#   {"type": "ping"} every WS_HEARTBEAT_INTERVAL, {"type": "pong"}
+#
+# Several messages can be in flight at once (up to WS_MAX_IN_FLIGHT); their frames interleave and
+# carry the client's id. Outgoing frames go through a bounded queue drained by one writer: when the
+# client reads slower than replies arrive, the queue fills and the reply tasks wait, which stops
+# them reading the upstream streams. A connection that sends nothing (not even a pong) for
+# WS_IDLE_TIMEOUT is closed.
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+# --- WebSocket Chat Configuration ---
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))  # Seconds between server pings
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))  # Seconds without any client frame
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "4"))  # Concurrent messages per connection
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))  # Outgoing frames buffered per connection
+
+CLOSE_IDLE = 4408  # Application close codes: 4000 + the HTTP status of the equivalent error
+
+
+class ChatSocket:
+    def __init__(self, websocket: WebSocket, user_id: int, chat_id: Optional[int], context: List[dict],
+                 max_in_flight: int = WS_MAX_IN_FLIGHT, send_queue_size: int = WS_SEND_QUEUE_SIZE,
+                 heartbeat_interval: float = WS_HEARTBEAT_INTERVAL, idle_timeout: float = WS_IDLE_TIMEOUT):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.chat_id = chat_id  # Set by the first message of a new chat
+        self.context = context  # The chat's window as of the last stored message (history.trim_window)
+        # Held while a message is stored: messages are stored in the order they arrived, and only
+        # the first message of a new chat creates it
+        self.setup_lock = asyncio.Lock()
+        self.max_in_flight = max_in_flight
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self._outbox: asyncio.Queue = asyncio.Queue(maxsize=send_queue_size)
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+    async def send(self, frame: dict) -> None:
+        # Waits while the client is behind by a full queue
+        if self._outbox.full():
+            socket_stats.send_waits += 1
+        await self._outbox.put(frame)
+
+    async def send_error(self, frame_id, status_code: int, detail: str) -> None:
+        await self.send({"type": "error", "id": frame_id, "status_code": status_code, "detail": detail})
+
+    async def serve(self, handle: Callable[["ChatSocket", object, dict], Awaitable[None]]) -> None:
+        # Reads frames until the client disconnects or goes silent. handle(socket, id, frame) runs
+        # one message as its own task and sends its frames through self.send.
+        socket_stats.open += 1
+        socket_stats.opened += 1
+        writer = asyncio.create_task(self._write())
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            await self._read(handle)
+        finally:
+            socket_stats.open -= 1
+            tasks = [writer, heartbeat, *self._in_flight.values()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _read(self, handle) -> None:
+        while True:
+            try:
+                raw = await asyncio.wait_for(self.websocket.receive_text(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                socket_stats.idle_closes += 1
+                await self._close(CLOSE_IDLE, "No frames received within the idle timeout.")
+                return
+            except (WebSocketDisconnect, RuntimeError):
+                return  # RuntimeError: the writer's send failed and closed the socket first
+            try:
+                frame = json.loads(raw)
+                kind = frame.get("type")
+            except (ValueError, AttributeError):
+                await self.send_error(None, 400, "Frames must be JSON objects.")
+                continue
+            frame_id = frame.get("id")
+            if kind == "message":
+                await self._start(handle, frame_id, frame)
+            elif kind == "cancel":
+                task = self._in_flight.get(json.dumps(frame_id))
+                if task is not None:
+                    task.cancel()
+            elif kind == "ping":
+                await self.send({"type": "pong"})
+            elif kind != "pong":
+                await self.send_error(frame_id, 400, f"Unknown frame type: {kind!r}.")
+
+    async def _start(self, handle, frame_id, frame: dict) -> None:
+        key = json.dumps(frame_id)  # Ids are any JSON scalar the client chose
+        if frame_id is None:
+            await self.send_error(None, 400, "A message frame needs an id.")
+        elif key in self._in_flight:
+            await self.send_error(frame_id, 409, "A message with this id is already in flight.")
+        elif len(self._in_flight) >= self.max_in_flight:
+            socket_stats.rejected += 1
+            await self.send_error(frame_id, 429, f"At most {self.max_in_flight} messages can be in flight.")
+        else:
+            socket_stats.messages += 1
+            task = asyncio.create_task(self._run(handle, frame_id, frame))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+    async def _run(self, handle, frame_id, frame: dict) -> None:
+        try:
+            await handle(self, frame_id, frame)
+        except asyncio.CancelledError:
+            # Cancelled by the client, or by the connection closing (then nobody reads this)
+            if not self._outbox.full():
+                self._outbox.put_nowait({"type": "error", "id": frame_id, "status_code": 499, "detail": "Cancelled."})
+            raise
+
+    async def _write(self) -> None:
+        while True:
+            frame = await self._outbox.get()
+            try:
+                await self.websocket.send_text(json.dumps(frame))
+            except Exception:
+                return  # Disconnected: the reader sees it too and tears the connection down
+
+    async def _heartbeat(self) -> None:
+        # A ping is skipped when the queue is full: the client is being sent frames anyway
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if not self._outbox.full():
+                self._outbox.put_nowait({"type": "ping", "time": time.time()})
+
+    async def _close(self, code: int, reason: str) -> None:
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except RuntimeError:
+            pass  # Already closed
+
+
+class SocketStats:
+    def __init__(self):
+        self.open = 0
+        self.opened = 0
+        self.messages = 0
+        self.rejected = 0  # Messages refused by the in-flight limit
+        self.send_waits = 0  # Frames that waited for the client to catch up
+        self.idle_closes = 0
+
+    def stats(self) -> dict:
+        return dict(vars(self))
+
+
+socket_stats = SocketStats()
@@ -0,0 +1,251 @@
+# Conversation compaction: the older part of a long chat is folded into a rolling summary
+# (models.ChatSummary), and history.py sends that summary plus the messages after it instead of
+# the full log.
+#
+# After each turn, a chat whose unsummarized window has grown past COMPACTION_TRIGGER_TOKENS or
+# COMPACTION_TRIGGER_MESSAGES is queued for a background worker, off the request path. The worker
+# asks the model to merge the current summary with the messages since it, keeping the newest
+# COMPACTION_KEEP_TOKENS / COMPACTION_KEEP_MESSAGES verbatim, and moves the summary's boundary
+# forward; each summary call reads at most COMPACTION_MAX_INPUT_TOKENS of history, so compaction
+# is incremental and its cost bounded. A larger backlog (a chat from before compaction was enabled)
+# is folded in successive passes, oldest first, and the boundary only ever moves past messages
+# that were summarized. The tokens of a summary call are recorded as usage of the chat's owner;
+# the prompt tokens saved by later requests, and their upstream latency, are recorded on their
+# usage rows.
+import asyncio
+import os
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from . import history, models
+from .database import AsyncSessionLocal, dialect_insert
+from .rate_limit import usage_quota
+from .tokens import count_tokens
+from .usage_rollup import record_usage
+
+# --- Compaction Configuration ---
+COMPACTION_ENABLED = os.getenv("COMPACTION_ENABLED", "false").lower() in ("1", "true", "yes")
+# Triggers; keep them below HISTORY_TOKEN_BUDGET / HISTORY_MAX_MESSAGES, or the window is trimmed first
+COMPACTION_TRIGGER_TOKENS = int(os.getenv("COMPACTION_TRIGGER_TOKENS", "3000"))
+COMPACTION_TRIGGER_MESSAGES = int(os.getenv("COMPACTION_TRIGGER_MESSAGES", "40"))
+COMPACTION_KEEP_TOKENS = int(os.getenv("COMPACTION_KEEP_TOKENS", "1000"))  # Newest history left verbatim
+COMPACTION_KEEP_MESSAGES = int(os.getenv("COMPACTION_KEEP_MESSAGES", "8"))
+COMPACTION_MAX_INPUT_TOKENS = int(os.getenv("COMPACTION_MAX_INPUT_TOKENS", "8000"))  # History per summary call
+COMPACTION_SUMMARY_WORDS = int(os.getenv("COMPACTION_SUMMARY_WORDS", "250"))
+COMPACTION_MAX_TOKENS = int(os.getenv("COMPACTION_MAX_TOKENS", "600"))  # max_tokens of the summary call
+COMPACTION_MODEL = os.getenv("COMPACTION_MODEL", "")  # Empty: routed like a chat request without "model"
+COMPACTION_MAX_QUEUE = int(os.getenv("COMPACTION_MAX_QUEUE", "1000"))
+COMPACTION_CONCURRENCY = int(os.getenv("COMPACTION_CONCURRENCY", "2"))
+
+INSTRUCTIONS = (
+    "You maintain the running summary of a conversation between a user and an AI assistant. "
+    "Merge the current summary (if any) with the new messages into one updated summary. Keep facts, "
+    "names, numbers, decisions, the user's preferences and open questions; drop greetings and small "
+    "talk. Write at most {words} words of plain prose, without preamble."
+)
+SPEAKERS = {"user": "User", "ai": "Assistant"}
+
+
+def needs_compaction(context: List[dict]) -> bool:
+    # `context` is the window a request sent upstream (history.trim_window output)
+    recent = context[1:] if context and context[0].get("summary") else context
+    return len(recent) >= COMPACTION_TRIGGER_MESSAGES or sum(m["tokens"] for m in recent) >= COMPACTION_TRIGGER_TOKENS
+
+
+def summary_prompt(previous: Optional[str], rows: list) -> List[dict]:
+    transcript = "\n".join(f"{SPEAKERS.get(row.sender_type, row.sender_type)}: {row.content}" for row in rows)
+    current = f"Current summary:\n{previous}\n\n" if previous else ""
+    return [
+        {"role": "system", "content": INSTRUCTIONS.format(words=COMPACTION_SUMMARY_WORDS)},
+        {"role": "user", "content": f"{current}New messages:\n{transcript}"},
+    ]
+
+
+def verbatim_count(rows: list) -> int:
+    # rows: unsummarized messages, newest first. How many of the newest stay verbatim (KEEP_*),
+    # always at least one.
+    kept = kept_tokens = 0
+    for row in rows:
+        tokens = history.row_tokens(row)
+        if kept and (kept >= COMPACTION_KEEP_MESSAGES or kept_tokens + tokens > COMPACTION_KEEP_TOKENS):
+            break
+        kept += 1
+        kept_tokens += tokens
+    return kept
+
+
+class Compactor:
+    def __init__(self, enabled: bool = COMPACTION_ENABLED, max_queue: int = COMPACTION_MAX_QUEUE,
+                 concurrency: int = COMPACTION_CONCURRENCY):
+        self.enabled = enabled
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending = set()  # chat ids queued or being compacted
+        self._summarize: Optional[Callable[[List[dict]], Awaitable[dict]]] = None
+        self.scheduled = 0
+        self.dropped = 0
+        self.compactions = 0
+        self.skipped = 0
+        self.failures = 0
+        self.messages_summarized = 0
+        self.tokens_spent = 0
+
+    def schedule(self, chat_id: int, context: List[dict]) -> bool:
+        # Never blocks the request: a chat already queued is not queued twice, and a full queue
+        # drops the trigger (the chat's next turn triggers again).
+        if self._queue is None or chat_id in self._pending or not needs_compaction(context):
+            return False
+        try:
+            self._queue.put_nowait(chat_id)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self._pending.add(chat_id)
+        self.scheduled += 1
+        return True
+
+    async def start(self, summarize: Callable[[List[dict]], Awaitable[dict]]) -> None:
+        # summarize(messages) -> {"text", "tokens", "model"}: one upstream completion (main.py)
+        if not self.enabled or self._tasks:
+            return
+        self._summarize = summarize
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        # Queued compactions are dropped rather than drained: nothing is lost, the chats are
+        # queued again by their next turn.
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._pending.clear()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "scheduled": self.scheduled,
+            "dropped": self.dropped,
+            "compactions": self.compactions,
+            "skipped": self.skipped,
+            "failures": self.failures,
+            "messages_summarized": self.messages_summarized,
+            "tokens_spent": self.tokens_spent,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            chat_id = await self._queue.get()
+            try:
+                await self.compact(chat_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                print(f"Compaction: failed to summarize chat {chat_id}: {e}")
+            finally:
+                self._pending.discard(chat_id)
+
+    async def compact(self, chat_id: int) -> bool:
+        # Returns whether the chat's summary was advanced. Runs passes until everything older than
+        # the verbatim messages is folded in.
+        advanced = False
+        while True:
+            folded, more = await self._fold(chat_id)
+            advanced = advanced or folded
+            if not (folded and more):
+                return advanced
+
+    async def _fold(self, chat_id: int) -> Tuple[bool, bool]:
+        # One summary call: folds the oldest unsummarized messages, up to MAX_INPUT_TOKENS, into the
+        # summary. Returns (whether the summary was advanced, whether older messages are left).
+        async with AsyncSessionLocal() as db:
+            summary = await history.load_summary(db, chat_id)
+            after = summary.covers_message_id if summary else None
+            # Newest-first pages until the verbatim messages are known
+            recent, cursor = [], None
+            while True:
+                page = (await db.execute(
+                    history.history_page_query(chat_id, history.HISTORY_PAGE_SIZE, cursor, after)
+                )).all()
+                recent.extend(page)
+                kept = verbatim_count(recent)
+                if kept < len(recent) or len(page) < history.HISTORY_PAGE_SIZE:
+                    break
+                cursor = page[-1].id
+            if kept >= len(recent):
+                self.skipped += 1
+                return False, False
+            # Then oldest-first pages from the boundary up to the verbatim messages, as far as one call takes
+            fold, tokens, more, start = [], 0, False, after
+            while not more:
+                page = (await db.execute(history.history_page_query(
+                    chat_id, history.HISTORY_PAGE_SIZE, recent[kept - 1].id, start, oldest_first=True
+                ))).all()
+                for row in page:
+                    row_tokens = history.row_tokens(row)
+                    if fold and tokens + row_tokens > COMPACTION_MAX_INPUT_TOKENS:
+                        more = True
+                        break
+                    fold.append(row)
+                    tokens += row_tokens
+                if len(page) < history.HISTORY_PAGE_SIZE:
+                    break
+                start = page[-1].id
+
+        # The upstream call runs without a database connection checked out.
+        result = await self._summarize(summary_prompt(summary.content if summary else None, fold))
+        text = (result.get("text") or "").strip()
+        if not text:
+            raise ValueError("the model returned an empty summary")
+
+        table = models.ChatSummary.__table__
+        values = {
+            "chat_id": chat_id,
+            "content": text,
+            "covers_message_id": fold[-1].id,
+            "covered_tokens": (summary.covered_tokens if summary else 0)
+                              + sum(history.row_tokens(row) for row in fold),
+            "summary_tokens": count_tokens(text),
+            "updated_at": datetime.now(timezone.utc),
+        }
+        statement = dialect_insert(table).values(**values)
+        if summary is None:
+            statement = statement.on_conflict_do_nothing()
+        else:
+            # Only if nobody (another worker) advanced the summary in the meantime
+            statement = statement.on_conflict_do_update(
+                index_elements=["chat_id"],
+                set_={column: statement.excluded[column] for column in values if column != "chat_id"},
+                where=table.c.covers_message_id == summary.covers_message_id,
+            )
+        tokens_used = result.get("tokens") or 0
+        async with AsyncSessionLocal() as db:
+            written = (await db.execute(statement)).rowcount
+            owner_id = None
+            if tokens_used:
+                # The summary call is billed to the chat's owner, like the turns it summarizes
+                owner_id = (await db.execute(select(models.Chat.user_id).where(models.Chat.id == chat_id))).scalar()
+                if owner_id is not None:
+                    await record_usage(db, owner_id, tokens_used, prompt_tokens=result.get("prompt_tokens"),
+                                       completion_tokens=result.get("completion_tokens"))
+            await db.commit()
+        if owner_id is not None:
+            usage_quota.add(owner_id, tokens_used)
+        self.tokens_spent += tokens_used
+        if not written:
+            self.skipped += 1
+            return False, False
+        history.context_cache.invalidate(chat_id)  # Other workers pick it up within CONTEXT_CACHE_TTL
+        self.compactions += 1
+        self.messages_summarized += len(fold)
+        return True, more
+
+
+compactor = Compactor()
@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# --- Completion Cache Configuration ---
+# Opt-in: identical prompts (same model, normalized messages and sampling params) are answered
+# from memory, and concurrent identical requests share a single upstream call.
+COMPLETION_CACHE_ENABLED = os.getenv("COMPLETION_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", "3600"))  # Seconds
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "10000"))
+COMPLETION_CACHE_MAX_BYTES = int(os.getenv("COMPLETION_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_content(content: str) -> str:
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", content)).strip()
+
+
+def cache_key(model: str, api_messages: List[dict], params: Dict) -> str:
+    material = {
+        "model": model,
+        "messages": [{"role": m["role"], "content": normalize_content(m["content"])} for m in api_messages],
+        "params": {k: v for k, v in sorted(params.items()) if v is not None},
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+class CompletionCache:
+    def __init__(self, enabled: bool = COMPLETION_CACHE_ENABLED, ttl: float = COMPLETION_CACHE_TTL,
+                 max_entries: int = COMPLETION_CACHE_MAX_ENTRIES, max_bytes: int = COMPLETION_CACHE_MAX_BYTES):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_tokens = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry["result"]
+
+    def put(self, key: str, result: dict) -> None:
+        if key in self._entries:
+            self._remove(key)
+        result = {"text": result["text"], "tokens": result["tokens"], "model": result.get("model")}  # Drop the raw upstream payload
+        size = len(result["text"]) + len(key) + 128
+        self._entries[key] = {"result": result, "bytes": size, "expires_at": time.monotonic() + self.ttl}
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def lookup(self, key: Optional[str]) -> Optional[dict]:
+        # Counted cache read, for callers (the streaming path) that cannot use get_or_compute.
+        if not self.enabled or key is None:
+            return None
+        cached = self.get(key)
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.saved_tokens += cached["tokens"]
+        return cached
+
+    def store(self, key: Optional[str], result: dict) -> None:
+        if self.enabled and key is not None and result.get("text"):
+            self.put(key, result)
+
+    async def get_or_compute(self, key: Optional[str], compute: Callable[[], Awaitable[dict]]) -> Tuple[dict, bool]:
+        # Returns (result, served_from_cache). `result` has "text" and "tokens"; only a fresh
+        # upstream call (served_from_cache=False) actually spent those tokens.
+        if not self.enabled or key is None:
+            return await compute(), False
+
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            self.saved_tokens += cached["tokens"]
+            return cached, True
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # Identical request already on its way upstream: wait for its answer.
+            result = await asyncio.shield(inflight)
+            self.coalesced += 1
+            self.saved_tokens += result["tokens"]
+            return result, True
+
+        self.misses += 1
+        # The upstream call runs as its own task so a disconnecting leader does not cancel
+        # it for the followers waiting on the same key.
+        task = asyncio.ensure_future(compute())
+        self._inflight[key] = task
+        task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task), False
+
+    def _finish(self, key: str, task: asyncio.Future) -> None:
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        result = task.result()
+        if result.get("text"):
+            self.put(key, result)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "saved_tokens": self.saved_tokens,
+        }
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry["bytes"]
+
+
+completion_cache = CompletionCache()
@@ -0,0 +1,13 @@
+# Settings shared by the command-line entry points.
+#
+# Each module reads its configuration from the environment when it is imported. A .env file is
+# loaded once per command, never on import: a command-line entry point (python -m backend.X, the
+# launcher, Alembic's env.py) calls load_env_file() before it imports backend.database, and the
+# app workers inherit the environment from the launcher.
+
+
+def load_env_file() -> None:
+    # Loads backend/.env (or the nearest .env above it) into the environment; variables already set win.
+    from dotenv import find_dotenv, load_dotenv
+
+    load_dotenv(find_dotenv())
@@ -1,23 +1,108 @@
+import asyncio
 import os
-from sqlalchemy import create_engine
+from contextlib import asynccontextmanager, nullcontext
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from dotenv import load_dotenv
-
-load_dotenv() # Load environment variables from .env file
 
+# Read from the environment only; a .env file is loaded by the entry points (serve.py, migrations.py)
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 if DATABASE_URL is None:
     raise ValueError("DATABASE_URL environment variable not set")
 
-engine = create_engine(DATABASE_URL)
+# --- Connection Pool Configuration ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Seconds; -1 disables recycling
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+
+def to_async_url(url: str) -> str:
+    # Map the sync driver URL used by Alembic onto its asyncio driver (asyncpg / aiosqlite)
+    if url.startswith("postgresql+psycopg2://"):
+        return "postgresql+asyncpg://" + url[len("postgresql+psycopg2://"):]
+    if url.startswith("postgresql://"):
+        return "postgresql+asyncpg://" + url[len("postgresql://"):]
+    if url.startswith("postgres://"):
+        return "postgresql+asyncpg://" + url[len("postgres://"):]
+    if url.startswith("sqlite://") and not url.startswith("sqlite+"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    return url
+
+
+def _pool_kwargs() -> dict:
+    if IS_SQLITE:
+        # SQLite has no server-side connection limit; the pool size options do not apply.
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    }
+
+
+# Synchronous engine, used by Alembic and offline scripts.
+# SQLite (used for local load tests) refuses connections shared across threads by default
+connect_args = {"check_same_thread": False} if IS_SQLITE else {}
+engine = create_engine(DATABASE_URL, connect_args=connect_args)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Async engine, used by the request path so DB I/O never blocks the event loop.
+ASYNC_DATABASE_URL = to_async_url(DATABASE_URL)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_pool_kwargs())
+# expire_on_commit=False keeps attributes readable after commit without an implicit (sync) reload
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine, class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False
+)
+
+if IS_SQLITE:
+    # WAL lets readers (history queries held open across the upstream call) coexist with
+    # writers; without it concurrent async requests fail with "database is locked".
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA busy_timeout=30000")
+        cursor.close()
+
+# SQLite allows one writer at a time. A writer that finds the database locked waits in SQLite's
+# busy handler, which sleeps with a growing back-off (up to 100 ms per try), so under concurrent
+# chats the lock goes to whichever writer wakes at the right moment and the tail grows to seconds.
+# The request path takes this lock around its write transactions instead: writers queue in
+# arrival order and the lock passes straight to the next one. (Background writers, which are few,
+# still rely on busy_timeout.)
+_sqlite_writer = asyncio.Lock() if IS_SQLITE else None
+
+
+def write_lock():
+    # async with write_lock(): ... around a transaction that writes; a no-op on PostgreSQL
+    return _sqlite_writer if _sqlite_writer is not None else nullcontext()
+
 Base = declarative_base()
 
+
+def dialect_insert(table):
+    # INSERT construct for the configured backend, with on_conflict_do_nothing/do_update support
+    if IS_SQLITE:
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
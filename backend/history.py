@@ -0,0 +1,223 @@
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .tokens import count_tokens
+
+# --- History Window Configuration ---
+# Only the most recent part of a conversation is sent upstream: at most
+# HISTORY_MAX_MESSAGES messages and at most HISTORY_TOKEN_BUDGET tokens (counted by tokens.py).
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "50"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+
+# --- Context Cache Configuration ---
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "10000"))
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "600"))  # Seconds
+CONTEXT_CACHE_MAX_BYTES = int(os.getenv("CONTEXT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Stored sender_type -> chat completions role
+ROLE_BY_SENDER = {"user": "user", "ai": "assistant"}
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+_MESSAGE_OVERHEAD_BYTES = 64  # Rough per-entry cost of the dict/list bookkeeping
+
+
+def row_tokens(row) -> int:
+    # The stored count of a message row; rows from before the column existed are counted now.
+    return row.token_count if row.token_count is not None else count_tokens(row.content)
+
+
+def context_message(sender_type: str, content: str, tokens: Optional[int] = None) -> dict:
+    # `tokens`: the message's stored count, when the caller has it
+    if tokens is None:
+        tokens = count_tokens(content)
+    return {"role": ROLE_BY_SENDER.get(sender_type, sender_type), "content": content, "tokens": tokens}
+
+
+def summary_message(content: str, covered_tokens: int) -> dict:
+    # A chat's stored summary (see compaction.py), sent as a system message ahead of the window.
+    # tokens_saved: the messages it stands for, less the summary itself.
+    text = SUMMARY_PREFIX + content
+    tokens = count_tokens(text)
+    return {"role": "system", "content": text, "tokens": tokens, "summary": True,
+            "tokens_saved": max(0, covered_tokens - tokens)}
+
+
+def tokens_saved(messages: List[dict]) -> int:
+    return messages[0]["tokens_saved"] if messages and messages[0].get("summary") else 0
+
+
+def trim_window(messages: List[dict], max_messages: int = HISTORY_MAX_MESSAGES,
+                token_budget: int = HISTORY_TOKEN_BUDGET) -> List[dict]:
+    # Keep the newest messages that fit; the latest message is always kept. A leading summary
+    # is always kept as well and counts against the token budget (not the message count).
+    pinned = messages[:1] if messages and messages[0].get("summary") else []
+    kept = []
+    tokens = sum(m["tokens"] for m in pinned)
+    for message in reversed(messages[len(pinned):]):
+        if kept and (len(kept) >= max_messages or tokens + message["tokens"] > token_budget):
+            break
+        kept.append(message)
+        tokens += message["tokens"]
+    kept.reverse()
+    return pinned + kept
+
+
+def to_api_messages(messages: List[dict]) -> List[dict]:
+    return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+
+class ContextCache:
+    # LRU + TTL cache of the assembled context window per chat_id, bounded by entry count and bytes.
+    # Each worker process has its own cache; the TTL bounds how long a worker can miss turns
+    # written through another worker.
+    def __init__(self, max_entries: int = CONTEXT_CACHE_MAX_ENTRIES, ttl: float = CONTEXT_CACHE_TTL,
+                 max_bytes: int = CONTEXT_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, dict]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, chat_id: int) -> Optional[List[dict]]:
+        entry = self._entries.get(chat_id)
+        if entry is None or entry["expires_at"] < time.monotonic():
+            if entry is not None:
+                self._remove(chat_id)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(chat_id)
+        self.hits += 1
+        return list(entry["messages"])
+
+    def put(self, chat_id: int, messages: List[dict]) -> None:
+        if chat_id in self._entries:
+            self._remove(chat_id)
+        size = sum(len(m["content"]) + _MESSAGE_OVERHEAD_BYTES for m in messages)
+        self._entries[chat_id] = {"messages": messages, "bytes": size, "expires_at": time.monotonic() + self.ttl}
+        self._bytes += size
+        self._evict()
+
+    def append(self, chat_id: int, *new_messages: dict) -> None:
+        # Extend a cached window after a committed turn. Chats that are not cached are
+        # left alone; their next request reloads from the database.
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return
+        self.put(chat_id, trim_window(entry["messages"] + list(new_messages)))
+
+    def remember(self, chat_id: int, *new_messages: dict, new_chat: bool = False) -> None:
+        # Record committed messages. A chat created by this request starts a fresh entry.
+        if new_chat:
+            self.put(chat_id, trim_window(list(new_messages)))
+        else:
+            self.append(chat_id, *new_messages)
+
+    def invalidate(self, chat_id: int) -> None:
+        if chat_id in self._entries:
+            self._remove(chat_id)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, chat_id: int) -> None:
+        entry = self._entries.pop(chat_id)
+        self._bytes -= entry["bytes"]
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+
+context_cache = ContextCache()
+
+
+def history_page_query(chat_id: int, page_size: int, cursor: Optional[int] = None, after: Optional[int] = None,
+                       oldest_first: bool = False):
+    # One newest-first page of a chat, served by ix_messages_chat_id_created_at. With `after`,
+    # only messages newer than that one (the end of the chat's summary) are returned.
+    # oldest_first: the oldest messages after `after` (and older than `cursor`) instead.
+    query = select(models.Message.id, models.Message.created_at, models.Message.sender_type, models.Message.content,
+                   models.Message.token_count) \
+        .where(models.Message.chat_id == chat_id)
+    if after is not None:
+        after_created_at = select(models.Message.created_at).where(models.Message.id == after).scalar_subquery()
+        query = query.where(tuple_(models.Message.created_at, models.Message.id) > tuple_(after_created_at, after))
+    if cursor is not None:
+        # The cursor's created_at is read back inside the database rather than bound from Python,
+        # so the comparison sees the stored value exactly (SQLite keeps timestamps as text).
+        # A row-value comparison lets PostgreSQL walk ix_messages_chat_id_created_at backwards with no sort.
+        created_at = select(models.Message.created_at).where(models.Message.id == cursor).scalar_subquery()
+        query = query.where(tuple_(models.Message.created_at, models.Message.id) < tuple_(created_at, cursor))
+    if oldest_first:
+        return query.order_by(models.Message.created_at, models.Message.id).limit(page_size)
+    return query.order_by(models.Message.created_at.desc(), models.Message.id.desc()).limit(page_size)
+
+
+async def load_summary(db: AsyncSession, chat_id: int):
+    # The chat's summary row (content, covers_message_id, covered_tokens), or None
+    summary = models.ChatSummary
+    return (await db.execute(
+        select(summary.content, summary.covers_message_id, summary.covered_tokens).where(summary.chat_id == chat_id)
+    )).first()
+
+
+async def load_recent_messages(db: AsyncSession, chat_id: int, max_messages: int = HISTORY_MAX_MESSAGES,
+                               token_budget: int = HISTORY_TOKEN_BUDGET) -> List[dict]:
+    # Walk the chat newest-first in keyset pages on (created_at, id) and stop as soon as the
+    # window is full, so long chats cost the same as short ones; the budget is checked against
+    # the stored token counts. A compacted chat starts with its summary, followed by the messages
+    # after it.
+    summary = await load_summary(db, chat_id)
+    pinned = [summary_message(summary.content, summary.covered_tokens)] if summary else []
+    after = summary.covers_message_id if summary else None
+    window: List[dict] = []
+    tokens = sum(m["tokens"] for m in pinned)
+    cursor = None
+    while len(window) < max_messages:
+        page_size = min(HISTORY_PAGE_SIZE, max_messages - len(window))
+        query = history_page_query(chat_id, page_size, cursor, after)
+        rows = (await db.execute(query)).all()
+        budget_exhausted = False
+        for row in rows:
+            message = context_message(row.sender_type, row.content, row_tokens(row))
+            if window and tokens + message["tokens"] > token_budget:
+                budget_exhausted = True
+                break
+            window.append(message)
+            tokens += message["tokens"]
+        if budget_exhausted or len(rows) < page_size:
+            break
+        cursor = rows[-1].id
+    window.reverse()
+    return pinned + window
+
+
+async def load_context(db: AsyncSession, chat_id: Optional[int]) -> List[dict]:
+    # Prior turns of a chat (without the message being sent now). New chats have no history.
+    if chat_id is None:
+        return []
+    cached = context_cache.get(chat_id)
+    if cached is not None:
+        return cached
+    window = await load_recent_messages(db, chat_id)
+    context_cache.put(chat_id, window)
+    return list(window)
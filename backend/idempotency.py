@@ -0,0 +1,164 @@
+# Idempotency keys for chat submissions (POST /api/v1/chat and /api/v1/chat/stream).
+#
+# A client that retries a message sends the same Idempotency-Key header again. The first request
+# with a key claims it and runs the turn; its response is kept for IDEMPOTENCY_TTL and replayed to
+# any retry, so a retry stores no second message, makes no second upstream call and records no
+# second usage row. A retry that arrives while the first request is still running waits for its
+# result instead of starting new work. Keys are scoped per user and bound to the request body:
+# reusing a key for a different request is refused. When the first request fails (or its stream
+# is abandoned), the key is released and the next retry runs the turn afresh.
+#
+# Entries are "user:key" -> {"fingerprint", "response", "claim"} (response null while pending),
+# kept in the same backends as lookup_cache.py: in-process by default, or Redis to share keys
+# across workers (a retry routed to another worker then polls for the pending result). A pending
+# claim expires after IDEMPOTENCY_PENDING_TTL, so a worker that died mid-request does not hold its
+# keys; the worker running the turn refreshes it every third of that. Each claim carries a unique
+# token, and complete/release only touch the entry while it still holds their token: a claim that
+# expired and was taken over by a retry is left to the retry. The in-process backend never evicts
+# a pending entry.
+import asyncio
+import hashlib
+import json
+import os
+import uuid
+from typing import Dict, Optional, Tuple
+
+from .lookup_cache import InProcessBackend, RedisBackend
+
+# --- Idempotency Configuration ---
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "memory")  # 'memory' or 'redis'
+IDEMPOTENCY_REDIS_URL = os.getenv("IDEMPOTENCY_REDIS_URL", "redis://localhost:6379/0")
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))  # Seconds a response is replayed
+IDEMPOTENCY_PENDING_TTL = int(os.getenv("IDEMPOTENCY_PENDING_TTL", "120"))  # Refreshed every third while the turn runs
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "100000"))  # In-process backend
+IDEMPOTENCY_PREFIX = os.getenv("IDEMPOTENCY_PREFIX", "chatapi:idempotency:")
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENCY_POLL_INTERVAL = 0.1  # Seconds between checks for a result pending on another worker
+
+
+class KeyMismatch(Exception):
+    # The key was already used by a request with a different body
+    pass
+
+
+def fingerprint(body: dict) -> str:
+    return hashlib.sha256(json.dumps(body, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def build_backend():
+    if IDEMPOTENCY_BACKEND == "redis":
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("IDEMPOTENCY_BACKEND=redis requires the 'redis' package (pip install redis).")
+        return RedisBackend(redis_asyncio.from_url(IDEMPOTENCY_REDIS_URL), prefix=IDEMPOTENCY_PREFIX)
+    return InProcessBackend(max_entries=IDEMPOTENCY_MAX_ENTRIES, evictable=is_completed)
+
+
+def is_completed(raw: str) -> bool:
+    return json.loads(raw)["response"] is not None
+
+
+class IdempotencyStore:
+    def __init__(self, backend=None, ttl: int = IDEMPOTENCY_TTL, pending_ttl: int = IDEMPOTENCY_PENDING_TTL,
+                 poll_interval: float = IDEMPOTENCY_POLL_INTERVAL):
+        self.backend = backend if backend is not None else build_backend()
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.poll_interval = poll_interval
+        # Claims held by this worker: token -> (pending entry, resolved when completed or released,
+        # task refreshing the entry's TTL)
+        self._claims: Dict[str, Tuple[str, asyncio.Future, asyncio.Task]] = {}
+        self.claimed = 0
+        self.replayed = 0
+        self.waited = 0
+        self.released = 0
+        self.mismatched = 0
+
+    async def begin(self, user_id: int, key: str, body_fingerprint: str) -> Tuple[Optional[dict], Optional[str]]:
+        # Returns (the stored response of an earlier request with this key, None), waiting for it
+        # while that request is in flight, or (None, claim token) when the caller now holds the
+        # key: it must then call complete() or release() with the token. Raises KeyMismatch.
+        storage_key = f"{user_id}:{key}"
+        token = uuid.uuid4().hex
+        entry = json.dumps({"fingerprint": body_fingerprint, "response": None, "claim": token})
+        waited = False
+        while True:
+            if await self.backend.add(storage_key, entry, self.pending_ttl):
+                refresh = asyncio.create_task(self._refresh(storage_key, entry))
+                self._claims[token] = (entry, asyncio.get_running_loop().create_future(), refresh)
+                self.claimed += 1
+                return None, token
+            raw = await self.backend.get(storage_key)
+            if raw is None:
+                continue  # Released or expired in between: try to claim it again
+            stored = json.loads(raw)
+            if stored["fingerprint"] != body_fingerprint:
+                self.mismatched += 1
+                raise KeyMismatch(key)
+            if stored["response"] is not None:
+                self.replayed += 1
+                return stored["response"], None
+            if not waited:
+                waited = True
+                self.waited += 1
+            claim = self._claims.get(stored.get("claim"))
+            if claim is not None:
+                await asyncio.shield(claim[1])  # Claimed by this worker: woken when it finishes
+            else:
+                await asyncio.sleep(self.poll_interval)
+
+    async def complete(self, user_id: int, key: str, token: str, response: dict) -> None:
+        # `response`: JSON-serializable, replayed as is. Stored unless another request has claimed
+        # the key since (this claim expired); a no-op for a claim already finished with.
+        claim = self._claims.pop(token, None)
+        if claim is None:
+            return
+        entry, done, refresh = claim
+        refresh.cancel()
+        storage_key = f"{user_id}:{key}"
+        completed = json.dumps({"fingerprint": json.loads(entry)["fingerprint"], "response": response})
+        try:
+            if not await self.backend.replace(storage_key, entry, completed, self.ttl):
+                await self.backend.add(storage_key, completed, self.ttl)  # Expired, and not claimed again
+        finally:
+            done.set_result(None)
+
+    async def release(self, user_id: int, key: str, token: str) -> None:
+        # A no-op for a claim complete() has already finished with
+        claim = self._claims.pop(token, None)
+        if claim is None:
+            return
+        self.released += 1
+        entry, done, refresh = claim
+        refresh.cancel()
+        try:
+            await self.backend.delete_if(f"{user_id}:{key}", entry)
+        finally:
+            done.set_result(None)
+
+    async def _refresh(self, storage_key: str, entry: str) -> None:
+        # Keeps a pending claim from expiring while its turn runs; stops once the entry is no
+        # longer this claim's
+        while True:
+            await asyncio.sleep(self.pending_ttl / 3)
+            try:
+                if not await self.backend.replace(storage_key, entry, entry, self.pending_ttl):
+                    return
+            except Exception as e:
+                print(f"Idempotency: could not refresh a pending claim: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__,
+            "entries": self.backend.size(),
+            "in_flight": len(self._claims),
+            "claimed": self.claimed,
+            "replayed": self.replayed,
+            "waited": self.waited,
+            "released": self.released,
+            "mismatched": self.mismatched,
+        }
+
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,123 @@
+import asyncio
+import os
+from collections import Counter
+from datetime import datetime
+from typing import List, Optional
+
+from . import models
+from .database import async_engine
+
+# --- Log Sink Configuration ---
+# Log rows are queued in memory and bulk-inserted by a background task, so request
+# handlers never pay a round trip (or a commit) per log line.
+LOG_SINK_MAX_QUEUE = int(os.getenv("LOG_SINK_MAX_QUEUE", "10000"))
+LOG_SINK_BATCH_SIZE = int(os.getenv("LOG_SINK_BATCH_SIZE", "500"))
+LOG_SINK_FLUSH_INTERVAL = float(os.getenv("LOG_SINK_FLUSH_INTERVAL", "1.0"))  # Seconds
+LOG_SINK_SHUTDOWN_TIMEOUT = float(os.getenv("LOG_SINK_SHUTDOWN_TIMEOUT", "10"))
+
+
+class LogSink:
+    def __init__(self, max_queue: int = LOG_SINK_MAX_QUEUE, batch_size: int = LOG_SINK_BATCH_SIZE,
+                 flush_interval: float = LOG_SINK_FLUSH_INTERVAL):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = Counter()  # level -> rows dropped because the queue was full
+        self.failed_batches = 0
+
+    def emit(self, level: str, message: str) -> None:
+        # Never blocks: a full queue means the database cannot keep up, and we prefer
+        # losing log lines (counted in `dropped`) over stalling chat requests.
+        row = {"level": level, "message": message, "timestamp": datetime.utcnow()}
+        if self._queue is None:
+            print(f"[{level}] {message}")  # Sink not running (e.g. scripts); fall back to stdout
+            return
+        try:
+            self._queue.put_nowait(row)
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped[level] += 1
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = LOG_SINK_SHUTDOWN_TIMEOUT) -> None:
+        # Drain everything queued so far, then stop the flusher.
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        remaining = self._take_batch(self._queue.qsize())
+        self._queue = None
+        for start in range(0, len(remaining), self.batch_size):
+            try:
+                await asyncio.wait_for(self._flush(remaining[start:start + self.batch_size]), timeout)
+            except Exception as e:
+                print(f"Log sink: failed to drain {len(remaining) - start} rows on shutdown: {e}")
+                return
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": sum(self.dropped.values()),
+            "dropped_by_level": dict(self.dropped),
+            "failed_batches": self.failed_batches,
+        }
+
+    def _take_batch(self, limit: int) -> List[dict]:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            # Flush when a full batch is available or when the interval elapses, whichever comes first.
+            try:
+                first = await asyncio.wait_for(self._queue.get(), self.flush_interval)
+            except asyncio.TimeoutError:
+                continue
+            batch = [first] + self._take_batch(self.batch_size - 1)
+            if len(batch) < self.batch_size:
+                await asyncio.sleep(min(self.flush_interval, 0.05))  # Let a burst coalesce into one insert
+                batch += self._take_batch(self.batch_size - len(batch))
+            try:
+                await self._flush(batch)
+            except asyncio.CancelledError:
+                # Shutdown while flushing: hand the batch back so stop() writes it.
+                for row in batch:
+                    try:
+                        self._queue.put_nowait(row)
+                    except asyncio.QueueFull:
+                        self.dropped[row["level"]] += 1
+                raise
+            except Exception as e:
+                self.failed_batches += 1
+                print(f"Log sink: failed to write {len(batch)} log rows: {e}")
+
+    async def _flush(self, batch: List[dict]) -> None:
+        if not batch:
+            return
+        # A single multi-row INSERT (executemany) in its own short transaction.
+        async with async_engine.begin() as conn:
+            await conn.execute(models.Log.__table__.insert(), batch)
+        self.written += len(batch)
+
+
+log_sink = LogSink()
@@ -0,0 +1,211 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from itertools import islice
+from typing import Callable, Optional
+
+from sqlalchemy import event
+
+from . import history, models
+
+# --- Lookup Cache Configuration ---
+# Read-through cache for "does user N exist" and "who owns chat N". Both facts only change
+# when a user or chat is created or deleted, so every chat message does not need to re-query them.
+LOOKUP_CACHE_BACKEND = os.getenv("LOOKUP_CACHE_BACKEND", "memory")  # 'memory' or 'redis'
+LOOKUP_CACHE_REDIS_URL = os.getenv("LOOKUP_CACHE_REDIS_URL", "redis://localhost:6379/0")
+LOOKUP_CACHE_TTL = int(os.getenv("LOOKUP_CACHE_TTL", "3600"))  # Seconds
+LOOKUP_CACHE_MAX_ENTRIES = int(os.getenv("LOOKUP_CACHE_MAX_ENTRIES", "100000"))
+LOOKUP_CACHE_PREFIX = os.getenv("LOOKUP_CACHE_PREFIX", "chatapi:lookup:")
+
+
+class InProcessBackend:
+    # Size-bounded LRU with per-key expiry, private to this worker process.
+    # evictable(value): entries it returns False for are skipped by the LRU eviction (they still
+    # expire); the size bound can then be exceeded by that many entries.
+    def __init__(self, max_entries: int = LOOKUP_CACHE_MAX_ENTRIES,
+                 evictable: Optional[Callable[[str], bool]] = None):
+        self.max_entries = max_entries
+        self.evictable = evictable
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.evictions = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: int) -> None:
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) <= self.max_entries:
+            return
+        if self.evictable is None:
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return
+        excess = len(self._entries) - self.max_entries
+        oldest_evictable = (k for k, (v, _) in self._entries.items() if self.evictable(v))
+        for old_key in list(islice(oldest_evictable, excess)):
+            del self._entries[old_key]
+            self.evictions += 1
+
+    async def add(self, key: str, value: str, ttl: int) -> bool:
+        # Set only if absent (or expired); returns whether it was set
+        if await self.get(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    async def replace(self, key: str, expected: str, value: str, ttl: int) -> bool:
+        # Set only if the current value is `expected`; returns whether it was set
+        if await self.get(key) != expected:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete_if(self, key: str, expected: str) -> bool:
+        # Delete only if the current value is `expected`; returns whether it was deleted
+        if await self.get(key) != expected:
+            return False
+        await self.delete(key)
+        return True
+
+    def size(self) -> int:
+        return len(self._entries)
+
+
+# Compare-and-set / compare-and-delete in one round trip. KEYS[1]; ARGV: expected, value, ttl.
+_REPLACE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+_DELETE_IF_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+return redis.call('DEL', KEYS[1])
+"""
+
+
+class RedisBackend:
+    # Shared across workers. Accepts any client with the redis.asyncio get/set/delete API,
+    # so a local fake (e.g. fakeredis.aioredis.FakeRedis) can stand in for a real server.
+    def __init__(self, client, prefix: str = LOOKUP_CACHE_PREFIX):
+        self.client = client
+        self.prefix = prefix
+        self.evictions = 0  # Eviction is handled by Redis (maxmemory-policy)
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self.client.get(self.prefix + key)
+        if isinstance(value, bytes):
+            value = value.decode()
+        return value
+
+    async def set(self, key: str, value: str, ttl: int) -> None:
+        await self.client.set(self.prefix + key, value, ex=ttl)
+
+    async def add(self, key: str, value: str, ttl: int) -> bool:
+        return bool(await self.client.set(self.prefix + key, value, ex=ttl, nx=True))
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(self.prefix + key)
+
+    async def replace(self, key: str, expected: str, value: str, ttl: int) -> bool:
+        return bool(await self.client.eval(_REPLACE_SCRIPT, 1, self.prefix + key, expected, value, ttl))
+
+    async def delete_if(self, key: str, expected: str) -> bool:
+        return bool(await self.client.eval(_DELETE_IF_SCRIPT, 1, self.prefix + key, expected))
+
+    def size(self) -> int:
+        return -1  # Unknown without a round trip
+
+
+def build_backend():
+    if LOOKUP_CACHE_BACKEND == "redis":
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("LOOKUP_CACHE_BACKEND=redis requires the 'redis' package (pip install redis).")
+        return RedisBackend(redis_asyncio.from_url(LOOKUP_CACHE_REDIS_URL))
+    return InProcessBackend()
+
+
+class LookupCache:
+    def __init__(self, backend=None, ttl: int = LOOKUP_CACHE_TTL):
+        self.backend = backend if backend is not None else build_backend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def user_exists(self, user_id: int) -> bool:
+        found = await self.backend.get(f"user:{user_id}") is not None
+        self._count(found)
+        return found
+
+    async def remember_user(self, user_id: int) -> None:
+        await self.backend.set(f"user:{user_id}", "1", self.ttl)
+
+    async def forget_user(self, user_id: int) -> None:
+        await self.backend.delete(f"user:{user_id}")
+
+    async def chat_owner(self, chat_id: int) -> Optional[int]:
+        owner = await self.backend.get(f"chat:{chat_id}")
+        self._count(owner is not None)
+        return int(owner) if owner is not None else None
+
+    async def remember_chat(self, chat_id: int, user_id: int) -> None:
+        await self.backend.set(f"chat:{chat_id}", str(user_id), self.ttl)
+
+    async def forget_chat(self, chat_id: int) -> None:
+        await self.backend.delete(f"chat:{chat_id}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "entries": self.backend.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.backend.evictions,
+        }
+
+    def _count(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+
+lookup_cache = LookupCache()
+
+
+# --- Invalidation on delete ---
+# ORM deletes of users and chats (including cascades) drop the cached facts. Creation paths
+# call remember_user / remember_chat themselves once their transaction has committed.
+def _schedule(coro) -> None:
+    try:
+        asyncio.get_running_loop().create_task(coro)
+    except RuntimeError:
+        coro.close()  # No event loop (sync scripts): nothing is cached in this process anyway
+
+
+@event.listens_for(models.User, "after_delete")
+def _user_deleted(mapper, connection, target):
+    _schedule(lookup_cache.forget_user(target.id))
+
+
+@event.listens_for(models.Chat, "after_delete")
+def _chat_deleted(mapper, connection, target):
+    history.context_cache.invalidate(target.id)
+    _schedule(lookup_cache.forget_chat(target.id))
@@ -1,80 +1,191 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import math
 import os
-import requests
-from fastapi import FastAPI, HTTPException, Body, Depends
-from sqlalchemy.orm import Session
-from sqlalchemy import func # for server_default=func.now() in models if not already there
-from dotenv import load_dotenv
-from typing import List, Optional
+import time
+import httpx
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, WebSocket
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, tuple_
+from typing import Callable, List, Optional
 from datetime import datetime
 
-# Alembic imports for running migrations on startup
-from alembic.config import Config as AlembicConfig
-from alembic import command as alembic_command
-
-from . import models, schemas
-from .database import SessionLocal, engine, get_db, DATABASE_URL
+from . import history, idempotency, migrations, models, schemas, search, tokens, transfer, upstream
+from .log_sink import log_sink
+from .lookup_cache import lookup_cache
+from .completion_cache import cache_key, completion_cache
+from .idempotency import IDEMPOTENCY_KEY_MAX_LENGTH, idempotency_store
+from .usage_rollup import record_usage, usage_summary
+from .write_behind import write_behind
+from .compaction import COMPACTION_MAX_TOKENS, COMPACTION_MODEL, compactor, needs_compaction
+from .chat_socket import ChatSocket, socket_stats
+from .batch import BATCH_CONCURRENCY, BATCH_MAX_ITEMS, batch_stats, run_batch
+from .timing import SERVER_TIMING_ENABLED, ServerTimingMiddleware, stage
+from . import metrics
+from .rate_limit import RateLimited, rate_limiter, usage_quota
+from .model_router import AUTO, UnknownModelError, model_router
+from .database import AsyncSessionLocal, async_engine, dialect_insert, get_async_db, write_lock
 
 # Ensure models create tables if they don't exist (though Alembic handles this)
 # models.Base.metadata.create_all(bind=engine) # This is generally handled by Alembic migrations now
 
-# Load environment variables from .env file
-load_dotenv()
+# Configuration is read from the environment. A .env file is loaded once by the launcher
+# (serve.py) before the workers start; with plain uvicorn, pass --env-file.
 
 # --- Environment and API Configuration ---
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions") # Default if not set
-DEFAULT_MODEL =  os.getenv("DEFAULT_MODEL", "gryphe/mythomax-l2-13b") # Default if not set
+# DEFAULT_MODEL / ROUTER_MODELS (which models may serve a chat) are read by model_router.py
+# Admin endpoints (bulk export/import) require this value in X-Admin-Token; unset disables them.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
 
 # --- FastAPI ---
 app = FastAPI(title="Chat API with PostgreSQL", version="1.0")
+if SERVER_TIMING_ENABLED:
+    app.add_middleware(ServerTimingMiddleware) # Per-stage Server-Timing header (see timing.py)
+if metrics.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware) # Request counts and durations for GET /metrics
+
+# --- Startup Migrations (development) ---
+# In production, migrations run once per deploy before the workers start (serve.py, or
+# `python -m backend.migrations` as a separate job). MIGRATE_ON_STARTUP=true applies them when
+# the app starts instead, which is convenient for a single local process; concurrent workers
+# still take turns through the migration lock.
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "false").lower() in ("1", "true", "yes")
 
-# --- Alembic Configuration for Startup Migrations ---
-# This is for development convenience. In production, you might run migrations manually or differently.
 @app.on_event("startup")
 def run_migrations():
-    if DATABASE_URL is None: # Should have been caught by database.py but double check
-        print("DATABASE_URL is not set. Skipping migrations.")
+    if not MIGRATE_ON_STARTUP:
         return
-    
-    alembic_cfg_path = os.path.join(os.path.dirname(__file__), "..", "alembic.ini") # Assuming alembic.ini is in project root
-    # If alembic.ini is in backend/ adjust path to "alembic.ini"
-    # For this project, alembic.ini will be in backend/ so use "alembic.ini"
-    alembic_cfg_path_backend = "alembic.ini" # alembic init alembic was run in backend/
-    
-    # Check if alembic.ini exists in backend/
-    if not os.path.exists(alembic_cfg_path_backend):
-        print(f"Alembic config not found at {alembic_cfg_path_backend}. Skipping migrations.")
-        # Attempt to find it in the root, just in case structure changes
-        if os.path.exists(alembic_cfg_path):
-             alembic_cfg_path_backend = alembic_cfg_path
-             print(f"Found alembic.ini at {alembic_cfg_path_backend}")
-        else:
-            print(f"Also not found at {alembic_cfg_path}. Skipping migrations.")
-            return
-
-    print(f"Running Alembic migrations from config: {alembic_cfg_path_backend}")
-    alembic_cfg = AlembicConfig(alembic_cfg_path_backend)
-    
-    # Make sure Alembic can find your models, typically by setting script_location
-    # and ensuring env.py points to your Base.metadata
-    # If alembic commands are run from backend/, script_location might not be needed in alembic.ini
-    # or it should be relative to backend/ (e.g. script_location = alembic)
-
     try:
-        alembic_command.upgrade(alembic_cfg, "head")
-        print("Migrations applied successfully.")
+        migrations.upgrade_to_head()
     except Exception as e:
         print(f"Error applying migrations: {e}")
         # Depending on the error, you might want to prevent app startup
         # For example, if it's a sqlalchemy.exc.OperationalError, the DB might not be reachable
 
 
+# --- Upstream HTTP Client Lifecycle ---
+# (closed at the end of the shutdown sequence, below)
+@app.on_event("startup")
+async def start_upstream_client():
+    await upstream.start_client()
+
+
 # --- Helper for Logging ---
-def create_log_entry(db: Session, level: str, message: str):
-    log_entry = models.Log(level=level, message=message, timestamp=datetime.utcnow())
-    db.add(log_entry)
-    db.commit()
+# Log rows are buffered and bulk-inserted by the background log sink. This keeps log writes
+# out of the request's transaction, so they no longer commit half-finished chat rows.
+def create_log_entry(level: str, message: str):
+    log_sink.emit(level, message)
+
+
+@app.on_event("startup")
+async def start_log_sink():
+    await log_sink.start()
+
+@app.on_event("shutdown")
+async def drain_log_sink():
+    await log_sink.stop()
+
+
+# --- Write-Behind Persistence ---
+# With WRITE_BEHIND_ENABLED, chats, messages and usage are staged with pre-allocated ids and
+# written by a background batch writer after the reply is returned (see write_behind.py).
+@app.on_event("startup")
+async def start_write_behind():
+    await write_behind.start()
+
+@app.on_event("shutdown")
+async def drain_write_behind():
+    await write_behind.stop()
+
+
+async def store_usage(db: AsyncSession, user_id: int, counts: dict, prompt_tokens_saved: int = 0,
+                      upstream_ms: Optional[int] = None) -> None:
+    # counts: {"tokens", "prompt_tokens", "completion_tokens"} of the reply (see usage_counts)
+    # upstream_ms: duration of the upstream call; None for a reply served from the completion cache
+    split = {"prompt_tokens": counts["prompt_tokens"], "completion_tokens": counts["completion_tokens"],
+             "prompt_tokens_saved": prompt_tokens_saved or None,  # NULL for requests without a chat summary
+             "upstream_ms": upstream_ms}
+    if write_behind.enabled:
+        # The writer applies the usage rollups when it inserts the row
+        await write_behind.stage(db, models.Usage(user_id=user_id, tokens_used=counts["tokens"], **split))
+    else:
+        await record_usage(db, user_id, counts["tokens"], **split)
+
+
+# --- Conversation Compaction ---
+# Long chats are summarized in the background; requests then send the summary plus the recent
+# window (see compaction.py).
+@app.on_event("startup")
+async def start_compactor():
+    await compactor.start(summarize_history)
+
+@app.on_event("shutdown")
+async def stop_compactor():
+    await compactor.stop()
+
+
+async def summarize_history(messages: List[dict]) -> dict:
+    # One completion for the compactor, routed, retried and circuit-broken like a chat request
+    data = {"messages": messages, "max_tokens": COMPACTION_MAX_TOKENS}
+    candidates = model_router.candidates(COMPACTION_MODEL or None)
+    return await request_completion(data, candidates, upstream.deadline_from_header(None))
+
+
+# --- Metrics and Tracing ---
+@app.on_event("startup")
+async def start_instrumentation():
+    if metrics.METRICS_ENABLED:
+        metrics.instrument_pool(async_engine)
+    metrics.start_tracing()
+
+@app.on_event("shutdown")
+async def stop_instrumentation():
+    metrics.stop_tracing()
+
+
+# --- Shutdown ---
+# Shutdown hooks run in registration order, once in-flight requests have finished (see serve.py).
+# These are registered last so the upstream client and the database pool outlive the drains
+# above: the log sink, the write-behind queue and any running compaction still need them.
+@app.on_event("shutdown")
+async def close_upstream_client():
+    await upstream.close_client()
+
+@app.on_event("shutdown")
+async def dispose_db_engine():
+    await async_engine.dispose()
+
+
+if metrics.METRICS_ENABLED:
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics_endpoint():
+        # Prometheus text exposition format, for this worker
+        return Response(content=metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def observe_token_usage(model: Optional[str], usage: dict) -> None:
+    for kind in ("prompt", "completion", "total"):
+        if usage.get(f"{kind}_tokens") is not None:
+            metrics.upstream_tokens.observe(usage[f"{kind}_tokens"], model or "unknown", kind)
+
+
+def observe_compaction(tokens_saved: int, upstream_started: float) -> int:
+    # Feeds the compaction metrics; returns the upstream duration in milliseconds, which is also
+    # stored on the request's usage row next to prompt_tokens_saved.
+    upstream_seconds = time.perf_counter() - upstream_started
+    metrics.upstream_seconds_by_history.observe(upstream_seconds, "summary" if tokens_saved else "window")
+    if tokens_saved:
+        metrics.prompt_tokens_saved.observe(tokens_saved)
+    return round(upstream_seconds * 1000)
 
 
 # --- Root Endpoint ---
@@ -85,154 +196,1051 @@ async def root():
 # --- API Endpoints ---
 API_V1_PREFIX = "/api/v1"
 
-@app.post(f"{API_V1_PREFIX}/chat", response_model=schemas.ChatCompletionResponse)
-async def chat_endpoint(
-    request_data: schemas.ChatCompletionRequest, 
-    db: Session = Depends(get_db)
-):
-    if not OPENROUTER_API_KEY:
-        create_log_entry(db, "ERROR", "OpenRouter API key not configured.")
-        raise HTTPException(status_code=500, detail="OpenRouter API key not configured.")
+@app.get(f"{API_V1_PREFIX}/stats")
+async def stats_endpoint():
+    # In-process cache and background-writer counters for this worker
+    return {
+        "context_cache": history.context_cache.stats(),
+        "lookup_cache": lookup_cache.stats(),
+        "completion_cache": completion_cache.stats(),
+        "log_sink": log_sink.stats(),
+        "upstream": upstream.stats(),
+        "model_router": model_router.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "usage_quota": usage_quota.stats(),
+        "write_behind": write_behind.stats(),
+        "compaction": compactor.stats(),
+        "tokens": tokens.stats(),
+        "chat_socket": socket_stats.stats(),
+        "idempotency": idempotency_store.stats(),
+        "batch": batch_stats.stats(),
+    }
+
+# --- Chat Turn Helpers (shared by the plain, streaming and batch endpoints) ---
+def openrouter_headers() -> dict:
+    return {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": os.getenv("OPENROUTER_SITE_URL", "http://localhost"), # Optional, but good practice
+        "X-Title": os.getenv("OPENROUTER_APP_TITLE", "FastAPI Chat App") # Optional
+    }
+
+
+def sampling_params(request_data: schemas.ChatCompletionRequest) -> dict:
+    return {
+        "temperature": request_data.temperature,
+        "top_p": request_data.top_p,
+        "max_tokens": request_data.max_tokens,
+    }
+
+
+def completion_payload(api_messages: list, request_data: schemas.ChatCompletionRequest) -> dict:
+    # "model" is filled in per attempt by the model router
+    data = {
+        "messages": api_messages
+    }
+    data.update({k: v for k, v in sampling_params(request_data).items() if v is not None})
+    return data
+
+
+def route_candidates(request_data: schemas.ChatCompletionRequest) -> List[str]:
+    # Models that may serve this request, best first; an unknown `model` is rejected up front.
+    try:
+        return model_router.candidates(request_data.model)
+    except UnknownModelError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def completion_cache_key(api_messages: list, request_data: schemas.ChatCompletionRequest) -> Optional[str]:
+    # Scoped by the requested model (or AUTO): any model the router may pick can answer a cached prompt.
+    if not completion_cache.enabled:
+        return None
+    return cache_key(request_data.model or AUTO, api_messages, sampling_params(request_data))
+
+
+async def request_completion(data: dict, candidates: List[str], deadline: float) -> dict:
+    # One non-streaming OpenRouter completion, falling back across `candidates` (model_router) with
+    # each call retried, hedged and circuit-broken by upstream.post_json.
+    # httpx errors and upstream.CircuitOpenError propagate to the caller for mapping.
+    model, response = await model_router.post_completion(OPENROUTER_API_URL, openrouter_headers(), data, candidates, deadline)
+    response.raise_for_status()
+    response_data = response.json()
+
+    ai_message_text = None
+    usage = {}
+    if response_data.get("choices") and len(response_data["choices"]) > 0:
+        ai_message_text = response_data["choices"][0].get("message", {}).get("content")
+        if response_data.get("usage"):
+            usage = response_data["usage"]
+            observe_token_usage(model, usage)
+    return {"text": ai_message_text, **reported_usage(usage), "model": model, "raw": response_data}
+
+
+def completion_error(e: Exception, chat_id: Optional[int]) -> HTTPException:
+    # The response for a failed request_completion (upstream.CircuitOpenError or an httpx error)
+    if isinstance(e, upstream.CircuitOpenError):
+        create_log_entry("WARNING", f"OpenRouter circuit open, failing fast for chat {chat_id}.")
+        return HTTPException(status_code=503, detail="OpenRouter API is unavailable, try again later.",
+                             headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+    if isinstance(e, httpx.TimeoutException):
+        create_log_entry("ERROR", f"Timeout calling OpenRouter for chat {chat_id}.")
+        return HTTPException(status_code=504, detail="Request to OpenRouter API timed out.")
+    if isinstance(e, httpx.HTTPStatusError):
+        status_code = e.response.status_code
+        error_detail = f"Error from OpenRouter API ({e.response.status_code}): {e.response.text}"
+        create_log_entry("ERROR", f"OpenRouter API error for chat {chat_id}: {error_detail}")
+        if status_code == 401:
+            return HTTPException(status_code=401, detail="Authentication error with OpenRouter. Check API key.")
+        return HTTPException(status_code=status_code, detail=error_detail)
+    error_detail = f"Error communicating with OpenRouter API: {e}"
+    create_log_entry("ERROR", f"OpenRouter API error for chat {chat_id}: {error_detail}")
+    return HTTPException(status_code=500, detail=error_detail)
+
 
-    # 1. User Handling
-    user = db.query(models.User).filter(models.User.id == request_data.user_id).first()
-    if not user:
-        # For now, create a user if not found. In a real app, this would be part of user management.
-        user = models.User(id=request_data.user_id, username=f"user_{request_data.user_id}")
-        db.add(user)
-        # db.commit() # Commit separately or together with other changes
-        # db.refresh(user) # Refresh to get defaults like created_at
-        create_log_entry(db, "INFO", f"User with ID {request_data.user_id} not found, created new user.")
-        # Not committing here, will commit along with message and chat
+def reported_usage(usage: dict) -> dict:
+    # The token counts of an upstream `usage` object
+    return {"tokens": usage.get("total_tokens") or 0, "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens")}
+
+
+def usage_counts(reported: dict, prompt_tokens: int, reply_tokens: int) -> dict:
+    # Token counts to record for a reply: as reported upstream or, when the provider sent no
+    # usage, counted locally (prompt from the stored counts of the window), so quotas and rate
+    # limits still see the request.
+    if reported["tokens"]:
+        return {key: reported[key] for key in ("tokens", "prompt_tokens", "completion_tokens")}
+    return {"tokens": prompt_tokens + reply_tokens, "prompt_tokens": prompt_tokens, "completion_tokens": reply_tokens}
+
+
+# Cached and coalesced replies cost nothing upstream, so they record zero tokens.
+NO_USAGE = {"tokens": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+
+async def ensure_user(db: AsyncSession, user_id: int) -> None:
+    # 1. User Handling: existence is cached; on a miss, create the user if needed in a single
+    # idempotent statement instead of select-then-insert.
+    if await lookup_cache.user_exists(user_id):
+        return
+    # For now, create a user if not found. In a real app, this would be part of user management.
+    async with write_lock():
+        result = await db.execute(
+            dialect_insert(models.User.__table__)
+            .values(id=user_id, username=f"user_{user_id}")
+            .on_conflict_do_nothing()
+        )
+        # Committed on its own so the cache never vouches for a user that a later rollback removed.
+        await db.commit()
+    if result.rowcount:
+        create_log_entry("INFO", f"User with ID {user_id} not found, created new user.")
+    await lookup_cache.remember_user(user_id)
+
+
+async def chat_owner_id(db: AsyncSession, chat_id: int) -> Optional[int]:
+    owner_id = await lookup_cache.chat_owner(chat_id)
+    if owner_id is None:
+        owner_id = (await db.execute(select(models.Chat.user_id).where(models.Chat.id == chat_id))).scalar()
+        if owner_id is not None:
+            await lookup_cache.remember_chat(chat_id, owner_id)
+    return owner_id
+
+
+def rate_limited_error(e: RateLimited) -> HTTPException:
+    detail = "Daily token quota exceeded." if e.reason == "daily_quota" else f"Rate limit exceeded ({e.reason})."
+    return HTTPException(status_code=429, detail=detail, headers={"Retry-After": e.retry_after_header})
+
+
+async def enforce_limits(db: AsyncSession, request_data: schemas.ChatCompletionRequest, requests: bool = True) -> int:
+    # Runs before anything is written or sent upstream. Rate limits are answered from memory (or the
+    # shared limiter backend); the quota reads a cached counter. Returns the message's token count
+    # (stored on its row), which is also the estimate reserved from the token buckets, to be
+    # settled by account_tokens, or released with account_tokens(user_id, 0, estimated_tokens) by
+    # a turn that fails. requests=False skips the request buckets (batch items, which were
+    # charged as one request by the batch).
+    estimated_tokens = tokens.count_tokens(request_data.message)
+    if tokens.MESSAGE_MAX_TOKENS and estimated_tokens > tokens.MESSAGE_MAX_TOKENS:
+        raise HTTPException(status_code=413, detail=f"Message too long: {estimated_tokens} tokens, "
+                                                    f"at most {tokens.MESSAGE_MAX_TOKENS}.")
+    try:
+        await rate_limiter.check(request_data.user_id, estimated_tokens, requests=requests)
+    except RateLimited as e:
+        raise rate_limited_error(e)
+    try:
+        await usage_quota.check(db, request_data.user_id, estimated_tokens)
+    except RateLimited as e:
+        # Refused after the buckets were charged: give back what rate_limiter.check took
+        await rate_limiter.refund(request_data.user_id, estimated_tokens, requests=requests)
+        raise rate_limited_error(e)
+    except BaseException:
+        await rate_limiter.refund(request_data.user_id, estimated_tokens, requests=requests)
+        raise
+    return estimated_tokens
+
+
+async def account_tokens(user_id: int, tokens_used: int, estimated_tokens: int) -> None:
+    # Called once the usage row is committed
+    usage_quota.add(user_id, tokens_used)
+    await rate_limiter.record_tokens(user_id, tokens_used, estimated_tokens)
+
+
+async def resolve_user_and_chat(db: AsyncSession, request_data: schemas.ChatCompletionRequest):
+    # Returns (user_id, chat_id, new_chat); chat_id is None for a new chat, which is created
+    # together with the turn's messages (stage_user_turn).
+    user_id = request_data.user_id
+    await ensure_user(db, user_id)
 
     # 2. Chat Session Handling
-    chat_session: Optional[models.Chat] = None
     if request_data.chat_id:
-        chat_session = db.query(models.Chat).filter(models.Chat.id == request_data.chat_id, models.Chat.user_id == user.id).first()
-        if not chat_session:
-            create_log_entry(db, "ERROR", f"Chat session {request_data.chat_id} not found for user {user.id}.")
+        chat_id = request_data.chat_id
+        owner_id = await chat_owner_id(db, chat_id)
+        if owner_id != user_id:
+            create_log_entry("ERROR", f"Chat session {chat_id} not found for user {user_id}.")
             raise HTTPException(status_code=404, detail=f"Chat session not found.")
-    else:
-        chat_session = models.Chat(user_id=user.id, title=f"Chat on {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}")
-        db.add(chat_session)
-        # db.flush() # Flush to get chat_session.id before using it for messages
-        # create_log_entry(db, "INFO", f"New chat session created for user {user.id} with ID {chat_session.id}.")
-        # Not committing here, will commit along with message
+        return user_id, chat_id, False
+
+    return user_id, None, True
+
+
+def new_chat_title() -> str:
+    return f"Chat on {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}"
+
+
+async def stage_new_chat(db: AsyncSession, user_id: int) -> int:
+    chat_session = models.Chat(user_id=user_id, title=new_chat_title())
+    await write_behind.stage(db, chat_session, need_id=True) # chat_session.id is needed for messages
+    # Not committing here, will commit along with message
+    return chat_session.id
+
+
+async def remember_committed_turn(user_id: int, chat_id: int, new_chat: bool, *messages: dict) -> None:
+    # Called after a commit: keep the per-chat caches in step with what is now in the database.
+    if new_chat:
+        await lookup_cache.remember_chat(chat_id, user_id)
+    history.context_cache.remember(chat_id, *messages, new_chat=new_chat)
+
+
+async def load_turn_context(db: AsyncSession, chat_id: Optional[int], text: str, token_count: int,
+                            prior_context: Optional[List[dict]] = None) -> List[dict]:
+    # The context window to send (summary, if any, + recent turns + the new message).
+    # prior_context: the chat's window when the caller already holds it (a chat socket)
+    # 3. Load the recent history window (cached per chat; a new chat has none)
+    if prior_context is None:
+        prior_context = await history.load_context(db, chat_id)
 
+    # 4. Prepare messages for OpenRouter API: bounded history window plus the new message
+    return history.trim_window(prior_context + [history.context_message("user", text, token_count)])
+
+
+async def release_connection(db: AsyncSession) -> None:
+    # Ends the session's read-only transaction and returns its connection to the pool. Called
+    # before the upstream call, so no connection sits idle in a transaction (or, on SQLite,
+    # holds the write lock) for the length of an LLM round trip.
+    await db.close()
+
+
+async def stage_user_turn(db: AsyncSession, user_id: int, chat_id: Optional[int], text: str, token_count: int):
+    # Stages the new chat (chat_id None) and the user message, to be committed with the rest of
+    # the turn. Returns the chat id and the user message (its id is set once committed).
+    if chat_id is None:
+        chat_id = await stage_new_chat(db, user_id)
+    user_message = models.Message(
+        chat_id=chat_id,
+        content=text,
+        sender_type="user",
+        token_count=token_count
+    )
+    await write_behind.stage(db, user_message)
+    create_log_entry("INFO", f"Stored user message for chat {chat_id}, user {user_id}.")
+    return chat_id, user_message
+
+
+# --- Idempotency Keys (see idempotency.py) ---
+REPLAYED_HEADERS = {"Idempotent-Replayed": "true"}
+
+
+async def claim_idempotency_key(request_data: schemas.ChatCompletionRequest, key: str):
+    # (the stored response to replay, None), or (None, claim token) when this request now holds the key
     try:
-        # Ensure chat_session is not None (for type checkers)
-        if chat_session is None : # Should not happen due to logic above
-            create_log_entry(db, "ERROR", "Chat session is unexpectedly None.")
-            raise HTTPException(status_code=500, detail="Internal error: Chat session not initialized.")
-        
-        db.flush() # Ensure user and chat are in session and have IDs if new
-
-        # 3. Store User Message
-        user_message = models.Message(
-            chat_id=chat_session.id,
-            content=request_data.message,
-            sender_type="user"
-        )
-        db.add(user_message)
-        db.flush() # Get user_message.id
-        create_log_entry(db, "INFO", f"Stored user message for chat {chat_session.id}, user {user.id}.")
-
-        # 4. Prepare messages for OpenRouter API (include history)
-        history_messages = db.query(models.Message).filter(models.Message.chat_id == chat_session.id).order_by(models.Message.created_at.asc()).all()
-        
-        api_messages = []
-        for msg in history_messages:
-            api_messages.append({"role": msg.sender_type, "content": msg.content})
-        # The current user message is already added to history_messages if committed before query
-        # If not, ensure it's part of api_messages. The current logic adds it before querying.
-
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": os.getenv("OPENROUTER_SITE_URL", "http://localhost"), # Optional, but good practice
-            "X-Title": os.getenv("OPENROUTER_APP_TITLE", "FastAPI Chat App") # Optional
-        }
-        data = {
-            "model": DEFAULT_MODEL,
-            "messages": api_messages
-        }
+        return await idempotency_store.begin(request_data.user_id, key, idempotency.fingerprint(request_data.dict()))
+    except idempotency.KeyMismatch:
+        create_log_entry("WARNING", f"Idempotency-Key reused with a different request by user {request_data.user_id}.")
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request.")
+
+
+@app.post(f"{API_V1_PREFIX}/chat", response_model=schemas.ChatCompletionResponse)
+async def chat_endpoint(
+    request_data: schemas.ChatCompletionRequest,
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    idempotency_key: Optional[str] = Header(None, max_length=IDEMPOTENCY_KEY_MAX_LENGTH),
+):
+    if not idempotency_key:
+        return await chat_turn(request_data, request, db)
+    replay, claim = await claim_idempotency_key(request_data, idempotency_key)
+    if replay is not None:
+        return JSONResponse(replay, headers=REPLAYED_HEADERS)
+    try:
+        response = await chat_turn(request_data, request, db)
+    except BaseException:
+        # Failed or cancelled: the next retry runs the turn afresh
+        await idempotency_store.release(request_data.user_id, idempotency_key, claim)
+        raise
+    await idempotency_store.complete(request_data.user_id, idempotency_key, claim, jsonable_encoder(response))
+    return response
+
+
+async def chat_turn(request_data: schemas.ChatCompletionRequest, request: Request,
+                    db: AsyncSession) -> schemas.ChatCompletionResponse:
+    deadline = upstream.deadline_from_header(request.headers.get(upstream.DEADLINE_HEADER))
+    if not OPENROUTER_API_KEY:
+        create_log_entry("ERROR", "OpenRouter API key not configured.")
+        raise HTTPException(status_code=500, detail="OpenRouter API key not configured.")
+
+    candidates = route_candidates(request_data)
+    with stage("limits"):
+        estimated_tokens = await enforce_limits(db, request_data)
+    settled = False  # Until the turn is stored, a failure releases the token reservation (finally)
+    try:
+        with stage("resolve"):
+            user_id, chat_id, new_chat = await resolve_user_and_chat(db, request_data)
+        with stage("history"):
+            context = await load_turn_context(db, chat_id, request_data.message, estimated_tokens)
+        # Nothing is written until the reply is in: the chat, both messages and the usage row are
+        # stored in one short transaction afterwards.
+        await release_connection(db)
+        api_messages = history.to_api_messages(context)
+        tokens_saved = history.tokens_saved(context)
 
-        # 5. Call OpenRouter API
-        ai_message_text = None
-        tokens_used = 0
+        data = completion_payload(api_messages, request_data)
+        key = completion_cache_key(api_messages, request_data)
+
+        # 5. Call OpenRouter API (or reuse a cached / in-flight identical completion)
         try:
-            response = requests.post(OPENROUTER_API_URL, headers=headers, json=data, timeout=30)
-            response.raise_for_status()
-            response_data = response.json()
-
-            if response_data.get("choices") and len(response_data["choices"]) > 0:
-                ai_message_text = response_data["choices"][0].get("message", {}).get("content")
-                if response_data.get("usage"):
-                    tokens_used = response_data["usage"].get("total_tokens", 0)
-            
+            upstream_started = time.perf_counter()
+            with stage("upstream"):
+                result, from_cache = await completion_cache.get_or_compute(key, lambda: request_completion(data, candidates, deadline))
+            upstream_ms = None if from_cache else observe_compaction(tokens_saved, upstream_started)
+            ai_message_text = result["text"]
+
             if not ai_message_text:
-                create_log_entry(db, "ERROR", f"No valid AI reply in OpenRouter response for chat {chat_session.id}. Response: {response_data}")
+                create_log_entry("ERROR", f"No valid AI reply in OpenRouter response for chat {chat_id}. Response: {result['raw']}")
                 raise HTTPException(status_code=500, detail="Could not parse assistant's reply.")
+            reply_tokens = tokens.count_tokens(ai_message_text)
+            counts = NO_USAGE if from_cache else usage_counts(result, tokens.prompt_tokens(context), reply_tokens)
+            tokens_used = counts["tokens"]
 
-        except requests.exceptions.Timeout:
-            create_log_entry(db, "ERROR", f"Timeout calling OpenRouter for chat {chat_session.id}.")
-            raise HTTPException(status_code=504, detail="Request to OpenRouter API timed out.")
-        except requests.exceptions.RequestException as e:
-            status_code = e.response.status_code if hasattr(e, 'response') and e.response is not None else 500
-            error_detail = f"Error communicating with OpenRouter API: {e}"
-            if hasattr(e, 'response') and e.response is not None and e.response.text:
-                 error_detail = f"Error from OpenRouter API ({e.response.status_code}): {e.response.text}"
-            create_log_entry(db, "ERROR", f"OpenRouter API error for chat {chat_session.id}: {error_detail}")
-            if status_code == 401:
-                raise HTTPException(status_code=401, detail="Authentication error with OpenRouter. Check API key.")
-            raise HTTPException(status_code=status_code, detail=error_detail)
-
-        # 6. Store AI Message and Usage
-        ai_message_record = None
-        if ai_message_text:
-            ai_message_record = models.Message(
-                chat_id=chat_session.id,
-                content=ai_message_text,
-                sender_type="ai",
-                token_usage=tokens_used 
-            )
-            db.add(ai_message_record)
-            create_log_entry(db, "INFO", f"Stored AI message for chat {chat_session.id}, user {user.id}.")
-
-            if tokens_used > 0:
-                usage_record = models.Usage(
-                    user_id=user.id,
-                    tokens_used=tokens_used
+        except (upstream.CircuitOpenError, httpx.HTTPError) as e:
+            raise completion_error(e, chat_id)
+
+        # 6. Store the turn: chat (if new), user message, AI message and usage
+        with stage("persist"):
+            async with write_lock():
+                chat_id, user_message = await stage_user_turn(db, user_id, chat_id, request_data.message, estimated_tokens)
+                ai_message_record = models.Message(
+                    chat_id=chat_id,
+                    content=ai_message_text,
+                    sender_type="ai",
+                    token_usage=tokens_used,
+                    model=result.get("model"),
+                    token_count=reply_tokens
                 )
-                db.add(usage_record)
-                create_log_entry(db, "INFO", f"Recorded {tokens_used} tokens for user {user.id}.")
-            
-            db.commit() # Commit all changes: user (if new), chat (if new), user_msg, ai_msg, usage
-            db.refresh(user_message)
-            if ai_message_record: db.refresh(ai_message_record)
-            if chat_session and request_data.chat_id is None: db.refresh(chat_session) # if it's a new chat
-
-            return schemas.ChatCompletionResponse(
-                reply=ai_message_text,
-                chat_id=chat_session.id,
-                user_message_id=user_message.id,
-                ai_message_id=ai_message_record.id if ai_message_record else None
-            )
-        else: # Should have been caught earlier
-            db.rollback() # Rollback user message if AI failed critically post-API call
-            create_log_entry(db, "ERROR", f"AI message text was empty after API call for chat {chat_session.id}, rolling back user message.")
-            raise HTTPException(status_code=500, detail="AI response was empty.")
+                await write_behind.stage(db, ai_message_record)
+                create_log_entry("INFO", f"Stored AI message for chat {chat_id}, user {user_id}.")
+
+                if tokens_used > 0 or from_cache:
+                    await store_usage(db, user_id, counts, tokens_saved, upstream_ms)
+                    create_log_entry("INFO", f"Recorded {tokens_used} tokens for user {user_id}{' (served from completion cache)' if from_cache else ''}.")
+
+                await write_behind.commit(db) # Commit (or hand off) all changes: chat (if new), user_msg, ai_msg, usage
+        settled = True
+        await account_tokens(user_id, tokens_used, estimated_tokens)
+        ai_context_message = history.context_message("ai", ai_message_text, reply_tokens)
+        await remember_committed_turn(
+            user_id, chat_id, new_chat,
+            history.context_message("user", request_data.message, estimated_tokens),
+            ai_context_message,
+        )
+        compactor.schedule(chat_id, context + [ai_context_message])
+
+        return schemas.ChatCompletionResponse(
+            reply=ai_message_text,
+            chat_id=chat_id,
+            user_message_id=user_message.id,
+            ai_message_id=ai_message_record.id,
+            model=ai_message_record.model
+        )
 
     except HTTPException as e:
-        db.rollback()
+        await db.rollback()
         # Log is already created in most cases or not applicable for db operational errors
         raise e # Re-raise FastAPI's HTTP exceptions
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         error_msg = f"An unexpected error occurred in chat endpoint for user {request_data.user_id}, chat {request_data.chat_id}: {str(e)}"
         print(error_msg) # Print for server logs
-        create_log_entry(db, "CRITICAL", error_msg)
+        create_log_entry("CRITICAL", error_msg)
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred.")
+    finally:
+        if not settled:
+            await account_tokens(request_data.user_id, 0, estimated_tokens)
+
+# --- Streaming Chat Endpoint (Server-Sent Events) ---
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def sse_event(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+async def sse_stream(events):
+    # (event, payload) pairs framed as Server-Sent Events
+    async for event, payload in events:
+        yield sse_event(event, payload)
+
+
+async def replayed_events(response: dict):
+    # A stored ChatCompletionResponse as the events of the stream that produced it
+    yield "delta", {"content": response["reply"]}
+    yield "done", {name: response[name] for name in ("chat_id", "user_message_id", "ai_message_id", "model")}
+
+
+async def idempotent_events(events, user_id: int, key: str, claim: str):
+    # Passes events through and stores the response once "done" is reached; a stream that
+    # fails or is abandoned before then releases the key
+    reply_parts = []
+    completed = False
+    try:
+        async for event, payload in events:
+            if event == "delta":
+                reply_parts.append(payload["content"])
+            elif event == "done":
+                await idempotency_store.complete(user_id, key, claim, {"reply": "".join(reply_parts), **payload})
+                completed = True
+            yield event, payload
+    finally:
+        if not completed:
+            await idempotency_store.release(user_id, key, claim)
+
+
+async def completion_events(chat_id: int, user_id: int, user_message_id: int, data: dict, key: Optional[str],
+                            estimated_tokens: int, candidates: List[str], deadline: float, tokens_saved: int = 0,
+                            prompt_tokens: int = 0, on_reply: Optional[Callable[[dict], None]] = None):
+    # Yields (event, payload): "delta" {"content"}, then "done" {ids, model} or "error" {"status_code", "detail"}.
+    # Runs after the endpoint has returned, so it uses its own session rather than the request-scoped one.
+    # prompt_tokens: local count of the prompt, recorded if the provider reports no usage.
+    # on_reply(context message): called once the reply is stored.
+    # Owns the token reservation from here: settled once the reply is stored, released on an error
+    # event or when the stream is abandoned (client gone, socket closed).
+    settled = False
+    try:
+        reply_parts = []
+        reported = reported_usage({})
+        upstream_ms = None
+        cached = completion_cache.lookup(key)
+        from_cache = cached is not None
+        if from_cache:
+            # Identical prompt answered recently: replay it as a single delta, no upstream call.
+            model = cached.get("model")
+            reply_parts.append(cached["text"])
+            yield "delta", {"content": cached["text"]}
+        else:
+            upstream_started = time.perf_counter()
+            try:
+                async with model_router.stream_completion(
+                    OPENROUTER_API_URL, openrouter_headers(), data, candidates, deadline
+                ) as (model, response):
+                    if response.status_code >= 400:
+                        body = (await response.aread()).decode("utf-8", errors="replace")
+                        error_detail = f"Error from OpenRouter API ({response.status_code}): {body}"
+                        create_log_entry("ERROR", f"OpenRouter API error for chat {chat_id}: {error_detail}")
+                        yield "error", {"status_code": response.status_code, "detail": error_detail}
+                        return
+
+                    async for line in response.aiter_lines():
+                        # Upstream SSE: "data: {...}" lines, ": keep-alive" comments, and a final "data: [DONE]"
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[len("data:"):].strip()
+                        if payload == "[DONE]":
+                            break
+                        try:
+                            chunk = json.loads(payload)
+                        except ValueError:
+                            continue
+                        if chunk.get("usage"):
+                            reported = reported_usage(chunk["usage"])
+                            observe_token_usage(model, chunk["usage"])
+                        for choice in chunk.get("choices") or []:
+                            delta = (choice.get("delta") or {}).get("content")
+                            if delta:
+                                reply_parts.append(delta)
+                                yield "delta", {"content": delta}
+            except asyncio.CancelledError:
+                # Client disconnected: the upstream stream is closed by the context manager and the
+                # partial reply is discarded. The user message was already committed by the endpoint.
+                create_log_entry("INFO", f"Client disconnected during streamed reply for chat {chat_id}; discarded partial reply.")
+                raise
+            except upstream.CircuitOpenError:
+                create_log_entry("WARNING", f"OpenRouter circuit open, failing fast for streamed chat {chat_id}.")
+                yield "error", {"status_code": 503, "detail": "OpenRouter API is unavailable, try again later."}
+                return
+            except httpx.TimeoutException:
+                create_log_entry("ERROR", f"Timeout streaming from OpenRouter for chat {chat_id}.")
+                yield "error", {"status_code": 504, "detail": "Request to OpenRouter API timed out."}
+                return
+            except httpx.RequestError as e:
+                create_log_entry("ERROR", f"OpenRouter API error for chat {chat_id}: {e}")
+                yield "error", {"status_code": 500, "detail": f"Error communicating with OpenRouter API: {e}"}
+                return
+            upstream_ms = observe_compaction(tokens_saved, upstream_started)
+
+        ai_message_text = "".join(reply_parts)
+        if not ai_message_text:
+            create_log_entry("ERROR", f"Streamed AI reply was empty for chat {chat_id}.")
+            yield "error", {"status_code": 500, "detail": "AI response was empty."}
+            return
+        reply_tokens = tokens.count_tokens(ai_message_text)
+        counts = NO_USAGE if from_cache else usage_counts(reported, prompt_tokens, reply_tokens)
+        tokens_used = counts["tokens"]
+
+        # Store AI Message and Usage once the stream has completed
+        async with AsyncSessionLocal() as db:
+            try:
+                ai_message_record = models.Message(
+                    chat_id=chat_id,
+                    content=ai_message_text,
+                    sender_type="ai",
+                    token_usage=tokens_used,
+                    model=model,
+                    token_count=reply_tokens
+                )
+                with stage("persist"):
+                    async with write_lock():
+                        await write_behind.stage(db, ai_message_record)
+                        if tokens_used > 0 or from_cache:
+                            await store_usage(db, user_id, counts, tokens_saved, upstream_ms)
+                        await write_behind.commit(db)
+                ai_context_message = history.context_message("ai", ai_message_text, reply_tokens)
+                history.context_cache.remember(chat_id, ai_context_message)
+                if on_reply is not None:
+                    on_reply(ai_context_message)
+                settled = True
+                await account_tokens(user_id, tokens_used, estimated_tokens)
+                if not from_cache:
+                    completion_cache.store(key, {"text": ai_message_text, **counts, "model": model})
+                create_log_entry("INFO", f"Stored streamed AI message for chat {chat_id}, user {user_id} ({tokens_used} tokens).")
+            except Exception as e:
+                await db.rollback()
+                error_msg = f"An unexpected error occurred storing streamed reply for chat {chat_id}: {str(e)}"
+                print(error_msg) # Print for server logs
+                yield "error", {"status_code": 500, "detail": "An unexpected server error occurred."}
+                return
+
+        yield "done", {
+            "chat_id": chat_id,
+            "user_message_id": user_message_id,
+            "ai_message_id": ai_message_record.id,
+            "model": model,
+        }
+    finally:
+        if not settled:
+            await account_tokens(user_id, 0, estimated_tokens)
+
+
+@app.post(f"{API_V1_PREFIX}/chat/stream")
+async def chat_stream_endpoint(
+    request_data: schemas.ChatCompletionRequest,
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    idempotency_key: Optional[str] = Header(None, max_length=IDEMPOTENCY_KEY_MAX_LENGTH),
+):
+    claim = None
+    if idempotency_key:
+        replay, claim = await claim_idempotency_key(request_data, idempotency_key)
+        if replay is not None:
+            return StreamingResponse(sse_stream(replayed_events(replay)), media_type="text/event-stream",
+                                     headers={**SSE_HEADERS, **REPLAYED_HEADERS})
+    try:
+        events = await chat_stream_turn(request_data, request, db)
+    except BaseException:
+        if idempotency_key:
+            await idempotency_store.release(request_data.user_id, idempotency_key, claim)
+        raise
+    if idempotency_key:
+        events = idempotent_events(events, request_data.user_id, idempotency_key, claim)
+    return StreamingResponse(sse_stream(events), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+async def chat_stream_turn(request_data: schemas.ChatCompletionRequest, request: Request, db: AsyncSession):
+    # Stores the user message and returns the reply's completion_events
+    deadline = upstream.deadline_from_header(request.headers.get(upstream.DEADLINE_HEADER))
+    if not OPENROUTER_API_KEY:
+        create_log_entry("ERROR", "OpenRouter API key not configured.")
+        raise HTTPException(status_code=500, detail="OpenRouter API key not configured.")
+
+    candidates = route_candidates(request_data)
+    with stage("limits"):
+        estimated_tokens = await enforce_limits(db, request_data)
+    streaming = False  # Once the stream is returned, completion_events settles the token reservation
+    try:
+        with stage("resolve"):
+            user_id, chat_id, new_chat = await resolve_user_and_chat(db, request_data)
+        with stage("history"):
+            context = await load_turn_context(db, chat_id, request_data.message, estimated_tokens)
+        api_messages = history.to_api_messages(context)
+        # The user message is committed before streaming starts so the reply can be stored
+        # from the stream generator, which outlives this request-scoped session. Nothing is held
+        # open across the stream: the reply is stored in a transaction of its own.
+        with stage("persist"):
+            async with write_lock():
+                chat_id, user_message = await stage_user_turn(db, user_id, chat_id, request_data.message, estimated_tokens)
+                await write_behind.commit(db)
+        await remember_committed_turn(user_id, chat_id, new_chat, history.context_message("user", request_data.message, estimated_tokens))
+        compactor.schedule(chat_id, context) # The reply is not needed: the newest turns stay verbatim
+        streaming = True
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        error_msg = f"An unexpected error occurred in chat stream endpoint for user {request_data.user_id}, chat {request_data.chat_id}: {str(e)}"
+        print(error_msg) # Print for server logs
+        create_log_entry("CRITICAL", error_msg)
         raise HTTPException(status_code=500, detail=f"An unexpected server error occurred.")
+    finally:
+        if not streaming:
+            await account_tokens(request_data.user_id, 0, estimated_tokens)
+
+    return completion_events(
+        chat_id, user_id, user_message.id,
+        {**completion_payload(api_messages, request_data), "stream": True, "stream_options": {"include_usage": True}},
+        completion_cache_key(api_messages, request_data),
+        estimated_tokens,
+        candidates,
+        deadline,
+        history.tokens_saved(context),
+        tokens.prompt_tokens(context),
+    )
+
+# --- WebSocket Chat Endpoint ---
+# One connection per chat session: the user and chat are resolved and the context window loaded
+# once, then every message streams its reply back over the socket (frames: see chat_socket.py).
+@app.websocket(f"{API_V1_PREFIX}/chat/ws")
+async def chat_socket_endpoint(
+    websocket: WebSocket,
+    user_id: int = Query(..., description="ID of the user sending the messages."),
+    chat_id: Optional[int] = Query(None, description="Existing chat session; a new chat is created by the first message if omitted."),
+):
+    await websocket.accept()
+    if not OPENROUTER_API_KEY:
+        create_log_entry("ERROR", "OpenRouter API key not configured.")
+        await close_chat_socket(websocket, 500, "OpenRouter API key not configured.")
+        return
+    async with AsyncSessionLocal() as db:
+        await ensure_user(db, user_id)
+        if chat_id is not None and await chat_owner_id(db, chat_id) != user_id:
+            create_log_entry("ERROR", f"Chat session {chat_id} not found for user {user_id}.")
+            await close_chat_socket(websocket, 404, "Chat session not found.")
+            return
+        context = await history.load_context(db, chat_id)
+    socket = ChatSocket(websocket, user_id, chat_id, context)
+    await socket.send({"type": "ready", "user_id": user_id, "chat_id": chat_id})
+    await socket.serve(chat_socket_turn)
+
+
+async def close_chat_socket(websocket: WebSocket, status_code: int, detail: str) -> None:
+    # Errors before the socket is ready: an error frame, then close code 4000 + status_code
+    await websocket.send_json({"type": "error", "id": None, "status_code": status_code, "detail": detail})
+    await websocket.close(code=4000 + status_code, reason=detail)
+
+
+async def chat_socket_turn(socket: ChatSocket, frame_id, frame: dict) -> None:
+    # One message on a chat socket, run as its own task: the same turn as POST /chat/stream, minus
+    # the user and chat lookups and the history read.
+    try:
+        request_data = schemas.ChatCompletionRequest(**{**frame, "user_id": socket.user_id, "chat_id": socket.chat_id})
+    except ValidationError as e:
+        await socket.send_error(frame_id, 422, str(e))
+        return
+    deadline = upstream.deadline_from_header(str(frame["deadline_ms"]) if frame.get("deadline_ms") else None)
+    estimated_tokens = None  # Reserved by enforce_limits; released here unless the reply stream takes it over
+    streaming = False
+    try:
+        candidates = route_candidates(request_data)
+        async with AsyncSessionLocal() as db:
+            estimated_tokens = await enforce_limits(db, request_data)
+            async with socket.setup_lock:
+                new_chat = socket.chat_id is None
+                prior_context = socket.context
+                if compactor.enabled and needs_compaction(prior_context):
+                    # Pick up the summary once the compactor has folded the older turns in
+                    prior_context = await history.load_context(db, socket.chat_id)
+                context = await load_turn_context(db, socket.chat_id, request_data.message, estimated_tokens,
+                                                  prior_context)
+                try:
+                    async with write_lock():
+                        chat_id, user_message = await stage_user_turn(
+                            db, socket.user_id, socket.chat_id, request_data.message, estimated_tokens)
+                        await write_behind.commit(db)
+                except Exception:
+                    await db.rollback()
+                    raise
+                socket.chat_id = chat_id
+                socket.context = context
+        await remember_committed_turn(socket.user_id, chat_id, new_chat,
+                                      history.context_message("user", request_data.message, estimated_tokens))
+        compactor.schedule(chat_id, context)
+        streaming = True
+    except HTTPException as e:
+        await socket.send_error(frame_id, e.status_code, e.detail)
+        return
+    except Exception as e:
+        error_msg = f"An unexpected error occurred in chat socket for user {socket.user_id}, chat {socket.chat_id}: {str(e)}"
+        print(error_msg) # Print for server logs
+        create_log_entry("CRITICAL", error_msg)
+        await socket.send_error(frame_id, 500, "An unexpected server error occurred.")
+        return
+    finally:
+        if estimated_tokens is not None and not streaming:
+            await account_tokens(socket.user_id, 0, estimated_tokens)
+
+    api_messages = history.to_api_messages(context)
+
+    def on_reply(ai_context_message: dict) -> None:
+        socket.context = history.trim_window(socket.context + [ai_context_message])
+
+    events = completion_events(
+        chat_id, socket.user_id, user_message.id,
+        {**completion_payload(api_messages, request_data), "stream": True, "stream_options": {"include_usage": True}},
+        completion_cache_key(api_messages, request_data),
+        estimated_tokens,
+        candidates,
+        deadline,
+        history.tokens_saved(context),
+        tokens.prompt_tokens(context),
+        on_reply,
+    )
+    try:
+        async for event, payload in events:
+            await socket.send({"type": event, "id": frame_id, **payload})
+    finally:
+        await events.aclose()  # Cancelled mid-send (cancel frame, socket closed): the stream releases its reservation
+
+# --- Batch Chat Endpoint ---
+# Many messages in one request, for offline jobs: users and chats are resolved with one query
+# each, upstream calls fan out with bounded concurrency and the turns are written in bulk.
+# Results stream back as NDJSON as the items finish (see batch.py).
+@app.post(f"{API_V1_PREFIX}/chat/batch")
+async def chat_batch_endpoint(batch_request: schemas.ChatBatchRequest, request: Request):
+    if not OPENROUTER_API_KEY:
+        create_log_entry("ERROR", "OpenRouter API key not configured.")
+        raise HTTPException(status_code=500, detail="OpenRouter API key not configured.")
+    if len(batch_request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch.")
+
+    items, rejected = [], []
+    for index, body in enumerate(batch_request.items):
+        try:
+            items.append((index, schemas.ChatCompletionRequest(**body)))
+        except ValidationError as e:
+            rejected.append((index, 422, str(e)))
+    # The batch is one request for the request rate limits; its items are checked against the
+    # token buckets and the daily quota only (batch_turn).
+    try:
+        limited_users = await rate_limiter.check_batch({request_data.user_id for _, request_data in items})
+    except RateLimited as e:
+        raise rate_limited_error(e)
+    if limited_users:
+        for index, request_data in items:
+            if request_data.user_id in limited_users:
+                error = rate_limited_error(limited_users[request_data.user_id])
+                rejected.append((index, error.status_code, error.detail))
+        items = [(index, request_data) for index, request_data in items if request_data.user_id not in limited_users]
+    with stage("resolve"):
+        async with AsyncSessionLocal() as db:
+            chat_owners = await resolve_batch_users_and_chats(db, [request_data for _, request_data in items])
+
+    # One chain per chat: its items run in order. New-chat items each start a chat of their own.
+    chains, chat_chains = [], {}
+    for index, request_data in items:
+        if not request_data.chat_id:
+            chains.append([(index, request_data)])
+        elif chat_owners.get(request_data.chat_id) != request_data.user_id:
+            create_log_entry("ERROR", f"Chat session {request_data.chat_id} not found for user {request_data.user_id}.")
+            rejected.append((index, 404, "Chat session not found."))
+        else:
+            if request_data.chat_id not in chat_chains:
+                chat_chains[request_data.chat_id] = []
+                chains.append(chat_chains[request_data.chat_id])
+            chat_chains[request_data.chat_id].append((index, request_data))
+
+    deadline_header = request.headers.get(upstream.DEADLINE_HEADER)  # Applies to each item
+    contexts: dict = {}  # chat_id -> window, advanced by each of the chat's items
+
+    async def run_item(request_data: schemas.ChatCompletionRequest) -> dict:
+        return await batch_turn(request_data, deadline_header, contexts)
+
+    concurrency = min(batch_request.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)
+    return StreamingResponse(run_batch(chains, run_item, batch_turn_stored, batch_turn_discarded, concurrency, rejected),
+                             media_type="application/x-ndjson")
+
+
+async def resolve_batch_users_and_chats(db: AsyncSession, requests: List[schemas.ChatCompletionRequest]) -> dict:
+    # ensure_user and chat_owner_id for a whole batch: one IN (...) query for the users (missing
+    # users are created in one INSERT) and one for the chats. Returns chat_id -> owner's user_id.
+    user_ids = {request_data.user_id for request_data in requests}
+    if user_ids:
+        found = set((await db.execute(select(models.User.id).where(models.User.id.in_(user_ids)))).scalars())
+        missing = sorted(user_ids - found)
+        if missing:
+            await db.execute(dialect_insert(models.User.__table__).on_conflict_do_nothing(),
+                             [{"id": user_id, "username": f"user_{user_id}"} for user_id in missing])
+            await db.commit()
+            create_log_entry("INFO", f"Users {missing[:10]} not found, created {len(missing)} new users for a batch.")
+    chat_ids = {request_data.chat_id for request_data in requests if request_data.chat_id}
+    if not chat_ids:
+        return {}
+    owners = dict((await db.execute(select(models.Chat.id, models.Chat.user_id).where(models.Chat.id.in_(chat_ids)))).all())
+    for chat_id in chat_ids - owners.keys():
+        # Possibly a new chat still queued by write-behind, which lookup_cache already knows
+        owner_id = await lookup_cache.chat_owner(chat_id)
+        if owner_id is not None:
+            owners[chat_id] = owner_id
+    return owners
+
+
+async def batch_turn(request_data: schemas.ChatCompletionRequest, deadline_header: Optional[str],
+                     contexts: dict) -> dict:
+    # One batch item up to its reply: the same turn as POST /chat, except that nothing is stored
+    # here. Returns the turn for batch.write_turns, which stores it with others.
+    # contexts: chat_id -> window; the chat's items run one at a time, so each sees the last reply.
+    candidates = route_candidates(request_data)
+    chat_id = request_data.chat_id
+    async with AsyncSessionLocal() as db:
+        estimated_tokens = await enforce_limits(db, request_data, requests=False)
+        try:
+            if chat_id and chat_id not in contexts:
+                contexts[chat_id] = await history.load_context(db, chat_id)
+        except BaseException:
+            await account_tokens(request_data.user_id, 0, estimated_tokens)
+            raise
+    try:
+        return await batch_turn_reply(request_data, deadline_header, contexts, candidates, estimated_tokens)
+    except BaseException:
+        # Failed or cancelled before there was a turn to store: release the token reservation
+        await account_tokens(request_data.user_id, 0, estimated_tokens)
+        raise
+
+
+async def batch_turn_reply(request_data: schemas.ChatCompletionRequest, deadline_header: Optional[str],
+                           contexts: dict, candidates: List[str], estimated_tokens: int) -> dict:
+    chat_id = request_data.chat_id
+    prior_context = contexts[chat_id] if chat_id else []
+    user_context_message = history.context_message("user", request_data.message, estimated_tokens)
+    context = history.trim_window(prior_context + [user_context_message])
+    api_messages = history.to_api_messages(context)
+    tokens_saved = history.tokens_saved(context)
+    data = completion_payload(api_messages, request_data)
+    key = completion_cache_key(api_messages, request_data)
+    deadline = upstream.deadline_from_header(deadline_header)  # From when the item starts
+
+    try:
+        upstream_started = time.perf_counter()
+        result, from_cache = await completion_cache.get_or_compute(key, lambda: request_completion(data, candidates, deadline))
+    except (upstream.CircuitOpenError, httpx.HTTPError) as e:
+        raise completion_error(e, chat_id)
+    upstream_ms = None if from_cache else observe_compaction(tokens_saved, upstream_started)
+    ai_message_text = result["text"]
+    if not ai_message_text:
+        create_log_entry("ERROR", f"No valid AI reply in OpenRouter response for chat {chat_id}. Response: {result['raw']}")
+        raise HTTPException(status_code=500, detail="Could not parse assistant's reply.")
+    reply_tokens = tokens.count_tokens(ai_message_text)
+    ai_context_message = history.context_message("ai", ai_message_text, reply_tokens)
+    if chat_id:
+        contexts[chat_id] = history.trim_window(context + [ai_context_message])
+
+    return {
+        "user_id": request_data.user_id,
+        "chat_id": chat_id,  # Filled in for a new chat when it is stored
+        "new_chat": not chat_id,
+        "title": None if chat_id else new_chat_title(),
+        "message": request_data.message,
+        "message_tokens": estimated_tokens,
+        "reply": ai_message_text,
+        "reply_tokens": reply_tokens,
+        "model": result.get("model"),
+        "counts": NO_USAGE if from_cache else usage_counts(result, tokens.prompt_tokens(context), reply_tokens),
+        "tokens_saved": tokens_saved,
+        "upstream_ms": upstream_ms,
+        "from_cache": from_cache,
+        "context": context + [ai_context_message],
+    }
+
+
+async def batch_turn_stored(turn: dict) -> None:
+    # Called once the turn is written: settle the token reservation and update the per-chat caches.
+    await account_tokens(turn["user_id"], turn["counts"]["tokens"], turn["message_tokens"])
+    await remember_committed_turn(turn["user_id"], turn["chat_id"], turn["new_chat"], *turn["context"][-2:])
+    compactor.schedule(turn["chat_id"], turn["context"])
+
+
+async def batch_turn_discarded(turn: dict) -> None:
+    # Called for a turn that was not written (failed write, client gone): release its reservation.
+    await account_tokens(turn["user_id"], 0, turn["message_tokens"])
+
+# --- Read-side Endpoints (chat list and message history) ---
+# Keyset pagination on (created_at, id), newest first. Only the listed columns are selected, so no
+# ORM objects or relationship collections are loaded, and rows are serialized straight to JSON.
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+
+
+def encode_cursor(row_id: int) -> str:
+    return base64.urlsafe_b64encode(str(row_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[int]:
+    if not cursor:
+        return None
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+
+def keyset_page(query, model, cursor_id: Optional[int], limit: int):
+    # Rows strictly older than the cursor row. Its created_at is read back inside the database
+    # so the comparison sees the stored value (see history.history_page_query).
+    if cursor_id is not None:
+        cursor_created_at = select(model.created_at).where(model.id == cursor_id).scalar_subquery()
+        query = query.where(tuple_(model.created_at, model.id) < tuple_(cursor_created_at, cursor_id))
+    return query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1)
+
+
+def page_response(request: Request, rows, limit: int, columns: List[str],
+                  row_cursor: Callable = lambda row: encode_cursor(row.id)) -> Response:
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    body = json.dumps({
+        "items": [
+            {c: (v.isoformat() if isinstance(v, datetime) else v) for c, v in zip(columns, row)}
+            for row in rows
+        ],
+        "next_cursor": row_cursor(rows[-1]) if has_more else None,
+    }, separators=(",", ":"))
+    etag = '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip().lstrip("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+@app.get(f"{API_V1_PREFIX}/users/{{user_id}}/chats", response_model=schemas.ChatPage)
+async def list_user_chats(
+    user_id: int,
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_async_db)
+):
+    columns = ["id", "title", "created_at"]
+    query = select(models.Chat.id, models.Chat.title, models.Chat.created_at).where(models.Chat.user_id == user_id)
+    rows = (await db.execute(keyset_page(query, models.Chat, decode_cursor(cursor), limit))).all()
+    return page_response(request, rows, limit, columns)
+
+
+@app.get(f"{API_V1_PREFIX}/chats/{{chat_id}}/messages", response_model=schemas.MessagePage)
+async def list_chat_messages(
+    chat_id: int,
+    request: Request,
+    user_id: int = Query(..., description="Owner of the chat; other users get 404."),
+    cursor: Optional[str] = None,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if await chat_owner_id(db, chat_id) != user_id:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    columns = ["id", "sender_type", "content", "created_at", "token_usage", "model"]
+    query = select(
+        models.Message.id, models.Message.sender_type, models.Message.content,
+        models.Message.created_at, models.Message.token_usage, models.Message.model,
+    ).where(models.Message.chat_id == chat_id)
+    rows = (await db.execute(keyset_page(query, models.Message, decode_cursor(cursor), limit))).all()
+    return page_response(request, rows, limit, columns)
+
+
+@app.get(f"{API_V1_PREFIX}/users/{{user_id}}/search", response_model=schemas.SearchPage)
+async def search_user_messages(
+    user_id: int,
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=search.SEARCH_MAX_QUERY_LENGTH,
+                   description='Words to find (all must match); "quoted phrases", `or` and -excluded words work too.'),
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # Messages in the user's chats, most relevant first (see search.py)
+    try:
+        after = search.decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    rows = await search.search_messages(db, user_id, q, after, limit + 1)
+    return page_response(request, rows, limit, search.RESULT_COLUMNS,
+                         row_cursor=lambda row: search.encode_cursor(row.rank, row.id))
+
+
+@app.get(f"{API_V1_PREFIX}/usage/{{user_id}}", response_model=schemas.UsageSummary)
+async def get_usage_summary(
+    user_id: int,
+    hours: int = Query(24, ge=1, le=24 * 7, description="Hourly buckets to return, ending with the current hour."),
+    days: int = Query(30, ge=1, le=366, description="Daily buckets to return, ending with today (UTC)."),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # Answered from usage_rollups only; the usage table itself is never scanned.
+    return await usage_summary(db, user_id, hours, days)
+
+
+# --- Admin: Bulk Export / Import (see transfer.py) ---
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+
+def check_compression(compress: Optional[str]) -> None:
+    # Fail before the response starts; a streamed response can no longer change its status.
+    try:
+        transfer.compressor(compress)
+    except (transfer.TransferError, RuntimeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get(f"{API_V1_PREFIX}/admin/export", dependencies=[Depends(require_admin)])
+async def admin_export(
+    user_id: Optional[int] = Query(None, description="Only this user's chats."),
+    compress: Optional[str] = Query(None, description="gzip or zstd."),
+):
+    # Streams NDJSON straight from server-side cursors; memory stays flat for any export size.
+    check_compression(compress)
+    suffix = {"gzip": ".gz", "zstd": ".zst"}.get(compress, "")
+    return StreamingResponse(
+        transfer.export_stream(user_id, compress),
+        media_type=transfer.MEDIA_TYPES[compress],
+        headers={"Content-Disposition": f'attachment; filename="chats.ndjson{suffix}"'},
+    )
+
+
+@app.post(f"{API_V1_PREFIX}/admin/import", dependencies=[Depends(require_admin)])
+async def admin_import(request: Request, compress: Optional[str] = Query(None, description="gzip or zstd.")):
+    # The request body is an export stream; it is read and loaded batch by batch.
+    check_compression(compress)
+    try:
+        counts = await transfer.import_stream(request.stream(), compress)
+    except transfer.TransferError as e:
+        raise HTTPException(status_code=400, detail=f"Import failed, nothing was imported: {e}")
+    create_log_entry("INFO", f"Imported {counts['users']} users, {counts['chats']} chats and {counts['messages']} messages.")
+    return counts
+
 
 # Placeholder for other potential CRUD endpoints for users, chats, etc.
 # For example:
@@ -247,17 +1255,3 @@ async def chat_endpoint(
 #     db.refresh(new_user)
 #     create_log_entry(db, "INFO", f"User {new_user.username} created with ID {new_user.id}.")
 #     return new_user
-
-# @app.get(f"{API_V1_PREFIX}/chats/{{user_id}}", response_model=List[schemas.Chat])
-# def get_user_chats(user_id: int, db: Session = Depends(get_db)):
-#     user = db.query(models.User).filter(models.User.id == user_id).first()
-#     if not user:
-#         raise HTTPException(status_code=404, detail="User not found")
-#     return user.chats
-
-# @app.get(f"{API_V1_PREFIX}/chats/{{chat_id}}/messages", response_model=List[schemas.Message])
-# def get_chat_messages(chat_id: int, db: Session = Depends(get_db)):
-#     chat = db.query(models.Chat).filter(models.Chat.id == chat_id).first()
-#     if not chat:
-#         raise HTTPException(status_code=404, detail="Chat not found")
-#     return chat.messages
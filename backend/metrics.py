@@ -0,0 +1,300 @@
+import os
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+
+# --- Metrics Configuration ---
+# In-process counters, gauges and histograms served at GET /metrics in the Prometheus text format
+# (no client library needed). Recording a value is a dict lookup and a bisect, so instrumenting
+# the request path costs microseconds against requests that take tens of milliseconds or more.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# --- Tracing Configuration ---
+# Optional OpenTelemetry export: every instrumented stage also becomes a span, sent over OTLP/HTTP
+# to OTEL_EXPORTER_OTLP_ENDPOINT (e.g. a local collector at http://localhost:4318).
+# Needs opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http.
+OTEL_TRACING_ENABLED = os.getenv("OTEL_TRACING_ENABLED", "false").lower() in ("1", "true", "yes")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "chat-api")
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+        self.function = function  # Read at scrape time instead of being set
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def samples(self) -> List[str]:
+        if self.function is not None:
+            return [f"{self.name} {_format_number(self.function())}"]
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_number(value)}"
+                for labels, value in self._values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, list] = {}  # labels -> [per-bucket counts (+Inf last), sum, count]
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _format_number(bound)
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_number(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = Registry()
+
+# Request path
+requests_in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests currently being served (streamed replies count until they end).",
+))
+request_seconds = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request duration, until the last byte of the response.",
+    ("method", "route", "status"),
+))
+stage_seconds = registry.register(Histogram(
+    "chat_stage_duration_seconds",
+    "Duration of each stage of a chat request (limits, resolve, history, upstream, persist).", ("stage",),
+))
+# Upstream (OpenRouter)
+upstream_attempt_seconds = registry.register(Histogram(
+    "upstream_attempt_duration_seconds",
+    "Duration of each upstream HTTP attempt (to the response headers for streams), by status or error.",
+    ("status",),
+))
+upstream_tokens = registry.register(Histogram(
+    "upstream_tokens", "Tokens per completion as reported by the upstream, by model and kind.",
+    ("model", "kind"), buckets=TOKEN_BUCKETS,
+))
+# Compaction (see compaction.py): what sending a summary instead of older history saves
+prompt_tokens_saved = registry.register(Histogram(
+    "chat_prompt_tokens_saved", "Estimated prompt tokens per chat request not sent thanks to a chat summary.",
+    buckets=TOKEN_BUCKETS,
+))
+upstream_seconds_by_history = registry.register(Histogram(
+    "chat_upstream_duration_by_history_seconds",
+    "Upstream duration of chat requests (to the last token for streams), by whether older history went "
+    "as a summary ('summary') or was left out of the window ('window').", ("history",),
+))
+# Database
+db_checkout_seconds = registry.register(Histogram(
+    "db_pool_checkout_duration_seconds",
+    "Time spent waiting for a pooled database connection (including connecting, when a new one is opened).",
+))
+
+
+_pooled_engine = None  # The engine whose pool db_pool_connections_checked_out reports
+
+
+def _connections_checked_out() -> float:
+    pool = _pooled_engine.sync_engine.pool if _pooled_engine is not None else None
+    return pool.checkedout() if hasattr(pool, "checkedout") else 0
+
+
+db_connections_checked_out = registry.register(Gauge(
+    "db_pool_connections_checked_out", "Database connections currently checked out of the pool.",
+    function=_connections_checked_out,
+))
+stage_connections = registry.register(Histogram(
+    "chat_stage_db_connections",
+    "Database connections the request held when a chat stage started. Above 0 for 'upstream', a "
+    "connection sat checked out (idle, possibly in a transaction) for the whole upstream call.",
+    ("stage",), buckets=(0, 1, 2, 4),
+))
+
+# Connections checked out by the current HTTP request: a one-item list set by MetricsMiddleware.
+# SQLAlchemy runs pool events in the context of the task that checks the connection out.
+_request_connections: ContextVar[Optional[list]] = ContextVar("request_connections", default=None)
+
+
+def _count_checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+    held = _request_connections.get()
+    if held is not None:
+        held[0] += 1
+        connection_record.info["held_by"] = held
+
+
+def _count_checkin(dbapi_connection, connection_record) -> None:
+    held = connection_record.info.pop("held_by", None) if connection_record is not None else None
+    if held is not None:
+        held[0] -= 1
+
+
+def observe_stage_connections(stage: str) -> None:
+    held = _request_connections.get()
+    if held is not None:
+        stage_connections.observe(held[0], stage)
+
+
+def instrument_pool(engine) -> None:
+    # Times connection checkouts of an AsyncEngine's pool and exposes how many are checked out.
+    # Pool._do_get is where a checkout waits for a free (or new) connection. Safe to call on every
+    # startup: a pool is wrapped once, and the pool that replaces it after engine.dispose() is
+    # wrapped when the app starts again. Checkouts are also counted per request
+    # (chat_stage_db_connections); engine-level listeners carry over to a replacement pool.
+    global _pooled_engine
+    _pooled_engine = engine
+    if not event.contains(engine.sync_engine, "checkout", _count_checkout):
+        event.listen(engine.sync_engine, "checkout", _count_checkout)
+        event.listen(engine.sync_engine, "checkin", _count_checkin)
+    pool = engine.sync_engine.pool
+    if getattr(pool, "_checkout_timed", False):
+        return
+    do_get = pool._do_get
+
+    def timed_do_get():
+        started = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            db_checkout_seconds.observe(time.perf_counter() - started)
+
+    pool._do_get = timed_do_get
+    pool._checkout_timed = True
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware: in-flight gauge and request duration by route template (not the raw
+    # path, which would make one series per chat id).
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = "500"
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        requests_in_flight.inc()
+        _request_connections.set([0])
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            requests_in_flight.dec()
+            route = scope.get("route")
+            request_seconds.observe(time.perf_counter() - started, scope["method"],
+                                    getattr(route, "path", "unmatched"), status)
+
+
+# --- Tracing ---
+_tracer = None
+
+
+def start_tracing() -> None:
+    global _tracer
+    if not OTEL_TRACING_ENABLED or _tracer is not None:
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        raise RuntimeError("OTEL_TRACING_ENABLED requires the 'opentelemetry-sdk' and "
+                           "'opentelemetry-exporter-otlp-proto-http' packages.")
+    provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(
+        OTLPSpanExporter(endpoint=OTEL_EXPORTER_OTLP_ENDPOINT.rstrip("/") + "/v1/traces")
+    ))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("chat-api")
+
+
+def stop_tracing() -> None:
+    if _tracer is not None:
+        from opentelemetry import trace
+        trace.get_tracer_provider().shutdown()  # Flushes queued spans
+
+
+def span(name: str):
+    # A span around a stage when tracing is on; otherwise a no-op context manager.
+    return _tracer.start_as_current_span(name) if _tracer is not None else nullcontext()
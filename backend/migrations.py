@@ -0,0 +1,148 @@
+# Schema migrations as a one-shot leader step.
+#
+# Run once per deploy, before the app workers start (serve.py does this unless --no-migrate):
+#   python -m backend.migrations
+# Every process that migrates first takes a PostgreSQL advisory lock, so when several replicas
+# start at once one of them applies the pending revisions and the others wait, then find the
+# schema already at head and return. Alembic is imported here only, keeping it out of the
+# workers' import time.
+#
+# After migrating it checks that the hot-path queries can use their indexes and prints a warning
+# for any that cannot; the check never fails the deploy. To run it as a check of its own, which
+# exits non-zero on a failure:
+#   python -m backend.migrations check
+import argparse
+import os
+import sys
+import time
+
+from typing import List
+
+from sqlalchemy import inspect, text
+
+# --- Migration Configuration ---
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")
+MIGRATION_LOCK_KEY = int(os.getenv("MIGRATION_LOCK_KEY", "727162021"))  # PostgreSQL advisory lock key
+MIGRATION_LOCK_POLL = 0.5  # Seconds between attempts to take the lock
+
+
+def upgrade_to_head() -> None:
+    # Raises on failure: a deploy must not start workers against a half-migrated schema.
+    from alembic import command as alembic_command
+    from alembic.config import Config as AlembicConfig
+
+    from . import models
+    from .database import IS_SQLITE, engine  # Here, so main() can load .env before DATABASE_URL is read
+
+    config = AlembicConfig(ALEMBIC_INI)  # script_location is relative to the file, so any cwd works
+    started = time.perf_counter()
+    if IS_SQLITE:
+        # A local database has a single writer; there is nobody to coordinate with. The initial
+        # revisions are PostgreSQL-only (now() defaults, partitioning), so a new SQLite database
+        # is created from the models and stamped as being at head.
+        if inspect(engine).has_table("users"):
+            alembic_command.upgrade(config, "head")
+        else:
+            models.Base.metadata.create_all(bind=engine)
+            alembic_command.stamp(config, "head")
+    else:
+        # The lock is held by its own session, in autocommit mode, and released when that
+        # connection closes, even if this process dies mid-migration. It is polled with
+        # pg_try_advisory_lock rather than waited on: a session blocked in pg_advisory_lock (or
+        # idle in a transaction) holds a snapshot, which CREATE INDEX CONCURRENTLY in the
+        # leader's migrations would wait for forever.
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+            while not lock_conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY}).scalar():
+                time.sleep(MIGRATION_LOCK_POLL)
+            waited = time.perf_counter() - started
+            try:
+                alembic_command.upgrade(config, "head")
+            finally:
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        if waited > 1:
+            print(f"Waited {waited:.1f}s for the migration lock held by another process.")
+        try:
+            check_index_plans(engine)
+        except Exception as e:  # The schema is migrated; a check that cannot run is not a failed deploy
+            print(f"Warning: index check could not run: {e}")
+    engine.dispose()  # A launcher should not keep this connection open while it serves
+    print(f"Database schema at head ({time.perf_counter() - started:.2f}s).")
+
+
+def _index_plan_checks() -> list:
+    # (label, index, query): hot-path queries and the index each one must be served by
+    from sqlalchemy import select
+
+    from . import history, models
+
+    return [
+        ("history first page", "ix_messages_chat_id_created_at", history.history_page_query(1, history.HISTORY_PAGE_SIZE)),
+        ("history keyset page", "ix_messages_chat_id_created_at",
+         history.history_page_query(1, history.HISTORY_PAGE_SIZE, cursor=1)),
+        ("chat list", "ix_chats_user_id_created_at",
+         select(models.Chat.id).where(models.Chat.user_id == 1)
+         .order_by(models.Chat.created_at.desc(), models.Chat.id.desc()).limit(50)),
+        ("message search", "ix_messages_search_vector",  # search_vector is not mapped (see models.py)
+         select(models.Message.id).where(text("search_vector @@ plainto_tsquery('english', 'hello')"))),
+    ]
+
+
+def _plan_index_names(plan: dict) -> set:
+    names = {plan["Index Name"]} if plan.get("Index Name") else set()
+    for child in plan.get("Plans", []):
+        names |= _plan_index_names(child)
+    return names
+
+
+def index_plan_failures(conn) -> List[str]:
+    # PostgreSQL: EXPLAIN each hot-path query with sequential scans disabled (for the rest of the
+    # connection's transaction), so the plan shows whether its index can serve it at all, whatever
+    # the table sizes. Returns one line per query that cannot use its index (the index is missing
+    # or INVALID, or the query no longer matches it).
+    from sqlalchemy.dialects import postgresql
+
+    failures = []
+    conn.execute(text("SET LOCAL enable_seqscan = off"))
+    for label, index, query in _index_plan_checks():
+        sql = str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+        plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+        used = _plan_index_names(plan[0]["Plan"])
+        if index not in used:
+            failures.append(f"{label} does not use {index} (uses {sorted(used) or 'no index'})")
+    return failures
+
+
+def check_index_plans(engine) -> List[str]:
+    # Prints the outcome of index_plan_failures as a warning per failure; returns the failures
+    with engine.begin() as conn:
+        failures = index_plan_failures(conn)
+    for failure in failures:
+        print(f"Warning: index check: {failure}")
+    if not failures:
+        print(f"Index check: the {len(_index_plan_checks())} hot-path queries use their indexes.")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Apply the schema migrations, or check the hot-path index plans")
+    parser.add_argument("command", nargs="?", choices=("upgrade", "check"), default="upgrade")
+    args = parser.parse_args()
+
+    from .config import load_env_file
+
+    load_env_file()
+    if args.command == "upgrade":
+        upgrade_to_head()
+        return
+    from .database import IS_SQLITE, engine
+
+    if IS_SQLITE:
+        sys.exit("The index check needs a PostgreSQL DATABASE_URL")
+    failures = check_index_plans(engine)
+    engine.dispose()
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import httpx
+
+from . import upstream
+
+# --- Model Router Configuration ---
+# ROUTER_MODELS lists the OpenRouter model ids a chat may be served by, in order of preference.
+# Each request tries the fastest healthy candidate first and falls back to the next one when a
+# model errors (429/5xx, connection failure) or does not answer within ROUTER_ATTEMPT_TIMEOUT.
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "gryphe/mythomax-l2-13b")
+ROUTER_MODELS = [m.strip() for m in os.getenv("ROUTER_MODELS", DEFAULT_MODEL).split(",") if m.strip()]
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "100"))  # Recent calls kept per model
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))  # Below this a model is tried to learn its latency
+ROUTER_ERROR_RATIO = float(os.getenv("ROUTER_ERROR_RATIO", "0.5"))  # Error ratio that marks a model unhealthy
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", "30"))  # Seconds an unhealthy model is skipped
+ROUTER_ATTEMPT_TIMEOUT = float(os.getenv("ROUTER_ATTEMPT_TIMEOUT", "20"))  # Seconds before falling back
+
+AUTO = "auto"  # Completion cache scope for requests that let the router choose
+
+
+class UnknownModelError(ValueError):
+    pass
+
+
+class ModelStats:
+    def __init__(self, model: str, window: int = ROUTER_WINDOW):
+        self.model = model
+        self._calls = deque(maxlen=window)  # (ok, latency seconds or None)
+        self.unhealthy_until = 0.0
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, ok: bool, latency: Optional[float] = None) -> None:
+        self.calls += 1
+        self.errors += not ok
+        self._calls.append((ok, latency))
+        failures = sum(1 for call_ok, _ in self._calls if not call_ok)
+        if len(self._calls) >= ROUTER_MIN_SAMPLES and failures / len(self._calls) >= ROUTER_ERROR_RATIO:
+            self.unhealthy_until = time.monotonic() + ROUTER_COOLDOWN
+            self._calls.clear()  # Judge the model afresh once the cooldown is over
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def median_latency(self) -> Optional[float]:
+        samples = sorted(latency for ok, latency in self._calls if ok and latency is not None)
+        if len(samples) < ROUTER_MIN_SAMPLES:
+            return None
+        return samples[len(samples) // 2]
+
+    def stats(self) -> dict:
+        median = self.median_latency()
+        window_errors = sum(1 for ok, _ in self._calls if not ok)
+        return {
+            "healthy": self.healthy,
+            "median_latency_seconds": round(median, 4) if median is not None else None,
+            "error_ratio": round(window_errors / len(self._calls), 4) if self._calls else 0.0,
+            "calls": self.calls,
+            "errors": self.errors,
+        }
+
+
+class ModelRouter:
+    def __init__(self, models: List[str] = ROUTER_MODELS):
+        self.models = list(models) or [DEFAULT_MODEL]  # candidates() never comes back empty
+        self._stats = {model: ModelStats(model) for model in self.models}
+        self.fallbacks = 0
+
+    def candidates(self, requested: Optional[str]) -> List[str]:
+        # `requested` is an exact model id or a provider prefix ending in "/" (e.g. "openai/").
+        # Healthy models come first, then by median latency; models without enough samples yet
+        # sort ahead so the router learns their latency. Config order breaks ties.
+        if requested:
+            allowed = [m for m in self.models if m == requested or (requested.endswith("/") and m.startswith(requested))]
+            if not allowed:
+                raise UnknownModelError(f"Model '{requested}' is not available. Choose one of: {', '.join(self.models)}.")
+        else:
+            allowed = self.models
+
+        def rank(model: str):
+            stats = self._stats[model]
+            median = stats.median_latency()
+            return (not stats.healthy, median if median is not None else 0.0)
+
+        return sorted(allowed, key=rank)
+
+    async def post_completion(self, url: str, headers: dict, data: dict, candidates: List[str], deadline: float):
+        # Returns (model, response). Falls back through `candidates` on errors, slow answers and open
+        # circuits; the last model's response or error is what the caller sees.
+        if not candidates:
+            raise ValueError("No candidate models to send the completion to.")
+        for position, model in enumerate(candidates):
+            last = position == len(candidates) - 1
+            attempt_deadline = deadline if last else min(deadline, time.monotonic() + ROUTER_ATTEMPT_TIMEOUT)
+            started = time.monotonic()
+            try:
+                response = await upstream.post_json(url, headers, {**data, "model": model}, attempt_deadline,
+                                                     breaker_key=upstream.breaker_key_for(url, model))
+            except (httpx.TimeoutException, httpx.TransportError, upstream.CircuitOpenError) as e:
+                if not isinstance(e, upstream.CircuitOpenError):
+                    self._stats[model].record(False)  # An open circuit made no call, so there is no outcome
+                if last or time.monotonic() >= deadline:
+                    raise
+                self.fallbacks += 1
+                continue
+            ok = response.status_code not in upstream.RETRYABLE_STATUS
+            self._stats[model].record(ok, time.monotonic() - started if ok else None)
+            if ok or last:
+                return model, response
+            self.fallbacks += 1
+
+    @asynccontextmanager
+    async def stream_completion(self, url: str, headers: dict, data: dict, candidates: List[str], deadline: float):
+        # Yields (model, response). Falls back only before the first byte of a reply, and without
+        # ROUTER_ATTEMPT_TIMEOUT, which would cut a long reply short. Stream outcomes count towards
+        # a model's health but not its latency (which is measured on whole replies).
+        if not candidates:
+            raise ValueError("No candidate models to send the completion to.")
+        for position, model in enumerate(candidates):
+            last = position == len(candidates) - 1
+            streaming = False
+            try:
+                async with upstream.stream_post(url, headers, {**data, "model": model}, deadline,
+                                                breaker_key=upstream.breaker_key_for(url, model)) as response:
+                    ok = response.status_code not in upstream.RETRYABLE_STATUS
+                    self._stats[model].record(ok)
+                    if ok or last:
+                        streaming = True
+                        yield model, response
+                        return
+            except (httpx.TimeoutException, httpx.TransportError, upstream.CircuitOpenError) as e:
+                if streaming:
+                    raise  # Failed mid-reply, in the caller: too late to fall back
+                if not isinstance(e, upstream.CircuitOpenError):
+                    self._stats[model].record(False)
+                if last or time.monotonic() >= deadline:
+                    raise
+            self.fallbacks += 1
+
+    def stats(self) -> dict:
+        return {"fallbacks": self.fallbacks, "models": {m: s.stats() for m, s in self._stats.items()}}
+
+
+model_router = ModelRouter()
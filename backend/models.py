@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, func
+from sqlalchemy import DDL, Column, BigInteger, Integer, String, Text, DateTime, ForeignKey, Index, event, func
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -23,6 +23,8 @@ class Chat(Base):
     user = relationship("User", back_populates="chats")
     messages = relationship("Message", back_populates="chat", cascade="all, delete-orphan")
 
+    __table_args__ = (Index("ix_chats_user_id_created_at", "user_id", "created_at"),)
+
 class Message(Base):
     __tablename__ = "messages"
 
@@ -32,19 +34,89 @@ class Message(Base):
     sender_type = Column(String, nullable=False)  # 'user' or 'ai'
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     token_usage = Column(Integer, nullable=True) # For AI messages
+    model = Column(String, nullable=True) # Model that wrote an AI message (see model_router.py)
+    token_count = Column(Integer, nullable=True) # Tokens of `content` by the local tokenizer (see tokens.py)
 
     chat = relationship("Chat", back_populates="messages")
 
+    # Serves the history window: newest messages of one chat, keyset-ordered by (created_at, id)
+    __table_args__ = (Index("ix_messages_chat_id_created_at", "chat_id", "created_at", "id"),)
+
+# Full-text index of message content (see search.py), maintained by the database rather than
+# mapped: on PostgreSQL a `search_vector` tsvector column set by a trigger and indexed with GIN,
+# on SQLite an FTS5 table over messages kept in sync by triggers. Emitted after `messages` is
+# created by create_all; existing databases get it from revision 4a7d9c2e8b13.
+MESSAGE_SEARCH_DDL = {
+    "postgresql": [
+        "ALTER TABLE messages ADD COLUMN search_vector tsvector",
+        "CREATE TRIGGER messages_search_vector BEFORE INSERT OR UPDATE OF content ON messages "
+        "FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger(search_vector, 'pg_catalog.english', content)",
+        # Fires under session_replication_role = replica too (bulk import, see transfer.py)
+        "ALTER TABLE messages ENABLE ALWAYS TRIGGER messages_search_vector",
+        "CREATE INDEX ix_messages_search_vector ON messages USING gin (search_vector)",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', content_rowid='id', "
+        "tokenize='porter unicode61')",
+        "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); END",
+        "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+        "CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+        "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); END",
+    ],
+}
+for _dialect, _statements in MESSAGE_SEARCH_DDL.items():
+    for _statement in _statements:
+        event.listen(Message.__table__, "after_create", DDL(_statement).execute_if(dialect=_dialect))
+
+class ChatSummary(Base):
+    # Rolling summary of a chat's older messages, sent upstream in their place (see compaction.py).
+    # It covers every message up to and including covers_message_id in (created_at, id) order.
+    __tablename__ = "chat_summaries"
+
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), primary_key=True)
+    content = Column(Text, nullable=False)
+    covers_message_id = Column(Integer, nullable=False)
+    covered_tokens = Column(Integer, nullable=False)  # Estimated tokens of the messages it replaces
+    summary_tokens = Column(Integer, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+# On PostgreSQL, usage and logs are range-partitioned by month of `timestamp` (primary key
+# (id, timestamp)); the partitions are created and retired by partitions.py.
 class Usage(Base):
     __tablename__ = "usage"
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     tokens_used = Column(Integer, nullable=False)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    # Estimated prompt tokens not sent because older history went as a summary (see compaction.py)
+    prompt_tokens_saved = Column(Integer, nullable=True)
+    # Upstream duration of the request in milliseconds (NULL when served from the completion cache);
+    # compared between rows with and without prompt_tokens_saved, it shows what compaction saves
+    upstream_ms = Column(Integer, nullable=True)
 
     user = relationship("User", back_populates="usages")
 
+    __table_args__ = (Index("ix_usage_user_id_timestamp", "user_id", "timestamp"),)
+
+class UsageRollup(Base):
+    # Per-user token totals per hour and per day, maintained incrementally (see usage_rollup.py)
+    __tablename__ = "usage_rollups"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    period = Column(String, primary_key=True)  # 'hour' or 'day'
+    bucket_start = Column(DateTime(timezone=True), primary_key=True)  # UTC start of the hour/day
+    tokens_used = Column(BigInteger, nullable=False, default=0)
+    requests = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(BigInteger, nullable=False, default=0, server_default="0")
+    completion_tokens = Column(BigInteger, nullable=False, default=0, server_default="0")
+    prompt_tokens_saved = Column(BigInteger, nullable=False, default=0, server_default="0")
+
 class Log(Base):
     __tablename__ = "logs"
 
@@ -52,3 +124,5 @@ class Log(Base):
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     level = Column(String, nullable=False) # 'INFO', 'ERROR', 'WARNING'
     message = Column(Text, nullable=False)
+
+    __table_args__ = (Index("ix_logs_timestamp", "timestamp"),)
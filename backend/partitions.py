@@ -0,0 +1,236 @@
+# Monthly partition maintenance for the time-partitioned tables (PostgreSQL only).
+#
+# `logs` and `usage` are range-partitioned by calendar month (UTC) of their timestamp, with
+# partitions named <table>_y<YYYY>m<MM> and a <table>_default partition for rows outside them
+# (see alembic revision 5e2b8c7a1d46). Run from cron or a scheduled job, e.g. daily:
+#   python -m backend.partitions maintain [--dry-run]
+# which creates the partitions for the next PARTITION_PREMAKE_MONTHS months and drops the ones
+# older than each table's retention, exporting them first when PARTITION_ARCHIVE_DIR is set.
+# Expired rows in the default partition (written before their month's partition existed) are
+# deleted on the same schedule, and exported first in the same way.
+#
+# Other commands:
+#   python -m backend.partitions list
+#   python -m backend.partitions export logs 2026-06 --out /var/backups/chat
+# Exports are gzipped NDJSON (one JSON object per row), streamed through a server-side cursor in
+# batches of PARTITION_EXPORT_BATCH rows, so memory stays bounded for any partition size.
+import argparse
+import gzip
+import json
+import os
+import re
+from datetime import date, datetime, timezone
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from .config import load_env_file
+
+if __name__ == "__main__":
+    load_env_file()  # Before .database reads DATABASE_URL
+
+from .database import IS_SQLITE, engine
+
+# --- Partition Configuration ---
+PARTITION_PREMAKE_MONTHS = int(os.getenv("PARTITION_PREMAKE_MONTHS", "3"))
+LOGS_RETENTION_MONTHS = int(os.getenv("LOGS_RETENTION_MONTHS", "3"))  # 0 keeps every month
+USAGE_RETENTION_MONTHS = int(os.getenv("USAGE_RETENTION_MONTHS", "0"))  # Raw usage; rollups are kept regardless
+PARTITION_ARCHIVE_DIR = os.getenv("PARTITION_ARCHIVE_DIR", "")  # Export before dropping when set
+PARTITION_EXPORT_BATCH = int(os.getenv("PARTITION_EXPORT_BATCH", "5000"))
+
+# table -> (partition column, retention in months)
+PARTITIONED_TABLES = {
+    "logs": ("timestamp", LOGS_RETENTION_MONTHS),
+    "usage": ("timestamp", USAGE_RETENTION_MONTHS),
+}
+
+
+def month_start(at: datetime) -> date:
+    at = at.astimezone(timezone.utc) if at.tzinfo else at
+    return date(at.year, at.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_y{month.year:04d}m{month.month:02d}"
+
+
+def _bounds(month: date) -> tuple:
+    return f"{month.isoformat()} 00:00:00+00", f"{add_months(month, 1).isoformat()} 00:00:00+00"
+
+
+def is_partitioned(conn, table: str) -> bool:
+    return bool(conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = :table AND c.relnamespace = 'public'::regnamespace"
+    ), {"table": table}).scalar())
+
+
+def monthly_partitions(conn, table: str) -> List[date]:
+    # Months that have their own partition, oldest first (the default partition is not listed).
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:table AS regclass)"
+    ), {"table": table}).scalars()
+    pattern = re.compile(rf"^{re.escape(table)}_y(\d{{4}})m(\d{{2}})$")
+    months = [date(int(m.group(1)), int(m.group(2)), 1) for m in map(pattern.match, names) if m]
+    return sorted(months)
+
+
+def create_partition(conn, table: str, key: str, month: date) -> None:
+    # Rows for this month that already landed in the default partition (maintenance did not run
+    # in time) are moved into the new partition; PostgreSQL refuses to create it otherwise.
+    lower, upper = _bounds(month)
+    name = partition_name(table, month)
+    in_range = f'"{key}" >= :lower AND "{key}" < :upper'
+    params = {"lower": lower, "upper": upper}
+    stranded = conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {table}_default WHERE {in_range})"), params).scalar()
+    if stranded:
+        conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {table}_default"))
+    conn.execute(text(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ('{lower}') TO ('{upper}')"))
+    if stranded:
+        conn.execute(text(f"INSERT INTO {table} SELECT * FROM {table}_default WHERE {in_range}"), params)
+        conn.execute(text(f"DELETE FROM {table}_default WHERE {in_range}"), params)
+        conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {table}_default DEFAULT"))
+
+
+def export_partition(table: str, month: date, out_dir: str, batch_size: int = PARTITION_EXPORT_BATCH) -> str:
+    # Writes <out_dir>/<partition>.ndjson.gz and returns its path. The file is written under a
+    # temporary name and renamed when complete, so a partial export is never mistaken for a full one.
+    name = partition_name(table, month)
+    path = os.path.join(out_dir, f"{name}.ndjson.gz")
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(text(f"SELECT * FROM {name}"))
+        rows = _write_rows(result, path, batch_size)
+    print(f"Exported {rows} rows of {name} to {path}.")
+    return path
+
+
+def _write_rows(result, path: str, batch_size: int) -> int:
+    # Streams a result into a gzipped NDJSON file; returns the row count
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    rows = 0
+    with gzip.open(path + ".partial", "wt", encoding="utf-8") as f:
+        while True:
+            batch = result.fetchmany(batch_size)
+            if not batch:
+                break
+            for row in batch:
+                f.write(json.dumps(dict(row._mapping), default=_json_value, separators=(",", ":")) + "\n")
+            rows += len(batch)
+    os.replace(path + ".partial", path)
+    return rows
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot export {type(value).__name__} values")
+
+
+def drop_partition(table: str, month: date) -> None:
+    # Detach first so the drop only locks the partition, not the parent table.
+    name = partition_name(table, month)
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+        conn.execute(text(f"DROP TABLE {name}"))
+
+
+def expired_default_rows(conn, table: str, key: str, before: date) -> int:
+    return conn.execute(text(f'SELECT count(*) FROM {table}_default WHERE "{key}" < :before'),
+                        {"before": _bounds(before)[0]}).scalar()
+
+
+def prune_default(table: str, key: str, before: date, archive_dir: str = "",
+                  batch_size: int = PARTITION_EXPORT_BATCH) -> int:
+    # Deletes the default partition's rows older than `before`; returns how many. With archive_dir
+    # they are exported first, in the same REPEATABLE READ transaction: the DELETE sees the same
+    # snapshot as the export, so it removes exactly the rows written to the file, and it only
+    # commits once the file is complete.
+    expired = f'FROM {table}_default WHERE "{key}" < :before'
+    params = {"before": _bounds(before)[0]}
+    with engine.connect().execution_options(isolation_level="REPEATABLE READ") as conn:
+        with conn.begin():
+            if archive_dir:
+                stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+                name = f"{table}_default_before_y{before.year:04d}m{before.month:02d}_{stamp}"
+                path = os.path.join(archive_dir, f"{name}.ndjson.gz")
+                result = conn.execution_options(stream_results=True).execute(text(f"SELECT * {expired}"), params)
+                print(f"Exported {_write_rows(result, path, batch_size)} rows of {table}_default to {path}.")
+            return conn.execute(text(f"DELETE {expired}"), params).rowcount
+
+
+def maintain(now: Optional[datetime] = None, dry_run: bool = False, archive_dir: str = PARTITION_ARCHIVE_DIR) -> List[str]:
+    # Returns the actions taken (or, with dry_run, the ones that would be taken).
+    current = month_start(now or datetime.now(timezone.utc))
+    actions = []
+    for table, (key, retention) in PARTITIONED_TABLES.items():
+        with engine.begin() as conn:
+            if not is_partitioned(conn, table):
+                actions.append(f"skip {table}: not partitioned (run the Alembic migrations)")
+                continue
+            existing = set(monthly_partitions(conn, table))
+            for offset in range(PARTITION_PREMAKE_MONTHS + 1):
+                month = add_months(current, offset)
+                if month not in existing:
+                    actions.append(f"create {partition_name(table, month)}")
+                    if not dry_run:
+                        create_partition(conn, table, key, month)
+        if retention <= 0:
+            continue
+        oldest_kept = add_months(current, -retention)
+        with engine.connect() as conn:
+            expired = expired_default_rows(conn, table, key, oldest_kept)
+        if expired:
+            if archive_dir:
+                actions.append(f"export {expired} expired rows of {table}_default to {archive_dir}")
+            actions.append(f"delete {expired} rows before {oldest_kept:%Y-%m} from {table}_default")
+            if not dry_run:
+                prune_default(table, key, oldest_kept, archive_dir)
+        for month in sorted(m for m in existing if m < oldest_kept):
+            if archive_dir:
+                actions.append(f"export {partition_name(table, month)} to {archive_dir}")
+                if not dry_run:
+                    export_partition(table, month, archive_dir)
+            actions.append(f"drop {partition_name(table, month)}")
+            if not dry_run:
+                drop_partition(table, month)
+    return actions
+
+
+def _parse_month(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m").date()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Maintain the monthly partitions of logs and usage")
+    commands = parser.add_subparsers(dest="command", required=True)
+    maintain_parser = commands.add_parser("maintain", help="Create upcoming partitions and apply retention")
+    maintain_parser.add_argument("--dry-run", action="store_true")
+    commands.add_parser("list", help="List the monthly partitions of each table")
+    export_parser = commands.add_parser("export", help="Export one month to a gzipped NDJSON file")
+    export_parser.add_argument("table", choices=sorted(PARTITIONED_TABLES))
+    export_parser.add_argument("month", type=_parse_month, help="YYYY-MM")
+    export_parser.add_argument("--out", default=PARTITION_ARCHIVE_DIR or ".")
+    args = parser.parse_args()
+
+    if IS_SQLITE:
+        parser.exit(1, "Partitioning needs PostgreSQL; SQLite tables are not partitioned.\n")
+    if args.command == "maintain":
+        for action in maintain(dry_run=args.dry_run):
+            print(("would " if args.dry_run else "") + action)
+    elif args.command == "list":
+        with engine.connect() as conn:
+            for table in PARTITIONED_TABLES:
+                months = monthly_partitions(conn, table) if is_partitioned(conn, table) else []
+                print(f"{table}: " + (", ".join(m.strftime("%Y-%m") for m in months) or "not partitioned"))
+    elif args.command == "export":
+        export_partition(args.table, args.month, args.out)
+
+
+if __name__ == "__main__":
+    main()
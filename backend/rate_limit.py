@@ -0,0 +1,291 @@
+import math
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, Iterable
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .usage_rollup import bucket_start, utcnow
+
+# --- Rate Limit Configuration ---
+# Token buckets checked before a chat request touches the database or OpenRouter.
+# Request buckets refill at *_RPS with room for *_BURST; token buckets refill at *_TOKENS_PER_MIN.
+# A rate of 0 disables that bucket.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # 'memory' or 'redis'
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+RATE_LIMIT_PREFIX = os.getenv("RATE_LIMIT_PREFIX", "chatapi:ratelimit:")
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+RATE_LIMIT_USER_RPS = float(os.getenv("RATE_LIMIT_USER_RPS", "2"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "10"))
+RATE_LIMIT_USER_TOKENS_PER_MIN = float(os.getenv("RATE_LIMIT_USER_TOKENS_PER_MIN", "20000"))
+RATE_LIMIT_GLOBAL_RPS = float(os.getenv("RATE_LIMIT_GLOBAL_RPS", "0"))
+RATE_LIMIT_GLOBAL_BURST = float(os.getenv("RATE_LIMIT_GLOBAL_BURST", "100"))
+RATE_LIMIT_GLOBAL_TOKENS_PER_MIN = float(os.getenv("RATE_LIMIT_GLOBAL_TOKENS_PER_MIN", "0"))
+
+# --- Quota Configuration ---
+# Daily (UTC) token allowance per user, checked against a cached counter seeded from usage_rollups.
+QUOTA_DAILY_TOKENS = int(os.getenv("QUOTA_DAILY_TOKENS", "0"))  # 0 disables the quota
+QUOTA_CACHE_TTL = float(os.getenv("QUOTA_CACHE_TTL", "60"))  # Seconds before re-reading the rollup row
+QUOTA_CACHE_MAX_ENTRIES = int(os.getenv("QUOTA_CACHE_MAX_ENTRIES", "100000"))
+
+
+class RateLimited(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class InProcessBuckets:
+    # Buckets private to this worker. take/debit never await, so on the event loop each call is
+    # atomic without a lock. Idle buckets are evicted LRU-first; an evicted bucket comes back full.
+    def __init__(self, max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # key -> [tokens, updated_at]
+
+    async def take(self, key: str, rate: float, capacity: float, amount: float) -> float:
+        # Returns 0 when `amount` was taken, otherwise the seconds until it would be available.
+        bucket = self._refill(key, rate, capacity)
+        if bucket[0] >= amount:
+            bucket[0] -= amount
+            return 0.0
+        return (amount - bucket[0]) / rate
+
+    async def debit(self, key: str, rate: float, capacity: float, amount: float) -> None:
+        # Unconditional charge (may go negative), for costs only known after the fact.
+        self._refill(key, rate, capacity)[0] -= amount
+
+    def size(self) -> int:
+        return len(self._buckets)
+
+    def _refill(self, key: str, rate: float, capacity: float) -> list:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [capacity, now]
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+
+# Refill-and-take in one round trip. ARGV: rate, capacity, amount, now, force (1 = debit unconditionally).
+_TAKE_SCRIPT = """
+local rate, capacity, amount, now, force = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), ARGV[5] == '1'
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens, updated_at = tonumber(state[1]) or capacity, tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if force or tokens >= amount then
+  tokens = tokens - amount
+else
+  wait = (amount - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    # Shared across workers, so the limits hold for the whole deployment. Accepts any client with
+    # the redis.asyncio eval API.
+    def __init__(self, client, prefix: str = RATE_LIMIT_PREFIX):
+        self.client = client
+        self.prefix = prefix
+
+    async def take(self, key: str, rate: float, capacity: float, amount: float) -> float:
+        return await self._run(key, rate, capacity, amount, force=False)
+
+    async def debit(self, key: str, rate: float, capacity: float, amount: float) -> None:
+        await self._run(key, rate, capacity, amount, force=True)
+
+    def size(self) -> int:
+        return -1  # Unknown without a round trip
+
+    async def _run(self, key: str, rate: float, capacity: float, amount: float, force: bool) -> float:
+        wait = await self.client.eval(_TAKE_SCRIPT, 1, self.prefix + key, rate, capacity, amount, time.time(), "1" if force else "0")
+        return float(wait.decode() if isinstance(wait, bytes) else wait)
+
+
+def build_backend():
+    if RATE_LIMIT_BACKEND == "redis":
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the 'redis' package (pip install redis).")
+        return RedisBuckets(redis_asyncio.from_url(RATE_LIMIT_REDIS_URL))
+    return InProcessBuckets()
+
+
+class RateLimiter:
+    def __init__(self, backend=None, enabled: bool = RATE_LIMIT_ENABLED):
+        self.backend = backend if backend is not None else build_backend()
+        self.enabled = enabled
+        self.user_rps = RATE_LIMIT_USER_RPS
+        self.user_burst = RATE_LIMIT_USER_BURST
+        self.user_tokens_per_min = RATE_LIMIT_USER_TOKENS_PER_MIN
+        self.global_rps = RATE_LIMIT_GLOBAL_RPS
+        self.global_burst = RATE_LIMIT_GLOBAL_BURST
+        self.global_tokens_per_min = RATE_LIMIT_GLOBAL_TOKENS_PER_MIN
+        self.allowed = 0
+        self.rejected = {}  # reason -> count
+
+    def _limits(self, user_id: int):
+        # (reason, bucket key, refill per second, capacity) for every enabled bucket
+        if self.user_rps > 0:
+            yield "user_requests", f"req:user:{user_id}", self.user_rps, self.user_burst
+        if self.global_rps > 0:
+            yield "global_requests", "req:global", self.global_rps, self.global_burst
+        if self.user_tokens_per_min > 0:
+            yield "user_tokens", f"tok:user:{user_id}", self.user_tokens_per_min / 60, self.user_tokens_per_min
+        if self.global_tokens_per_min > 0:
+            yield "global_tokens", "tok:global", self.global_tokens_per_min / 60, self.global_tokens_per_min
+
+    async def check(self, user_id: int, estimated_tokens: int, requests: bool = True) -> None:
+        # Request buckets are charged one request; token buckets reserve the prompt estimate,
+        # which record_tokens settles against the actual usage once the reply is stored.
+        # requests=False: token buckets only, for the items of a batch (see check_batch).
+        # All or nothing: when a bucket rejects, what the earlier buckets took is given back.
+        if not self.enabled:
+            return
+        taken = []
+        for reason, key, rate, capacity, amount in self._charges(user_id, estimated_tokens, requests):
+            wait = await self.backend.take(key, rate, capacity, amount)
+            if wait > 0:
+                self.rejected[reason] = self.rejected.get(reason, 0) + 1
+                for _, key, rate, capacity, amount in taken:
+                    await self.backend.debit(key, rate, capacity, -amount)
+                raise RateLimited(reason, wait)
+            taken.append((reason, key, rate, capacity, amount))
+        self.allowed += 1
+
+    async def refund(self, user_id: int, estimated_tokens: int, requests: bool = True) -> None:
+        # Gives back everything a successful check took, for a request refused after it (the quota)
+        if not self.enabled:
+            return
+        for _, key, rate, capacity, amount in self._charges(user_id, estimated_tokens, requests):
+            await self.backend.debit(key, rate, capacity, -amount)
+        self.allowed -= 1
+
+    def _charges(self, user_id: int, estimated_tokens: int, requests: bool):
+        # (reason, bucket key, refill per second, capacity, amount) that check takes
+        for reason, key, rate, capacity in self._limits(user_id):
+            if reason.endswith("requests"):
+                if requests:
+                    yield reason, key, rate, capacity, 1
+            else:
+                yield reason, key, rate, capacity, min(estimated_tokens, capacity)
+
+    async def check_batch(self, user_ids: Iterable[int]) -> Dict[int, RateLimited]:
+        # A batch counts as one request: one from the global request bucket (raises RateLimited)
+        # and one from the request bucket of each of its users. Returns the users whose bucket is
+        # empty; their items are refused, the others go ahead.
+        if not self.enabled:
+            return {}
+        limited = {}
+        for reason, key, rate, capacity in self._limits(None):
+            if reason == "global_requests":
+                wait = await self.backend.take(key, rate, capacity, 1)
+                if wait > 0:
+                    self.rejected[reason] = self.rejected.get(reason, 0) + 1
+                    raise RateLimited(reason, wait)
+        for user_id in user_ids:
+            for reason, key, rate, capacity in self._limits(user_id):
+                if reason == "user_requests":
+                    wait = await self.backend.take(key, rate, capacity, 1)
+                    if wait > 0:
+                        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+                        limited[user_id] = RateLimited(reason, wait)
+        return limited
+
+    async def record_tokens(self, user_id: int, tokens: int, estimated_tokens: int) -> None:
+        if not self.enabled or tokens == estimated_tokens:
+            return
+        for reason, key, rate, capacity in self._limits(user_id):
+            if not reason.endswith("requests"):
+                reserved = min(estimated_tokens, capacity)
+                await self.backend.debit(key, rate, capacity, tokens - reserved)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "buckets": self.backend.size(),
+            "allowed": self.allowed,
+            "rejected": dict(self.rejected),
+        }
+
+
+class UsageQuota:
+    # Cached per-user token count for the current UTC day. A miss (or an entry older than the TTL)
+    # reads the user's single daily usage_rollups row; otherwise no database access at all.
+    # Tokens used through this worker are added locally as replies are stored.
+    def __init__(self, daily_tokens: int = QUOTA_DAILY_TOKENS, ttl: float = QUOTA_CACHE_TTL,
+                 max_entries: int = QUOTA_CACHE_MAX_ENTRIES):
+        self.daily_tokens = daily_tokens
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, list]" = OrderedDict()  # user_id -> [day, tokens, loaded_at]
+        self.reads = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.daily_tokens > 0
+
+    async def check(self, db: AsyncSession, user_id: int, prompt_tokens: int = 0) -> None:
+        # Rejects a request whose prompt (counted locally, see tokens.py) would take the user past
+        # the day's quota, as well as any request once the quota is used up.
+        if not self.enabled:
+            return
+        day = bucket_start("day", utcnow())
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] != day or entry[2] + self.ttl < time.monotonic():
+            entry = await self._load(db, user_id, day)
+        self._entries.move_to_end(user_id)
+        if entry[1] >= self.daily_tokens or entry[1] + prompt_tokens > self.daily_tokens:
+            self.rejected += 1
+            raise RateLimited("daily_quota", (day + timedelta(days=1) - utcnow()).total_seconds())
+
+    def add(self, user_id: int, tokens: int) -> None:
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] == bucket_start("day", utcnow()):
+            entry[1] += tokens
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "daily_tokens": self.daily_tokens,
+            "entries": len(self._entries),
+            "reads": self.reads,
+            "rejected": self.rejected,
+        }
+
+    async def _load(self, db: AsyncSession, user_id: int, day) -> list:
+        rollup = models.UsageRollup
+        tokens = (await db.execute(
+            select(rollup.tokens_used)
+            .where(rollup.user_id == user_id, rollup.period == "day", rollup.bucket_start == day)
+        )).scalar() or 0
+        self.reads += 1
+        entry = self._entries[user_id] = [day, tokens, time.monotonic()]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+
+rate_limiter = RateLimiter()
+usage_quota = UsageQuota()
@@ -1,6 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 # --- Base Models ---
 class TokenData(BaseModel):
@@ -31,6 +31,7 @@ class Message(MessageBase):
     chat_id: int
     created_at: datetime
     token_usage: Optional[int] = None
+    model: Optional[str] = None
 
     class Config:
         orm_mode = True
@@ -55,14 +56,60 @@ class ChatCompletionRequest(BaseModel):
     message: str = Field(..., example="Hello, how are you?")
     user_id: int = Field(1, description="ID of the user sending the message. For now, defaults to 1.")
     chat_id: Optional[int] = Field(None, description="ID of the existing chat session. If None, a new chat will be created.")
+    temperature: Optional[float] = Field(None, ge=0, le=2, description="Sampling temperature passed to the model. Provider default if omitted.")
+    top_p: Optional[float] = Field(None, gt=0, le=1, description="Nucleus sampling cutoff passed to the model. Provider default if omitted.")
+    max_tokens: Optional[int] = Field(None, gt=0, description="Upper bound on reply tokens. Provider default if omitted.")
+    model: Optional[str] = Field(None, description="Model id, or a provider prefix such as 'openai/', to restrict routing to. Any configured model if omitted.")
 
 class ChatCompletionResponse(BaseModel):
     reply: Optional[str] = None
     chat_id: int
     user_message_id: int
     ai_message_id: Optional[int] = None
+    model: Optional[str] = None
     error: Optional[str] = None
 
+class ChatBatchRequest(BaseModel):
+    items: List[Dict[str, Any]] = Field(..., description="ChatCompletionRequest bodies. Each is validated on its own: an invalid item fails only itself.")
+    concurrency: Optional[int] = Field(None, gt=0, description="Upstream calls in flight for this batch, at most BATCH_CONCURRENCY (the default).")
+
+# Read-side list endpoints. Pages are newest-first; pass next_cursor back as ?cursor= for the
+# following (older) page. next_cursor is None on the last page.
+class ChatSummary(BaseModel):
+    id: int
+    title: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+class ChatPage(BaseModel):
+    items: List[ChatSummary]
+    next_cursor: Optional[str] = None
+
+class MessageItem(BaseModel):
+    id: int
+    sender_type: str
+    content: str
+    created_at: Optional[datetime] = None
+    token_usage: Optional[int] = None
+    model: Optional[str] = None
+
+class MessagePage(BaseModel):
+    items: List[MessageItem]
+    next_cursor: Optional[str] = None
+
+# Search results are ordered by relevance (best first) instead; next_cursor works the same way.
+class SearchHit(BaseModel):
+    id: int
+    chat_id: int
+    chat_title: Optional[str] = None
+    sender_type: str
+    created_at: Optional[datetime] = None
+    rank: float
+    highlight: str = Field(..., description="Matching fragments, with matched words wrapped in <mark></mark>. Not HTML-escaped.")
+
+class SearchPage(BaseModel):
+    items: List[SearchHit]
+    next_cursor: Optional[str] = None
+
 class UsageBase(BaseModel):
     tokens_used: int
 
@@ -73,10 +120,35 @@ class Usage(UsageBase):
     id: int
     user_id: int
     timestamp: datetime
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    prompt_tokens_saved: Optional[int] = None
+    upstream_ms: Optional[int] = None
 
     class Config:
         orm_mode = True
 
+class UsageBucket(BaseModel):
+    bucket_start: datetime
+    tokens_used: int
+    requests: int
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    prompt_tokens_saved: int = 0  # By sending a summary instead of older history
+
+class UsageSummary(BaseModel):
+    user_id: int
+    hourly: List[UsageBucket]
+    hourly_tokens_used: int
+    hourly_prompt_tokens: int = 0
+    hourly_completion_tokens: int = 0
+    hourly_prompt_tokens_saved: int = 0
+    daily: List[UsageBucket]
+    daily_tokens_used: int
+    daily_prompt_tokens: int = 0
+    daily_completion_tokens: int = 0
+    daily_prompt_tokens_saved: int = 0
+
 class LogBase(BaseModel):
     level: str
     message: str
@@ -0,0 +1,209 @@
+# Full-text search over a user's messages.
+#
+# PostgreSQL matches `messages.search_vector` (a tsvector kept current by a trigger, with a GIN
+# index; see models.MESSAGE_SEARCH_DDL) against websearch_to_tsquery, so queries take the usual
+# search-box syntax: words (all must match), "quoted phrases", `or`, and -excluded words. Results
+# are ranked with ts_rank_cd and highlighted with ts_headline. SQLite, for local runs and tests,
+# uses an FTS5 table with bm25 ranking and snippet() instead; the same query syntax is translated
+# to FTS5's.
+#
+# A search only sees the user's own chats (chats.user_id). Pages are keyset-paginated on
+# (rank, message id), so deeper pages cost the same as the first.
+#
+# Messages written before the search migration have no vector until they are indexed with:
+#   python -m backend.search backfill [--chunk-size 5000]
+import argparse
+import base64
+import os
+import re
+from typing import Optional, Tuple
+
+from sqlalchemy import select, text
+
+from .config import load_env_file
+
+if __name__ == "__main__":
+    load_env_file()  # Before .database reads DATABASE_URL
+
+from . import models
+from .database import IS_SQLITE, engine
+
+# --- Search Configuration ---
+# The text search configuration the trigger indexes with; changing it needs a re-index.
+SEARCH_CONFIG = "english"
+HIGHLIGHT_START = "<mark>"  # Around matched words in `highlight`; content is not HTML-escaped
+HIGHLIGHT_STOP = "</mark>"
+HIGHLIGHT_MAX_WORDS = 32  # Length of each highlighted fragment
+SEARCH_MAX_QUERY_LENGTH = 256
+# Users with at most this many messages are searched by checking each of their messages' stored
+# vector; larger histories go through the GIN index.
+SEARCH_SCAN_MAX_MESSAGES = int(os.getenv("SEARCH_SCAN_MAX_MESSAGES", "10000"))
+BACKFILL_CHUNK_SIZE = 5000
+
+HEADLINE_OPTIONS = (
+    f'StartSel="{HIGHLIGHT_START}", StopSel="{HIGHLIGHT_STOP}", MaxWords={HIGHLIGHT_MAX_WORDS}, '
+    f'MinWords={HIGHLIGHT_MAX_WORDS // 2}, MaxFragments=2, FragmentDelimiter=" … "'
+)
+RESULT_COLUMNS = ["id", "chat_id", "chat_title", "sender_type", "created_at", "rank", "highlight"]
+
+_POSTGRES_MATCHES = f"""
+    SELECT m.id, m.chat_id, m.sender_type, m.created_at,
+           ts_rank_cd(m.search_vector, websearch_to_tsquery('{SEARCH_CONFIG}', :query)) AS rank
+    FROM messages m
+    WHERE m.chat_id = ANY(ARRAY(SELECT id FROM chats WHERE user_id = :user_id))
+      AND m.search_vector @@ websearch_to_tsquery('{SEARCH_CONFIG}', :query)
+"""
+_POSTGRES_AFTER = (
+    f" AND (ts_rank_cd(m.search_vector, websearch_to_tsquery('{SEARCH_CONFIG}', :query)), m.id)"
+    " < (CAST(:after_rank AS real), :after_id)"
+)
+# Highlights and chat titles are looked up for the page only: ts_headline re-parses each message
+_POSTGRES_PAGE = f"""
+    SELECT page.id, page.chat_id, c.title AS chat_title, page.sender_type, page.created_at, page.rank,
+           ts_headline('{SEARCH_CONFIG}', m.content, websearch_to_tsquery('{SEARCH_CONFIG}', :query),
+                       :headline_options) AS highlight
+    FROM ({{matches}} ORDER BY rank DESC, m.id DESC LIMIT :limit) AS page
+    JOIN messages m ON m.id = page.id
+    JOIN chats c ON c.id = page.chat_id
+    ORDER BY page.rank DESC, page.id DESC
+"""
+# How the next search in this transaction is planned (see search_messages), in one round trip
+_POSTGRES_PLAN_SETTINGS = text("""
+    SELECT set_config('plan_cache_mode', 'force_custom_plan', true),
+           set_config('enable_bitmapscan', CASE WHEN (
+               SELECT count(*) FROM (
+                   SELECT 1 FROM messages WHERE chat_id = ANY(ARRAY(SELECT id FROM chats WHERE user_id = :user_id))
+                   LIMIT :scan_max + 1
+               ) AS mine) > :scan_max THEN 'on' ELSE 'off' END, true)
+""")
+
+# bm25() is lower for better matches; it is negated so both backends rank higher-is-better
+_SQLITE_PAGE = f"""
+    SELECT m.id, m.chat_id, c.title AS chat_title, m.sender_type, m.created_at, -bm25(messages_fts) AS rank,
+           snippet(messages_fts, 0, '{HIGHLIGHT_START}', '{HIGHLIGHT_STOP}', '…', {HIGHLIGHT_MAX_WORDS}) AS highlight
+    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid JOIN chats c ON c.id = m.chat_id
+    WHERE messages_fts MATCH :query AND c.user_id = :user_id{{after}}
+    ORDER BY rank DESC, m.id DESC LIMIT :limit
+"""
+_SQLITE_AFTER = " AND (-bm25(messages_fts), m.id) < (:after_rank, :after_id)"
+
+_QUERY_TERM = re.compile(r'(-?)"([^"]*)"?|(\S+)')
+
+
+def fts5_query(query: str) -> str:
+    # Translates the websearch syntax into an FTS5 expression with every term quoted, so user
+    # input never reaches FTS5's own operators. Returns "" when nothing is searchable.
+    terms, excluded = [], []
+    pending_or = False
+    for negated, phrase, word in _QUERY_TERM.findall(query):
+        if word:
+            if word.lower() == "or" and terms:
+                pending_or = True
+                continue
+            negated, phrase = ("-", word[1:]) if word.startswith("-") else ("", word)
+        phrase = phrase.replace('"', "").strip()
+        if not phrase:
+            continue
+        quoted = f'"{phrase}"'
+        if negated:
+            excluded.append(quoted)
+        elif pending_or:
+            terms[-1] = f"({terms[-1]} OR {quoted})"
+        else:
+            terms.append(quoted)
+        pending_or = False
+    if not terms:
+        return ""  # FTS5 cannot match on exclusions alone
+    return " AND ".join(terms) + "".join(f" NOT {e}" for e in excluded)
+
+
+def encode_cursor(rank: float, message_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{rank!r}:{message_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    # Raises ValueError for a cursor this module did not produce
+    if not cursor:
+        return None
+    rank, message_id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+    return float(rank), int(message_id)
+
+
+def search_statement(user_id: int, query: str, after: Optional[Tuple[float, int]], limit: int):
+    # One page of matches, best first: RESULT_COLUMNS rows. `after` is the (rank, id) of the last
+    # row of the previous page. Returns None when the query has nothing to search for.
+    params = {"user_id": user_id, "limit": limit}
+    if after is not None:
+        params["after_rank"], params["after_id"] = after
+    if IS_SQLITE:
+        match = fts5_query(query)
+        if not match:
+            return None
+        sql = _SQLITE_PAGE.format(after=_SQLITE_AFTER if after is not None else "")
+        params["query"] = match
+    else:
+        sql = _POSTGRES_PAGE.format(matches=_POSTGRES_MATCHES + (_POSTGRES_AFTER if after is not None else ""))
+        params.update(query=query, headline_options=HEADLINE_OPTIONS)
+    # Typed so SQLite's created_at text comes back as a datetime, as on PostgreSQL
+    return text(sql).bindparams(**params).columns(created_at=models.Message.created_at.type)
+
+
+async def search_messages(db, user_id: int, query: str, after: Optional[Tuple[float, int]], limit: int) -> list:
+    # `db`: an AsyncSession or AsyncConnection
+    statement = search_statement(user_id, query, after, limit)
+    if statement is None:
+        return []
+    if not IS_SQLITE:
+        # PostgreSQL underestimates GIN scans: for a word found in a large share of all messages,
+        # it would read the word's whole posting list to find the few hundred messages of one
+        # user. Checking the stored vectors of the user's own messages takes a few ms per
+        # thousand messages whatever the words, so that is forced (GIN needs bitmap scans) unless
+        # the user has more than SEARCH_SCAN_MAX_MESSAGES. And since the driver prepares
+        # statements, this transaction is planned per query (PostgreSQL 12+): the generic plan
+        # PostgreSQL switches to after a few executions ignores how common the words are.
+        await db.execute(_POSTGRES_PLAN_SETTINGS, {"user_id": user_id, "scan_max": SEARCH_SCAN_MAX_MESSAGES})
+    return (await db.execute(statement)).all()
+
+
+# --- Backfill ---
+def backfill(chunk_size: int = BACKFILL_CHUNK_SIZE) -> int:
+    # PostgreSQL: sets the vector of messages written before the search migration, in id order,
+    # one chunk per transaction (new and edited messages are indexed by the trigger).
+    # SQLite: rebuilds the FTS5 index from the messages table in one go.
+    if IS_SQLITE:
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+            return conn.execute(text("SELECT count(*) FROM messages")).scalar()
+    message = models.Message
+    indexed = 0
+    after_id = 0
+    while True:
+        with engine.begin() as conn:
+            ids = conn.execute(
+                select(message.id).where(message.id > after_id, text("search_vector IS NULL"))
+                .order_by(message.id).limit(chunk_size)
+            ).scalars().all()
+            if ids:
+                conn.execute(
+                    text(f"UPDATE messages SET search_vector = to_tsvector('{SEARCH_CONFIG}', content) "
+                         "WHERE id = ANY(:ids)").bindparams(ids=ids),
+                )
+        indexed += len(ids)
+        if len(ids) < chunk_size:
+            return indexed
+        after_id = ids[-1]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Full-text search index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = commands.add_parser("backfill", help="Index messages written before the search migration")
+    backfill_parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        print(f"Indexed {backfill(args.chunk_size)} messages.")
+
+
+if __name__ == "__main__":
+    main()
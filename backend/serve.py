@@ -0,0 +1,96 @@
+# Production launcher: migrations as a one-shot leader step, then a multi-worker uvicorn server.
+#
+#   python -m backend.serve                  # migrate, then serve on $HOST:$PORT
+#   python -m backend.serve --no-migrate     # when migrations run as their own deploy job
+#                                            # (python -m backend.migrations)
+#
+# Workers default to the CPUs this process may run on (WEB_CONCURRENCY overrides). Each worker is
+# a separate process with its own caches, database pool (DB_POOL_SIZE + DB_MAX_OVERFLOW per
+# worker) and background tasks, so size the PostgreSQL connection limit for all of them. uvloop
+# and httptools are used when installed (they come with uvicorn[standard]).
+#
+# On SIGTERM or SIGINT the workers stop accepting connections and let in-flight requests,
+# streamed replies included, finish for up to SHUTDOWN_TIMEOUT seconds. Then the app's shutdown
+# hooks drain the write-behind queue and the log sink before closing the upstream client and the
+# database pool. Give the container at least that long to stop (docker-compose stop_grace_period).
+import argparse
+import importlib.util
+import os
+
+from .config import load_env_file
+
+if __name__ == "__main__":
+    load_env_file()  # Before the configuration below is read; the workers inherit the environment
+
+# --- Server Configuration ---
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "0"))  # 0: one worker per available CPU
+SHUTDOWN_TIMEOUT = int(os.getenv("SHUTDOWN_TIMEOUT", "30"))  # Seconds to finish in-flight requests
+KEEPALIVE_TIMEOUT = int(os.getenv("KEEPALIVE_TIMEOUT", "5"))
+BACKLOG = int(os.getenv("BACKLOG", "2048"))
+SERVER_LOG_LEVEL = os.getenv("SERVER_LOG_LEVEL", "info")
+ACCESS_LOG = os.getenv("ACCESS_LOG", "false").lower() in ("1", "true", "yes")  # A line per request costs throughput
+APP = "backend.main:app"
+
+
+def available_cpus() -> int:
+    # Honors CPU affinity (e.g. a cpuset-limited container), unlike os.cpu_count()
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def worker_count(requested: int = WEB_CONCURRENCY) -> int:
+    workers = requested if requested > 0 else available_cpus()
+    sqlite = os.getenv("DATABASE_URL", "").startswith("sqlite")
+    write_behind = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() in ("1", "true", "yes")
+    if workers > 1 and sqlite and write_behind:
+        # Write-behind ids continue from max(id) inside the process on SQLite (see write_behind.py)
+        print("WRITE_BEHIND_ENABLED on SQLite needs a single worker; starting 1 instead of "
+              f"{workers}.")
+        return 1
+    return workers
+
+
+def _installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the chat API with multiple workers")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY, help="0: one per available CPU")
+    parser.add_argument("--no-migrate", action="store_true", help="Skip the migration step")
+    args = parser.parse_args()
+
+    if not args.no_migrate:
+        # Imported here so a --no-migrate launcher never loads SQLAlchemy or Alembic itself
+        from .migrations import upgrade_to_head
+        upgrade_to_head()
+
+    import uvicorn
+
+    loop = "uvloop" if _installed("uvloop") else "asyncio"
+    http = "httptools" if _installed("httptools") else "h11"
+    workers = worker_count(args.workers)
+    print(f"Serving {APP} on {args.host}:{args.port} with {workers} worker(s), loop={loop}, http={http}.")
+    uvicorn.run(
+        APP,
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        loop=loop,
+        http=http,
+        backlog=BACKLOG,
+        timeout_keep_alive=KEEPALIVE_TIMEOUT,
+        timeout_graceful_shutdown=SHUTDOWN_TIMEOUT,
+        log_level=SERVER_LOG_LEVEL,
+        access_log=ACCESS_LOG,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from . import metrics
+
+# --- Server-Timing Configuration ---
+# Per-request stage durations (rate limits, history, upstream call, persistence, ...), reported in
+# a Server-Timing response header so load tests (backend/bench/chat_load.py) and browser dev tools
+# can break a request's latency down by stage. Off by default: it exposes internal timings.
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "false").lower() in ("1", "true", "yes")
+
+
+class StageTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}  # name -> seconds, summed if a stage runs more than once
+
+    def header(self) -> str:
+        # Streaming responses send their headers early, so their "total" is the time to first byte.
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        return ", ".join(entries)
+
+
+_current: ContextVar[Optional[StageTimer]] = ContextVar("stage_timer", default=None)
+
+
+def start_request() -> Optional[StageTimer]:
+    if not SERVER_TIMING_ENABLED:
+        return None
+    timer = StageTimer()
+    _current.set(timer)
+    return timer
+
+
+@contextmanager
+def stage(name: str):
+    # Times the block as `name`: into the stage histogram on /metrics, the current request's
+    # Server-Timing header and, when tracing is on, a span. A no-op when all three are off.
+    timer = _current.get()
+    if timer is None and not metrics.METRICS_ENABLED and not metrics.OTEL_TRACING_ENABLED:
+        yield
+        return
+    metrics.observe_stage_connections(name)
+    started = time.perf_counter()
+    try:
+        with metrics.span(name):
+            yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.stage_seconds.observe(elapsed, name)
+        if timer is not None:
+            timer.stages[name] = timer.stages.get(name, 0.0) + elapsed
+
+
+class ServerTimingMiddleware:
+    # Plain ASGI middleware (not BaseHTTPMiddleware, which would buffer streamed replies through an
+    # extra task): starts a timer per HTTP request and adds its header to the response.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timer = start_request()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and timer is not None:
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timer.header().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
+
+
+def parse_header(value: str) -> Dict[str, float]:
+    # "db;dur=1.2, total;dur=5" -> {"db": 1.2, "total": 5.0} (milliseconds)
+    stages = {}
+    for entry in value.split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, number = param.strip().partition("=")
+            if key == "dur" and name:
+                stages[name] = float(number)
+    return stages
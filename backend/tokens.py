@@ -0,0 +1,137 @@
+# Local token counting, so prompts can be budgeted and limits enforced before anything is sent
+# upstream.
+#
+# TOKENIZER picks the counter: `approx` (default) estimates from the UTF-8 length, about four
+# bytes per token, which is close for English and errs high rather than low for other scripts;
+# `tiktoken` counts exactly with a BPE encoding (TOKENIZER_ENCODING) when the `tiktoken` package
+# is installed. Other tokenizers can be added with register_tokenizer(). Every model is counted
+# with the same tokenizer: the counts budget the history window and the rate limits, while the
+# tokens billed still come from the upstream `usage`.
+#
+# Each message's count is stored on its row (Message.token_count) when it is written, so building
+# the history window adds up integers instead of re-tokenizing the chat. Rows written before the
+# column existed are counted on read; fill them in with:
+#   python -m backend.tokens backfill [--chunk-size 5000] [--recount]
+import argparse
+import os
+from typing import Callable, Dict, List
+
+from sqlalchemy import bindparam, select, update
+
+from .config import load_env_file
+
+if __name__ == "__main__":
+    load_env_file()  # Before .database reads DATABASE_URL
+
+from . import models
+from .database import engine
+
+# --- Tokenizer Configuration ---
+TOKENIZER = os.getenv("TOKENIZER", "approx")  # 'approx' or 'tiktoken'
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")  # tiktoken encoding
+MESSAGE_MAX_TOKENS = int(os.getenv("MESSAGE_MAX_TOKENS", "0"))  # Longest accepted user message; 0: no limit
+# Chat format overhead: role and delimiters per message, plus the priming of the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+BACKFILL_CHUNK_SIZE = 5000
+
+
+class ApproxTokenizer:
+    name = "approx"
+
+    def count(self, text: str) -> int:
+        return len(text.encode("utf-8")) // 4 + 1
+
+
+class TiktokenTokenizer:
+    name = "tiktoken"
+
+    def __init__(self, encoding: str = TOKENIZER_ENCODING):
+        import tiktoken
+        self._encoding = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str) -> int:
+        # Special-token text in a message is counted as plain text rather than rejected
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+TOKENIZERS: Dict[str, Callable[[], object]] = {"approx": ApproxTokenizer, "tiktoken": TiktokenTokenizer}
+
+
+def register_tokenizer(name: str, factory: Callable[[], object]) -> None:
+    # factory() returns an object with a `name` and a count(text) -> int method
+    TOKENIZERS[name] = factory
+
+
+def build_tokenizer(name: str = TOKENIZER):
+    if name not in TOKENIZERS:
+        raise RuntimeError(f"Unknown TOKENIZER '{name}'; expected one of: {', '.join(sorted(TOKENIZERS))}.")
+    try:
+        return TOKENIZERS[name]()
+    except ImportError:
+        print(f"TOKENIZER={name} needs a package that is not installed (pip install {name}). "
+              "Falling back to the approximate tokenizer.")
+    except Exception as e:
+        # e.g. tiktoken downloads its encoding on first use and the host is offline
+        print(f"TOKENIZER={name} could not be loaded ({e}). Falling back to the approximate tokenizer.")
+    return ApproxTokenizer()
+
+
+tokenizer = build_tokenizer()
+
+
+def count_tokens(text: str) -> int:
+    return tokenizer.count(text)
+
+
+def prompt_tokens(messages: List[dict]) -> int:
+    # Prompt size of a context window (history.py entries, each with its stored "tokens")
+    return sum(m["tokens"] + MESSAGE_OVERHEAD_TOKENS for m in messages) + REPLY_PRIMING_TOKENS
+
+
+def stats() -> dict:
+    return {"tokenizer": tokenizer.name, "message_max_tokens": MESSAGE_MAX_TOKENS}
+
+
+# --- Backfill ---
+def backfill(chunk_size: int = BACKFILL_CHUNK_SIZE, recount: bool = False) -> int:
+    # Counts messages without a stored token_count (or, with recount, every message, e.g. after
+    # changing TOKENIZER) in id order, one chunk per transaction.
+    message = models.Message
+    counted = 0
+    after_id = 0
+    while True:
+        query = select(message.id, message.content).where(message.id > after_id)
+        if not recount:
+            query = query.where(message.token_count.is_(None))
+        with engine.begin() as conn:
+            rows = conn.execute(query.order_by(message.id).limit(chunk_size)).all()
+            if rows:
+                conn.execute(
+                    update(message.__table__).where(message.__table__.c.id == bindparam("row_id")),
+                    [{"row_id": row.id, "token_count": count_tokens(row.content)} for row in rows],
+                )
+        counted += len(rows)
+        if len(rows) < chunk_size:
+            return counted
+        after_id = rows[-1].id
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local token counting")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = commands.add_parser("backfill", help="Store token counts of messages written without one")
+    backfill_parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE)
+    backfill_parser.add_argument("--recount", action="store_true", help="Recount every message")
+    count_parser = commands.add_parser("count", help="Count the tokens of a text")
+    count_parser.add_argument("text")
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        print(f"Counted {backfill(args.chunk_size, args.recount)} messages with the {tokenizer.name} tokenizer.")
+    elif args.command == "count":
+        print(count_tokens(args.text))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+# Streaming bulk export and import of conversations (users, chats and their messages).
+#
+#   python -m backend.transfer export [--user-id N] [--compress gzip|zstd] [--out FILE]
+#   python -m backend.transfer import FILE [--compress gzip|zstd]
+# The same streams are served by GET/POST /api/v1/admin/export and /api/v1/admin/import (main.py).
+#
+# Format: NDJSON, one record per line with a "type" of "user", "chat" or "message". Users come
+# first, then every chat immediately followed by its messages (oldest first):
+#   {"type":"chat","id":12,"user_id":3,"title":"...","created_at":"2026-10-01T09:30:00+00:00"}
+#   {"type":"message","id":881,"chat_id":12,"sender_type":"user","content":"...",...}
+#
+# Export reads chats and messages through two server-side cursors (yield_per batches) and merges
+# them by chat id, so memory stays constant for any dataset size. Import keeps user ids (they are
+# the caller-supplied ids of the API; a user whose username already belongs to another id in the
+# target is merged into that user) but gives chats and messages new ids, allocated in blocks
+# from the target's sequences, and loads each batch with COPY on PostgreSQL (executemany on
+# SQLite). The whole import runs in one transaction: a bad line rolls everything back.
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from sqlalchemy import Text, cast, func, literal_column, select, text
+from sqlalchemy.exc import DBAPIError
+
+from .config import load_env_file
+
+if __name__ == "__main__":
+    load_env_file()  # Before .database reads DATABASE_URL
+
+from . import models
+from .database import IS_SQLITE, async_engine, dialect_insert
+from .tokens import count_tokens
+
+# --- Transfer Configuration ---
+TRANSFER_BATCH = int(os.getenv("TRANSFER_BATCH", "10000"))  # Rows per cursor fetch / per COPY
+TRANSFER_CHUNK_BYTES = int(os.getenv("TRANSFER_CHUNK_BYTES", "262144"))  # Output is yielded in chunks of this size
+TRANSFER_GZIP_LEVEL = int(os.getenv("TRANSFER_GZIP_LEVEL", "1"))  # Fast; higher levels cost throughput
+TRANSFER_ZSTD_LEVEL = int(os.getenv("TRANSFER_ZSTD_LEVEL", "3"))
+# PostgreSQL: skip the per-row foreign key triggers while importing (session_replication_role =
+# replica, for the import transaction only). The importer checks chat and user references itself;
+# this roughly halves the cost of COPY into messages but needs a privileged role.
+TRANSFER_SKIP_FK_TRIGGERS = os.getenv("TRANSFER_SKIP_FK_TRIGGERS", "false").lower() in ("1", "true", "yes")
+
+COMPRESSIONS = ("gzip", "zstd")
+MEDIA_TYPES = {None: "application/x-ndjson", "gzip": "application/gzip", "zstd": "application/zstd"}
+EXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+
+USER_COLUMNS = ("id", "username", "created_at")
+CHAT_COLUMNS = ("id", "user_id", "title", "created_at")
+MESSAGE_COLUMNS = ("id", "chat_id", "sender_type", "content", "created_at", "token_usage", "model", "token_count")
+
+
+class TransferError(ValueError):
+    pass
+
+
+# --- Compression ---
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd compression requires the 'zstandard' package.")
+    return zstandard
+
+
+def compressor(compression: Optional[str]):
+    # An object with compress(bytes) and flush(), or None for plain NDJSON.
+    if compression is None:
+        return None
+    if compression == "gzip":
+        return zlib.compressobj(TRANSFER_GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip framing
+    if compression == "zstd":
+        return _zstandard().ZstdCompressor(level=TRANSFER_ZSTD_LEVEL).compressobj()
+    raise TransferError(f"Unknown compression {compression!r}; use one of {', '.join(COMPRESSIONS)}.")
+
+
+def decompressor(compression: Optional[str]):
+    if compression is None:
+        return None
+    if compression == "gzip":
+        return zlib.decompressobj(31)
+    if compression == "zstd":
+        return _zstandard().ZstdDecompressor().decompressobj()
+    raise TransferError(f"Unknown compression {compression!r}; use one of {', '.join(COMPRESSIONS)}.")
+
+
+def compression_for_path(path: str) -> Optional[str]:
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+# --- Export ---
+def _json_line(kind: str, table, columns: tuple):
+    # The record rendered to JSON text by the database (json_build_object / SQLite's json_object):
+    # much cheaper than building a dict and encoding it in Python for every row. Timestamps come
+    # out as ISO 8601 text (with the UTC offset on PostgreSQL).
+    build = func.json_object if IS_SQLITE else func.json_build_object
+    arguments = [literal_column("'type'"), literal_column(f"'{kind}'")]
+    for column in columns:
+        arguments += [literal_column(f"'{column}'"), table.c[column]]
+    return cast(build(*arguments), Text).label("line")  # Text, not json: no decoding on the way out
+
+
+async def _stream(query, batch_size: int) -> AsyncIterator[list]:
+    # Batches of rows from a server-side cursor on a connection of its own.
+    async with async_engine.connect() as conn:
+        result = await conn.stream(query.execution_options(yield_per=batch_size))
+        async for rows in result.partitions():
+            yield rows
+
+
+def _export_queries(user_id: Optional[int]):
+    users_table, chats_table, messages_table = models.User.__table__, models.Chat.__table__, models.Message.__table__
+    users = select(_json_line("user", users_table, USER_COLUMNS)).order_by(users_table.c.id)
+    chats = select(chats_table.c.id, _json_line("chat", chats_table, CHAT_COLUMNS)).order_by(chats_table.c.id)
+    # (chat_id, created_at, id) is the order of ix_messages_chat_id_created_at: no sort needed
+    messages = select(messages_table.c.chat_id, _json_line("message", messages_table, MESSAGE_COLUMNS)).order_by(
+        messages_table.c.chat_id, messages_table.c.created_at, messages_table.c.id
+    )
+    if user_id is not None:
+        users = users.where(users_table.c.id == user_id)
+        chats = chats.where(chats_table.c.user_id == user_id)
+        messages = messages.where(
+            messages_table.c.chat_id.in_(select(chats_table.c.id).where(chats_table.c.user_id == user_id))
+        )
+    return users, chats, messages
+
+
+async def export_records(user_id: Optional[int] = None, batch_size: int = TRANSFER_BATCH) -> AsyncIterator[list]:
+    # Batches of NDJSON lines (str, without the newline), in file order.
+    users, chats, messages = _export_queries(user_id)
+    async for rows in _stream(users, batch_size):
+        yield [row[0] for row in rows]
+
+    # Chats and messages are both ordered by chat id: walk them side by side, emitting each chat
+    # and then the messages that belong to it. Messages of chats created after the chat cursor
+    # was opened (they sort last) are left out, along with their chats.
+    message_batches = _stream(messages, batch_size).__aiter__()
+    pending: list = []
+    position = 0
+    exhausted = False
+    lines: List[str] = []
+    try:
+        async for chat_rows in _stream(chats, batch_size):
+            for chat_id, chat_line in chat_rows:
+                lines.append(chat_line)
+                while not exhausted:
+                    if position == len(pending):
+                        try:
+                            pending, position = await message_batches.__anext__(), 0
+                        except StopAsyncIteration:
+                            exhausted = True
+                            break
+                    message = pending[position]
+                    if message[0] != chat_id:
+                        break
+                    lines.append(message[1])
+                    position += 1
+                    if len(lines) >= batch_size:  # A long chat must not pile up in memory
+                        yield lines
+                        lines = []
+            if lines:
+                yield lines
+                lines = []
+    finally:
+        await message_batches.aclose()
+
+
+async def export_stream(user_id: Optional[int] = None, compression: Optional[str] = None,
+                        batch_size: int = TRANSFER_BATCH) -> AsyncIterator[bytes]:
+    # The export as (optionally compressed) byte chunks of about TRANSFER_CHUNK_BYTES.
+    packer = compressor(compression)
+    buffered: List[str] = []
+    size = 0
+    async for lines in export_records(user_id, batch_size):
+        buffered.extend(lines)
+        size += sum(map(len, lines))
+        if size >= TRANSFER_CHUNK_BYTES:
+            data = ("\n".join(buffered) + "\n").encode()
+            buffered, size = [], 0
+            data = packer.compress(data) if packer else data
+            if data:
+                yield data
+    data = ("\n".join(buffered) + "\n").encode() if buffered else b""
+    if packer:
+        data = packer.compress(data) + packer.flush()
+    if data:
+        yield data
+
+
+# --- Import ---
+async def _lines(chunks: AsyncIterator[bytes], compression: Optional[str]) -> AsyncIterator[list]:
+    # Complete lines (bytes) from a stream of (optionally compressed) chunks.
+    unpacker = decompressor(compression)
+    rest = b""
+    async for chunk in chunks:
+        if unpacker:
+            chunk = unpacker.decompress(chunk)
+        if not chunk:
+            continue
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        yield lines
+    if unpacker and hasattr(unpacker, "flush"):
+        rest += unpacker.flush()
+    if rest.strip():
+        yield [rest]
+
+
+def _parse(lines: List[bytes], first_line: int) -> List[dict]:
+    # The whole batch is parsed as one JSON array, which avoids a json.loads call per line; when
+    # that fails (or a line holds more than one value) each line is parsed to find the culprit.
+    records = [line for line in lines if line.strip()]
+    try:
+        parsed = json.loads(b"[" + b",".join(records) + b"]")
+        if len(parsed) == len(records):
+            return parsed
+    except ValueError:
+        pass
+    for number, line in enumerate(lines, first_line):
+        if line.strip():
+            try:
+                json.loads(line)
+            except ValueError as e:
+                raise TransferError(f"Line {number} is not valid JSON: {e}")
+    raise TransferError(f"Lines {first_line} to {first_line + len(lines) - 1} are not valid NDJSON.")
+
+
+_FRACTION = re.compile(r"\.(\d{1,6})")
+
+
+def _timestamp(value: Optional[str]) -> Optional[datetime]:
+    # Everything is stored in UTC; naive timestamps (exported from SQLite) are UTC too.
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        # Python < 3.11 only takes 3 or 6 fraction digits; PostgreSQL drops trailing zeros
+        parsed = datetime.fromisoformat(_FRACTION.sub(lambda m: "." + m.group(1).ljust(6, "0"), value, 1))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+async def allocate_ids(conn, table: str, count: int) -> List[int]:
+    # New ids from the table's own sequence, so they never collide with the app's inserts.
+    # SQLite has no sequences; the import transaction holds the write lock, so max(id) is stable.
+    if IS_SQLITE:
+        start = ((await conn.execute(text(f"SELECT max(id) FROM {table}"))).scalar() or 0) + 1
+        return list(range(start, start + count))
+    # One array instead of `count` result rows
+    return (await conn.execute(
+        select(func.array_agg(func.nextval(func.pg_get_serial_sequence(table, "id"))))
+        .select_from(func.generate_series(1, count))
+    )).scalar()
+
+
+async def _copy(conn, table, columns: tuple, rows: List[tuple]) -> None:
+    if not rows:
+        return
+    if IS_SQLITE:
+        await conn.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+        return
+    # Binary COPY on the session's own asyncpg connection, inside the import transaction
+    raw = await conn.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(table.name, records=rows, columns=list(columns))
+
+
+class Importer:
+    def __init__(self, conn):
+        self.conn = conn
+        self.chat_ids: Dict[int, int] = {}  # exported chat id -> new chat id, for this batch's chats
+        self.user_ids: Set[int] = set()  # users in the file or found in the database
+        self.merged_users: Dict[int, int] = {}  # exported user id -> existing user id with its username
+        self.counts = {"users": 0, "chats": 0, "messages": 0, "users_merged": 0}
+
+    async def _check_users(self, user_ids: Set[int]) -> None:
+        # Chats may belong to users that are only in the target database. Checked here rather than
+        # left to the foreign key, which TRANSFER_SKIP_FK_TRIGGERS turns off.
+        unknown = user_ids - self.user_ids
+        if unknown:
+            found = set((await self.conn.execute(
+                select(models.User.id).where(models.User.id.in_(unknown))
+            )).scalars())
+            if unknown - found:
+                raise TransferError(f"Chats refer to users that are neither in the file nor in the database: "
+                                    f"{sorted(unknown - found)[:10]}")
+            self.user_ids |= found
+
+    async def _load_users(self, users: List[dict]) -> None:
+        # Users whose id exists in the target are left as they are. A user whose username belongs to
+        # another id there is merged into that user: its chats are imported under the existing id.
+        existing = (await self.conn.execute(select(models.User.id, models.User.username).where(
+            models.User.id.in_({u["id"] for u in users}) | models.User.username.in_({u["username"] for u in users})
+        ))).all()
+        existing_ids = {row.id for row in existing}
+        taken = {row.username: row.id for row in existing}
+        new_users = []
+        for u in users:
+            existing_id = taken.get(u["username"])
+            if u["id"] in existing_ids:
+                self.user_ids.add(u["id"])
+            elif existing_id is not None:
+                self.merged_users[u["id"]] = existing_id
+                self.user_ids.add(existing_id)
+                self.counts["users_merged"] += 1
+            else:
+                new_users.append({"id": u["id"], "username": u["username"],
+                                  "created_at": _timestamp(u.get("created_at"))})
+        if new_users:
+            # Only an id inserted meanwhile is skipped; any other conflict fails the import
+            await self.conn.execute(dialect_insert(models.User.__table__).on_conflict_do_nothing(index_elements=["id"]),
+                                    new_users)
+        self.user_ids.update(u["id"] for u in new_users)
+        self.counts["users"] += len(users)
+
+    async def load(self, records: List[dict]) -> None:
+        # One batch of parsed lines; a message's chat may be in this batch or an earlier one.
+        users, chats, messages = [], [], []
+        for record in records:
+            kind = record.get("type")
+            if kind == "message":
+                messages.append(record)
+            elif kind == "chat":
+                chats.append(record)
+            elif kind == "user":
+                users.append(record)
+            else:
+                raise TransferError(f"Unknown record type {kind!r}.")
+
+        if users:
+            await self._load_users(users)
+
+        if chats:
+            # Each chat is followed by its messages, so only the last chat of the previous batch
+            # (whose messages may continue in this one) is still needed.
+            last = list(self.chat_ids.items())[-1:]
+            self.chat_ids = dict(last)
+            for chat in chats:
+                chat["user_id"] = self.merged_users.get(chat["user_id"], chat["user_id"])
+            await self._check_users({chat["user_id"] for chat in chats})
+            new_ids = await allocate_ids(self.conn, "chats", len(chats))
+            rows = []
+            for new_id, chat in zip(new_ids, chats):
+                self.chat_ids[chat["id"]] = new_id
+                rows.append((new_id, chat["user_id"], chat.get("title"), _timestamp(chat.get("created_at"))))
+            await _copy(self.conn, models.Chat.__table__, CHAT_COLUMNS, rows)
+            self.counts["chats"] += len(rows)
+
+        if messages:
+            new_ids = await allocate_ids(self.conn, "messages", len(messages))
+            rows = []
+            chat_ids = self.chat_ids
+            for new_id, message in zip(new_ids, messages):
+                chat_id = chat_ids.get(message["chat_id"])
+                if chat_id is None:
+                    raise TransferError(f"Message {message['id']} belongs to chat {message['chat_id']}, "
+                                        "which is not the chat it follows in the file.")
+                # Exports from before token counts were stored are counted on the way in
+                token_count = message.get("token_count")
+                if token_count is None:
+                    token_count = count_tokens(message["content"])
+                rows.append((new_id, chat_id, message["sender_type"], message["content"],
+                             _timestamp(message.get("created_at")), message.get("token_usage"), message.get("model"),
+                             token_count))
+            await _copy(self.conn, models.Message.__table__, MESSAGE_COLUMNS, rows)
+            self.counts["messages"] += len(rows)
+
+
+async def import_stream(chunks: AsyncIterator[bytes], compression: Optional[str] = None,
+                        batch_size: int = TRANSFER_BATCH) -> dict:
+    # Imports an export stream and returns the number of users, chats and messages read.
+    async with async_engine.begin() as conn:
+        if TRANSFER_SKIP_FK_TRIGGERS and not IS_SQLITE:
+            try:
+                await conn.execute(text("SET LOCAL session_replication_role = replica"))
+            except DBAPIError:
+                raise RuntimeError("TRANSFER_SKIP_FK_TRIGGERS needs a role allowed to set session_replication_role "
+                                   "(a superuser, or SET privilege on PostgreSQL 15+).")
+        importer = Importer(conn)
+        pending: List[bytes] = []
+        line_number = 1  # Of the first pending line
+        async for lines in _lines(chunks, compression):
+            pending.extend(lines)
+            if len(pending) >= batch_size:
+                await _load(importer, _parse(pending, line_number))
+                line_number += len(pending)
+                pending = []
+        await _load(importer, _parse(pending, line_number))
+    return importer.counts
+
+
+async def _load(importer: Importer, batch: List[dict]) -> None:
+    try:
+        await importer.load(batch)
+    except KeyError as e:
+        raise TransferError(f"A record is missing its {e} field.")
+    except (AttributeError, TypeError):
+        raise TransferError("Every line must be a JSON object with the fields of its record type.")
+
+
+# --- CLI ---
+async def _read_file(path: str, chunk_size: int = 1 << 20) -> AsyncIterator[bytes]:
+    with (sys.stdin.buffer if path == "-" else open(path, "rb")) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+async def export_to_file(path: str, user_id: Optional[int] = None, compression: Optional[str] = None) -> int:
+    # Writes the export to path ("-" for stdout) and returns its size in bytes. Files are
+    # written under a temporary name and renamed when complete.
+    written = 0
+    target = path if path == "-" else path + ".partial"
+    with (sys.stdout.buffer if path == "-" else open(target, "wb")) as f:
+        async for chunk in export_stream(user_id, compression):
+            f.write(chunk)
+            written += len(chunk)
+    if path != "-":
+        os.replace(target, path)
+    return written
+
+
+async def _main(args) -> None:
+    try:
+        if args.command == "export":
+            compression = args.compress or (compression_for_path(args.out) if args.out != "-" else None)
+            written = await export_to_file(args.out, args.user_id, compression)
+            if args.out != "-":
+                print(f"Exported {written} bytes to {args.out}.")
+        else:
+            compression = args.compress or (compression_for_path(args.path) if args.path != "-" else None)
+            counts = await import_stream(_read_file(args.path), compression)
+            print(f"Imported {counts['users']} users, {counts['chats']} chats and {counts['messages']} messages.")
+    finally:
+        await async_engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bulk export and import of chats and messages as NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="Stream users, chats and messages to NDJSON")
+    export_parser.add_argument("--user-id", type=int, help="Only this user's chats")
+    export_parser.add_argument("--out", default="-", help="File to write (.gz/.zst imply compression); - for stdout")
+    export_parser.add_argument("--compress", choices=COMPRESSIONS)
+    import_parser = commands.add_parser("import", help="Load an export, giving chats and messages new ids")
+    import_parser.add_argument("path", help="File to read (.gz/.zst imply compression); - for stdin")
+    import_parser.add_argument("--compress", choices=COMPRESSIONS)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_main(args))
+    except (TransferError, RuntimeError) as e:
+        parser.exit(1, f"{e}\n")
+
+
+if __name__ == "__main__":
+    main()
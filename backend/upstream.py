@@ -0,0 +1,363 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import httpx
+
+from . import metrics
+
+# --- Upstream (OpenRouter) HTTP Client Configuration ---
+# One client per worker process, shared by every request. Keep-alive connections
+# are pooled so concurrent completions reuse TCP/TLS sessions instead of paying
+# a fresh handshake per chat message.
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "200"))  # Per-host limit (we only talk to one host)
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "50"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "true").lower() in ("1", "true", "yes")
+
+# --- Upstream Resilience Configuration ---
+# Retries (429, 5xx, connection failures) back off with decorrelated jitter and never outlive
+# the request's deadline. The circuit breakers fail fast while the upstream error rate is high;
+# there is one per upstream host and model, so one failing model does not shut out the others.
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.2"))  # Seconds
+UPSTREAM_RETRY_MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "5"))
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", "60"))  # Default per-request budget in seconds
+UPSTREAM_BREAKER_WINDOW = float(os.getenv("UPSTREAM_BREAKER_WINDOW", "30"))  # Seconds of outcomes considered
+UPSTREAM_BREAKER_MIN_CALLS = int(os.getenv("UPSTREAM_BREAKER_MIN_CALLS", "20"))
+UPSTREAM_BREAKER_ERROR_RATIO = float(os.getenv("UPSTREAM_BREAKER_ERROR_RATIO", "0.5"))
+UPSTREAM_BREAKER_COOLDOWN = float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", "15"))  # Seconds open before a probe
+# Hedging: if a non-streaming call has not answered after the observed p95 latency, a second
+# identical call is fired and the first answer wins. Opt-in, since a hedge can double the token cost.
+UPSTREAM_HEDGE_ENABLED = os.getenv("UPSTREAM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+UPSTREAM_HEDGE_PERCENTILE = float(os.getenv("UPSTREAM_HEDGE_PERCENTILE", "95"))
+UPSTREAM_HEDGE_MIN_DELAY = float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "1.0"))  # Seconds; also used until enough samples
+
+DEADLINE_HEADER = "X-Request-Deadline-Ms"  # Incoming header: remaining time budget in milliseconds
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def build_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=UPSTREAM_CONNECT_TIMEOUT,
+        read=UPSTREAM_READ_TIMEOUT,
+        write=UPSTREAM_READ_TIMEOUT,
+        pool=UPSTREAM_POOL_TIMEOUT,
+    )
+    http2 = UPSTREAM_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401  # httpx only speaks HTTP/2 when the 'h2' package is installed
+        except ImportError:
+            print("UPSTREAM_HTTP2 is enabled but the 'h2' package is not installed. Falling back to HTTP/1.1.")
+            http2 = False
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+
+
+async def start_client() -> None:
+    global _client
+    if _client is None:
+        _client = build_client()
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    # Lazily create the client if startup hooks did not run (e.g. in scripts).
+    global _client
+    if _client is None:
+        _client = build_client()
+    return _client
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("Upstream circuit breaker is open")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    # A TimeoutException, so callers map it like any other upstream timeout (504).
+    def __init__(self):
+        super().__init__("Request deadline exceeded before the upstream call completed")
+
+
+class CircuitBreaker:
+    # closed -> open when, over the last `window` seconds and at least `min_calls` calls, the error
+    # ratio reaches `error_ratio`. After `cooldown` a single probe is let through (half-open);
+    # its outcome closes the breaker or re-opens it.
+    def __init__(self, window: float = UPSTREAM_BREAKER_WINDOW, min_calls: int = UPSTREAM_BREAKER_MIN_CALLS,
+                 error_ratio: float = UPSTREAM_BREAKER_ERROR_RATIO, cooldown: float = UPSTREAM_BREAKER_COOLDOWN):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_ratio = error_ratio
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._outcomes = deque()  # (monotonic time, ok)
+        self._failures = 0
+        self._probe_started = None
+
+    def before_call(self) -> None:
+        if self.state == "open":
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(remaining)
+            self.state = "half_open"
+        if self.state == "half_open":
+            # One probe at a time; a probe that never reports back (cancelled) expires after the cooldown.
+            now = time.monotonic()
+            if self._probe_started is not None and now - self._probe_started < self.cooldown:
+                self.rejected += 1
+                raise CircuitOpenError(self.cooldown)
+            self._probe_started = now
+
+    def record(self, ok: bool) -> None:
+        now = time.monotonic()
+        if self.state == "half_open" and self._probe_started is not None:
+            self._probe_started = None
+            if ok:
+                self.state = "closed"
+                self._outcomes.clear()
+                self._failures = 0
+            else:
+                self._open(now)
+            return
+        self._outcomes.append((now, ok))
+        self._failures += not ok
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._failures -= not self._outcomes.popleft()[1]
+        if (self.state == "closed" and len(self._outcomes) >= self.min_calls
+                and self._failures / len(self._outcomes) >= self.error_ratio):
+            self._open(now)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "calls_in_window": len(self._outcomes),
+            "failures_in_window": self._failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+    def _open(self, now: float) -> None:
+        self.state = "open"
+        self.opened_at = now
+        self.times_opened += 1
+
+
+class LatencyTracker:
+    # Recent successful call latencies, for the hedging delay.
+    def __init__(self, size: int = 500, min_samples: int = 20):
+        self._samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+breakers = {}  # breaker_key_for(url, model) -> CircuitBreaker; one per configured model
+latencies = LatencyTracker()
+counters = {"calls": 0, "attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "deadline_exceeded": 0}
+
+
+def breaker_key_for(url: str, model: Optional[str]) -> str:
+    return f"{httpx.URL(url).host}/{model or ''}"
+
+
+def breaker_for(key: str) -> CircuitBreaker:
+    breaker = breakers.get(key)
+    if breaker is None:
+        breaker = breakers[key] = CircuitBreaker(UPSTREAM_BREAKER_WINDOW, UPSTREAM_BREAKER_MIN_CALLS,
+                                                 UPSTREAM_BREAKER_ERROR_RATIO, UPSTREAM_BREAKER_COOLDOWN)
+    return breaker
+
+
+def deadline_from_header(value: Optional[str]) -> float:
+    # Absolute monotonic deadline for a request; the header can only shorten the default budget.
+    budget = UPSTREAM_DEADLINE
+    if value:
+        try:
+            budget = min(budget, max(0.0, float(value) / 1000.0))
+        except ValueError:
+            pass
+    return time.monotonic() + budget
+
+
+def decorrelated_jitter(previous: float) -> float:
+    return min(UPSTREAM_RETRY_MAX_DELAY, random.uniform(UPSTREAM_RETRY_BASE_DELAY, previous * 3))
+
+
+def attempt_timeout(deadline: float) -> httpx.Timeout:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        counters["deadline_exceeded"] += 1
+        raise DeadlineExceeded()
+    return httpx.Timeout(
+        connect=min(UPSTREAM_CONNECT_TIMEOUT, remaining),
+        read=min(UPSTREAM_READ_TIMEOUT, remaining),
+        write=min(UPSTREAM_READ_TIMEOUT, remaining),
+        pool=min(UPSTREAM_POOL_TIMEOUT, remaining),
+    )
+
+
+def _retryable(outcome) -> bool:
+    if isinstance(outcome, httpx.Response):
+        return outcome.status_code in RETRYABLE_STATUS
+    # Connection-level failures never reached the model, so they are safe to repeat. A read
+    # timeout may mean a completion is still being generated; it is not retried.
+    return isinstance(outcome, (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, httpx.PoolTimeout))
+
+
+def _retry_delay(outcome, previous: float) -> float:
+    delay = decorrelated_jitter(previous)
+    if isinstance(outcome, httpx.Response) and outcome.headers.get("retry-after", "").isdigit():
+        delay = max(delay, float(outcome.headers["retry-after"]))
+    return delay
+
+
+async def _send(url: str, headers: dict, body: dict, timeout: httpx.Timeout, breaker: CircuitBreaker):
+    # One attempt; returns the response or the httpx exception, and feeds the breaker and latency stats.
+    counters["attempts"] += 1
+    started = time.monotonic()
+    try:
+        response = await get_client().post(url, headers=headers, json=body, timeout=timeout)
+    except httpx.HTTPError as e:
+        breaker.record(False)
+        metrics.upstream_attempt_seconds.observe(time.monotonic() - started, type(e).__name__)
+        return e
+    metrics.upstream_attempt_seconds.observe(time.monotonic() - started, str(response.status_code))
+    breaker.record(response.status_code < 500 and response.status_code != 429)
+    if response.status_code < 400:
+        latencies.add(time.monotonic() - started)
+    return response
+
+
+async def _send_hedged(url: str, headers: dict, body: dict, deadline: float, breaker: CircuitBreaker):
+    delay = latencies.percentile(UPSTREAM_HEDGE_PERCENTILE)
+    delay = max(UPSTREAM_HEDGE_MIN_DELAY, delay if delay is not None else UPSTREAM_HEDGE_MIN_DELAY)
+    primary = asyncio.ensure_future(_send(url, headers, body, attempt_timeout(deadline), breaker))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or breaker.state != "closed" or deadline - time.monotonic() <= 0:
+        return await primary
+    counters["hedges"] += 1
+    hedge = asyncio.ensure_future(_send(url, headers, body, attempt_timeout(deadline), breaker))
+    pending = {primary, hedge}
+    outcome = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                outcome = task.result()
+                if not _retryable(outcome) and not isinstance(outcome, Exception):
+                    if task is hedge:
+                        counters["hedge_wins"] += 1
+                    return outcome
+        return outcome  # Both attempts failed; hand the last failure to the retry loop
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def post_json(url: str, headers: dict, body: dict, deadline: Optional[float] = None,
+                    hedge: bool = UPSTREAM_HEDGE_ENABLED, breaker_key: Optional[str] = None) -> httpx.Response:
+    # Resilient non-streaming POST. Returns the final response (which may still be an error status
+    # for the caller to map) or raises the final httpx error, CircuitOpenError or DeadlineExceeded.
+    # breaker_key picks the circuit breaker (default: the url's host and the body's model).
+    breaker = breaker_for(breaker_key or breaker_key_for(url, body.get("model")))
+    deadline = deadline if deadline is not None else time.monotonic() + UPSTREAM_DEADLINE
+    counters["calls"] += 1
+    delay = UPSTREAM_RETRY_BASE_DELAY
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        timeout = attempt_timeout(deadline)
+        breaker.before_call()
+        if hedge:
+            outcome = await _send_hedged(url, headers, body, deadline, breaker)
+        else:
+            outcome = await _send(url, headers, body, timeout, breaker)
+        if attempt == UPSTREAM_MAX_RETRIES or not _retryable(outcome):
+            break
+        delay = _retry_delay(outcome, delay)
+        if time.monotonic() + delay >= deadline:
+            break  # Not enough budget left for another attempt
+        counters["retries"] += 1
+        await asyncio.sleep(delay)
+    if isinstance(outcome, Exception):
+        raise outcome
+    return outcome
+
+
+@asynccontextmanager
+async def stream_post(url: str, headers: dict, body: dict, deadline: Optional[float] = None,
+                      breaker_key: Optional[str] = None):
+    # Streaming POST. Retries happen only before the first byte of the body (connection failures and
+    # retryable statuses); once the stream is handed to the caller it is never repeated.
+    breaker = breaker_for(breaker_key or breaker_key_for(url, body.get("model")))
+    deadline = deadline if deadline is not None else time.monotonic() + UPSTREAM_DEADLINE
+    counters["calls"] += 1
+    delay = UPSTREAM_RETRY_BASE_DELAY
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        timeout = attempt_timeout(deadline)
+        breaker.before_call()
+        counters["attempts"] += 1
+        request = get_client().stream("POST", url, headers=headers, json=body, timeout=timeout)
+        started = time.monotonic()
+        try:
+            outcome = await request.__aenter__()
+            breaker.record(outcome.status_code < 500 and outcome.status_code != 429)
+            metrics.upstream_attempt_seconds.observe(time.monotonic() - started, str(outcome.status_code))
+        except httpx.HTTPError as e:
+            breaker.record(False)
+            metrics.upstream_attempt_seconds.observe(time.monotonic() - started, type(e).__name__)
+            outcome = e
+        retry = attempt < UPSTREAM_MAX_RETRIES and _retryable(outcome)
+        if retry:
+            delay = _retry_delay(outcome, delay)
+            retry = time.monotonic() + delay < deadline  # Otherwise the last failure is final
+        if isinstance(outcome, Exception):
+            if not retry:
+                raise outcome
+        elif not retry:
+            try:
+                yield outcome
+            finally:
+                await request.__aexit__(None, None, None)
+            return
+        else:
+            await request.__aexit__(None, None, None)
+        counters["retries"] += 1
+        await asyncio.sleep(delay)
+
+
+def stats() -> dict:
+    p95 = latencies.percentile(95)
+    return {**counters, "p95_seconds": round(p95, 4) if p95 is not None else None,
+            "breakers": {key: breaker.stats() for key, breaker in breakers.items()}}
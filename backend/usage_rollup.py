@@ -0,0 +1,181 @@
+# Per-user token usage rollups.
+#
+# Every recorded Usage row also bumps the user's hourly and daily UsageRollup rows (an additive
+# upsert in the same transaction), so usage summaries and quota checks read a bounded number of
+# rollup rows instead of summing the usage table.
+#
+# Existing usage rows (from before rollups were written) are rolled up with:
+#   python -m backend.usage_rollup backfill [--chunk-size 5000]
+# The backfill recomputes each bucket from the usage table and overwrites it, so it is safe to re-run.
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import load_env_file
+
+if __name__ == "__main__":
+    load_env_file()  # Before .database reads DATABASE_URL
+
+from . import models
+from .database import dialect_insert, engine
+
+PERIODS = ("hour", "day")
+USAGE_COUNTS = ("tokens_used", "prompt_tokens", "completion_tokens", "prompt_tokens_saved")  # Summed per bucket
+ROLLUP_TOTALS = USAGE_COUNTS + ("requests",)
+BACKFILL_CHUNK_SIZE = 5000
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def bucket_start(period: str, at: datetime) -> datetime:
+    # SQLite hands back naive datetimes; everything stored by this app is UTC.
+    at = at.replace(tzinfo=timezone.utc) if at.tzinfo is None else at.astimezone(timezone.utc)
+    if period == "hour":
+        return at.replace(minute=0, second=0, microsecond=0)
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def rollup_upsert(additive: bool):
+    # Additive upserts apply a delta (write path); non-additive ones replace the bucket (backfill).
+    table = models.UsageRollup.__table__
+    statement = dialect_insert(table)
+    if additive:
+        values = {column: table.c[column] + statement.excluded[column] for column in ROLLUP_TOTALS}
+    else:
+        values = {column: statement.excluded[column] for column in ROLLUP_TOTALS}
+    return statement.on_conflict_do_update(index_elements=["user_id", "period", "bucket_start"], set_=values)
+
+
+def rollup_delta(usage: dict) -> dict:
+    # What one usage row adds to each of its buckets; NULL counts add nothing.
+    delta = {column: usage.get(column) or 0 for column in USAGE_COUNTS}
+    delta["requests"] = 1
+    return delta
+
+
+def rollup_rows(usage_rows: List[dict]) -> List[dict]:
+    # The additive rollup rows for a set of new usage rows, one per (user, period, bucket).
+    totals = {}
+    for row in usage_rows:
+        delta = rollup_delta(row)
+        for period in PERIODS:
+            key = (row["user_id"], period, bucket_start(period, row["timestamp"]))
+            bucket = totals.setdefault(key, dict.fromkeys(ROLLUP_TOTALS, 0))
+            for column, amount in delta.items():
+                bucket[column] += amount
+    return [
+        {"user_id": user_id, "period": period, "bucket_start": start, **bucket}
+        for (user_id, period, start), bucket in totals.items()
+    ]
+
+
+async def record_usage(db: AsyncSession, user_id: int, tokens_used: int, at: Optional[datetime] = None,
+                       **counts: Optional[int]) -> None:
+    # Adds the Usage row and bumps both rollups; committed by the caller together with the reply.
+    # counts: the optional Usage columns (prompt_tokens, completion_tokens, prompt_tokens_saved).
+    at = at or utcnow()
+    db.add(models.Usage(user_id=user_id, tokens_used=tokens_used, timestamp=at, **counts))
+    delta = rollup_delta({"tokens_used": tokens_used, **counts})
+    await db.execute(rollup_upsert(additive=True), [
+        {"user_id": user_id, "period": period, "bucket_start": bucket_start(period, at), **delta}
+        for period in PERIODS
+    ])
+
+
+async def usage_summary(db: AsyncSession, user_id: int, hours: int, days: int) -> dict:
+    # Reads at most hours + days rollup rows through the (user_id, period, bucket_start) primary key.
+    now = utcnow()
+    windows = {"hour": bucket_start("hour", now) - timedelta(hours=hours - 1),
+               "day": bucket_start("day", now) - timedelta(days=days - 1)}
+    rollup = models.UsageRollup
+    summary = {"user_id": user_id}
+    for period, since in windows.items():
+        rows = (await db.execute(
+            select(rollup.bucket_start, *(rollup.__table__.c[column] for column in ROLLUP_TOTALS))
+            .where(rollup.user_id == user_id, rollup.period == period, rollup.bucket_start >= since)
+            .order_by(rollup.bucket_start)
+        )).all()
+        key = "hourly" if period == "hour" else "daily"
+        summary[key] = [
+            {"bucket_start": bucket_start(period, row.bucket_start), **{column: row._mapping[column] for column in ROLLUP_TOTALS}}
+            for row in rows
+        ]
+        for column in USAGE_COUNTS:
+            summary[f"{key}_{column}"] = sum(row._mapping[column] for row in rows)
+    return summary
+
+
+# --- Backfill ---
+def _usage_chunk(conn, after_id: Optional[int], chunk_size: int) -> list:
+    # Usage rows in (user_id, timestamp, id) order, served by ix_usage_user_id_timestamp, so each
+    # user's buckets are contiguous and can be written as soon as the scan moves past them.
+    usage = models.Usage
+    query = select(usage.id, usage.user_id, usage.timestamp, *(usage.__table__.c[column] for column in USAGE_COUNTS)) \
+        .where(usage.timestamp.isnot(None))
+    if after_id is not None:
+        # As in history.history_page_query, the cursor row's timestamp is read back inside the database.
+        cursor = select(usage.user_id, usage.timestamp).where(usage.id == after_id).subquery()
+        query = query.where(tuple_(usage.user_id, usage.timestamp, usage.id) > tuple_(
+            select(cursor.c.user_id).scalar_subquery(), select(cursor.c.timestamp).scalar_subquery(), after_id,
+        ))
+    query = query.order_by(usage.user_id, usage.timestamp, usage.id).limit(chunk_size)
+    return conn.execute(query).all()
+
+
+def _write_buckets(buckets: List[dict]) -> None:
+    if buckets:
+        with engine.begin() as conn:
+            conn.execute(rollup_upsert(additive=False), buckets)
+
+
+def backfill(chunk_size: int = BACKFILL_CHUNK_SIZE) -> int:
+    # Memory is bounded by chunk_size: one chunk of usage rows, the open bucket per period,
+    # and at most chunk_size finished buckets waiting to be written.
+    open_buckets = {}  # period -> bucket dict being accumulated
+    finished: List[dict] = []
+    written = 0
+    after_id = None
+    while True:
+        with engine.connect() as conn:
+            rows = _usage_chunk(conn, after_id, chunk_size)
+        for row in rows:
+            for period in PERIODS:
+                start = bucket_start(period, row.timestamp)
+                current = open_buckets.get(period)
+                if current is None or current["user_id"] != row.user_id or current["bucket_start"] != start:
+                    if current is not None:
+                        finished.append(current)
+                    current = open_buckets[period] = {"user_id": row.user_id, "period": period, "bucket_start": start,
+                                                      **dict.fromkeys(ROLLUP_TOTALS, 0)}
+                for column, amount in rollup_delta(row._mapping).items():
+                    current[column] += amount
+        if len(rows) < chunk_size:
+            break
+        after_id = rows[-1].id
+        if len(finished) >= chunk_size:
+            _write_buckets(finished)
+            written += len(finished)
+            finished = []
+    finished.extend(open_buckets.values())
+    _write_buckets(finished)
+    return written + len(finished)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Maintain per-user usage rollups")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = commands.add_parser("backfill", help="Rebuild rollups from the usage table")
+    backfill_parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        print(f"Backfilled {backfill(args.chunk_size)} usage rollup buckets.")
+
+
+if __name__ == "__main__":
+    main()
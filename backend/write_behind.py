@@ -0,0 +1,258 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .database import IS_SQLITE, async_engine, dialect_insert
+from .usage_rollup import rollup_rows, rollup_upsert, utcnow
+
+# --- Write-Behind Configuration ---
+# Opt-in. New chats, messages and usage rows get pre-allocated ids and are handed to a background
+# writer, so a chat reply is returned without waiting on INSERTs and a COMMIT. Rows are written in
+# batches, at least once: every batch skips ids that already exist, so a retried batch is harmless.
+#
+# Durability: an accepted turn is in memory until its batch commits (normally within
+# WRITE_BEHIND_FLUSH_INTERVAL). Shutdown drains the queue; a hard crash (SIGKILL, OOM) loses what
+# was still queued. When the queue is full, requests wait for room instead of rows being dropped.
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() in ("1", "true", "yes")
+WRITE_BEHIND_ID_BLOCK = int(os.getenv("WRITE_BEHIND_ID_BLOCK", "100"))  # Ids fetched per sequence round trip
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "10000"))  # Turns
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))  # Turns per transaction
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.05"))  # Seconds
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "5"))
+WRITE_BEHIND_SHUTDOWN_TIMEOUT = float(os.getenv("WRITE_BEHIND_SHUTDOWN_TIMEOUT", "30"))
+
+# Parents before children, so foreign keys hold within a batch.
+WRITE_ORDER = [models.Chat, models.Message, models.Usage]
+
+
+class IdAllocator:
+    # PostgreSQL: blocks of ids are prefetched from each table's own sequence, so they never collide
+    # with ids the database hands out to ordinary INSERTs (from other workers or scripts).
+    # SQLite has no sequences: ids continue from max(id) and are handed out in-process, which is
+    # only safe while this process is the sole writer (the single-worker SQLite setup).
+    def __init__(self, block: int = WRITE_BEHIND_ID_BLOCK):
+        self.block = block
+        self._ids: Dict[str, deque] = {}
+        self._next: Dict[str, int] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.round_trips = 0
+
+    async def allocate(self, model) -> int:
+        table = model.__table__.name
+        ids = self._ids.setdefault(table, deque())
+        if not ids:
+            async with self._locks.setdefault(table, asyncio.Lock()):
+                if not ids:
+                    ids.extend(await self._fetch_block(table))
+        return ids.popleft()
+
+    async def _fetch_block(self, table: str) -> List[int]:
+        if IS_SQLITE:
+            if table not in self._next:
+                async with async_engine.connect() as conn:
+                    self._next[table] = ((await conn.execute(text(f"SELECT max(id) FROM {table}"))).scalar() or 0) + 1
+                self.round_trips += 1
+            start = self._next[table]
+            self._next[table] = start + self.block
+            return list(range(start, start + self.block))
+        async with async_engine.connect() as conn:
+            rows = await conn.execute(
+                select(func.nextval(func.pg_get_serial_sequence(table, "id"))).select_from(func.generate_series(1, self.block))
+            )
+            self.round_trips += 1
+            return [row[0] for row in rows]
+
+
+def row_values(obj) -> dict:
+    # Column values of a transient ORM object, keyed by column name, for a Core INSERT.
+    mapper = inspect(obj).mapper
+    return {attr.columns[0].name: getattr(obj, attr.key) for attr in mapper.column_attrs}
+
+
+class WriteBehindWriter:
+    def __init__(self, enabled: bool = WRITE_BEHIND_ENABLED, max_queue: int = WRITE_BEHIND_MAX_QUEUE,
+                 batch_size: int = WRITE_BEHIND_BATCH_SIZE, flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL):
+        self.enabled = enabled
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ids = IdAllocator()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._interrupted: list = []  # The batch the writer was working on when stop() cancelled it
+        self.turns_submitted = 0
+        self.turns_written_inline = 0
+        self.backpressure_waits = 0
+        self.rows_written = 0
+        self.rows_skipped = 0  # Already present: a retried batch
+        self.batches = 0
+        self.retries = 0
+        self.failed_turns = 0
+        self.max_pending_seconds = 0.0
+
+    async def stage(self, db: AsyncSession, obj, need_id: bool = False) -> None:
+        # Adds a new row for the current request. Normally that is db.add (flushed when the caller
+        # needs the id now, otherwise written at commit). In write-behind mode the row gets a
+        # pre-allocated id and timestamp and is kept in the session until commit() hands it to the
+        # writer; rows of a session that is never committed are discarded with it.
+        if not self.enabled:
+            db.add(obj)
+            if need_id:
+                await db.flush()
+            return
+        obj.id = await self.ids.allocate(type(obj))
+        for name in ("created_at", "timestamp"):
+            if hasattr(obj, name) and getattr(obj, name) is None:
+                setattr(obj, name, utcnow())
+        db.info.setdefault("write_behind", []).append(obj)
+
+    async def commit(self, db: AsyncSession) -> None:
+        if not self.enabled:
+            await db.commit()
+            return
+        if db.new or db.dirty or db.deleted:
+            await db.commit()  # Anything added to the session directly (nothing on the chat path)
+        rows = db.info.pop("write_behind", [])
+        if rows:
+            await self.submit(rows)
+
+    async def submit(self, objs: list) -> None:
+        turn = {"rows": [(type(obj), row_values(obj)) for obj in objs], "submitted_at": time.monotonic()}
+        self.turns_submitted += 1
+        if self._queue is None:
+            await self._write([turn])  # Writer not running (e.g. scripts): write inline
+            self.turns_written_inline += 1
+            return
+        if self._queue.full():
+            self.backpressure_waits += 1
+        # A full queue means the database is not keeping up: the request waits for room rather than
+        # writing out of turn (a message must not overtake the queued chat it belongs to).
+        await self._queue.put(turn)
+
+    async def start(self) -> None:
+        if not self.enabled or self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = WRITE_BEHIND_SHUTDOWN_TIMEOUT) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # The interrupted batch first: it was taken off the queue ahead of everything still in it
+        remaining = self._interrupted + self._take_batch(self._queue.qsize())
+        self._interrupted = []
+        self._queue = None
+        try:
+            for start in range(0, len(remaining), self.batch_size):
+                await asyncio.wait_for(self._write_with_retry(remaining[start:start + self.batch_size]), timeout)
+        except Exception as e:
+            print(f"Write-behind: failed to drain {len(remaining)} queued turns on shutdown: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "queued_turns": self._queue.qsize() if self._queue is not None else 0,
+            "turns_submitted": self.turns_submitted,
+            "turns_written_inline": self.turns_written_inline,
+            "backpressure_waits": self.backpressure_waits,
+            "rows_written": self.rows_written,
+            "rows_skipped": self.rows_skipped,
+            "batches": self.batches,
+            "retries": self.retries,
+            "failed_turns": self.failed_turns,
+            "max_pending_seconds": round(self.max_pending_seconds, 4),
+            "id_round_trips": self.ids.round_trips,
+        }
+
+    def _take_batch(self, limit: int) -> list:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                await asyncio.sleep(self.flush_interval)  # Let concurrent turns join this batch
+                batch += self._take_batch(self.batch_size - 1)
+                await self._write_with_retry(batch)
+            except asyncio.CancelledError:
+                # Shutdown while waiting or mid-write: stop() writes the batch (duplicates are skipped).
+                self._interrupted = batch
+                raise
+
+    async def _write_with_retry(self, batch: list) -> None:
+        delay = 0.1
+        for attempt in range(1, WRITE_BEHIND_MAX_ATTEMPTS + 1):
+            try:
+                await self._write(batch)
+                return
+            except Exception as e:
+                if attempt == WRITE_BEHIND_MAX_ATTEMPTS:
+                    print(f"Write-behind: batch of {len(batch)} turns failed {attempt} times: {e}")
+                    break
+                self.retries += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+        # Persistent failure: write turn by turn so one bad turn (e.g. its chat was deleted) does not
+        # block the others.
+        for turn in batch:
+            try:
+                await self._write([turn])
+            except Exception as e:
+                self.failed_turns += 1
+                print(f"Write-behind: dropping turn with {len(turn['rows'])} rows after repeated failures: {e}")
+
+    async def _write(self, batch: list) -> None:
+        # One transaction: per table, skip ids that already exist, insert the rest, then apply the
+        # usage rollups of the usage rows actually inserted (so a retry never double-counts).
+        by_model = {model: [] for model in WRITE_ORDER}
+        for turn in batch:
+            for model, values in turn["rows"]:
+                by_model[model].append(values)
+        inserted_usage = []
+        written = skipped = 0
+        async with async_engine.begin() as conn:
+            for model in WRITE_ORDER:
+                rows = by_model[model]
+                if not rows:
+                    continue
+                table = model.__table__
+                existing = set((await conn.execute(
+                    select(table.c.id).where(table.c.id.in_([row["id"] for row in rows]))
+                )).scalars())
+                new_rows = [row for row in rows if row["id"] not in existing]
+                skipped += len(rows) - len(new_rows)
+                if new_rows:
+                    # No conflict target: on partitioned tables (usage, see backend/partitions.py) the
+                    # unique key is (id, timestamp) rather than id.
+                    await conn.execute(dialect_insert(table).on_conflict_do_nothing(), new_rows)
+                    written += len(new_rows)
+                if model is models.Usage:
+                    inserted_usage = new_rows
+            if inserted_usage:
+                await conn.execute(rollup_upsert(additive=True), rollup_rows(inserted_usage))
+        # Counted once committed: a failed transaction is retried and would be counted twice
+        self.rows_written += written
+        self.rows_skipped += skipped
+        self.batches += 1
+        now = time.monotonic()
+        self.max_pending_seconds = max(self.max_pending_seconds, max(now - turn["submitted_at"] for turn in batch))
+
+write_behind = WriteBehindWriter()
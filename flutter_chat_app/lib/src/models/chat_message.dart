@@ -11,4 +11,14 @@ class ChatMessage {
     required this.isUserMessage,
     required this.timestamp,
   });
+
+  // Used to grow a streamed reply in place as new tokens arrive.
+  ChatMessage copyWith({String? text}) {
+    return ChatMessage(
+      id: id,
+      text: text ?? this.text,
+      isUserMessage: isUserMessage,
+      timestamp: timestamp,
+    );
+  }
 }
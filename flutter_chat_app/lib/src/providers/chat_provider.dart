@@ -1,6 +1,7 @@
 import 'package:flutter/foundation.dart';
 import '../models/chat_message.dart';
 import '../services/api_service.dart'; // Import ApiService
+import '../services/chat_socket.dart';
 import 'dart:math';
 
 class ChatProvider with ChangeNotifier {
@@ -12,6 +13,20 @@ class ChatProvider with ChangeNotifier {
   bool _isLoading = false; // New loading state
   bool get isLoading => _isLoading;
 
+  int? _chatId; // Assigned by the backend after the first reply, reused for follow-up messages
+  int? get chatId => _chatId;
+
+  // Messages go over a persistent socket for the current chat; when it cannot be opened they
+  // fall back to the HTTP stream, and the socket is tried again after _socketRetryDelay.
+  static const Duration _socketRetryDelay = Duration(seconds: 30);
+  ChatSocket? _socket;
+  Future<ChatSocket?>? _connecting;
+  DateTime? _socketRetryAt;
+
+  String? _olderCursor; // Cursor for the next page of stored history, null when fully loaded
+  bool _isLoadingHistory = false;
+  bool get hasOlderMessages => _olderCursor != null;
+
   List<ChatMessage> get messages => List.unmodifiable(_messages.reversed);
 
   String _generateId() {
@@ -30,10 +45,33 @@ class ChatProvider with ChangeNotifier {
     _isLoading = true;
     notifyListeners(); // Notify for user message and loading state
 
+    // Placeholder bot message that grows as streamed tokens arrive
+    final botMessageId = _generateId();
+    _messages.add(ChatMessage(id: botMessageId, text: '', isUserMessage: false, timestamp: DateTime.now()));
+    final reply = StringBuffer();
+
     try {
-      final String botReplyText = await _apiService.sendMessage(text);
-      _addBotMessage(botReplyText, isError: false);
+      await for (final event in _sendMessage(text)) {
+        switch (event.type) {
+          case 'delta':
+            reply.write(event.delta ?? '');
+            _replaceMessageText(botMessageId, reply.toString());
+            notifyListeners();
+            break;
+          case 'done':
+            _chatId = event.chatId ?? _chatId;
+            break;
+          case 'error':
+            throw event.error ?? 'Unknown streaming error';
+        }
+      }
+      if (reply.isEmpty) {
+        _messages.removeWhere((m) => m.id == botMessageId);
+      }
     } catch (e) {
+      if (reply.isEmpty) {
+        _messages.removeWhere((m) => m.id == botMessageId);
+      }
       _addBotMessage(e.toString(), isError: true);
     } finally {
       _isLoading = false;
@@ -41,6 +79,85 @@ class ChatProvider with ChangeNotifier {
     }
   }
 
+  Stream<ChatStreamEvent> _sendMessage(String text) async* {
+    final socket = await _openSocket();
+    if (socket != null) {
+      yield* socket.sendMessage(text);
+    } else {
+      yield* _apiService.streamMessage(text, chatId: _chatId);
+    }
+  }
+
+  Future<ChatSocket?> _openSocket() {
+    final socket = _socket;
+    if (socket != null && socket.isOpen && socket.chatId == _chatId) {
+      return Future.value(socket);
+    }
+    if (_socketRetryAt != null && DateTime.now().isBefore(_socketRetryAt!)) {
+      return Future.value(null);
+    }
+    return _connecting ??= _connectSocket().whenComplete(() => _connecting = null);
+  }
+
+  Future<ChatSocket?> _connectSocket() async {
+    _socket?.close();
+    _socket = null;
+    final socket = _apiService.openChatSocket(chatId: _chatId);
+    try {
+      await socket.connect();
+    } catch (_) {
+      _socketRetryAt = DateTime.now().add(_socketRetryDelay);
+      return null;
+    }
+    _socketRetryAt = null;
+    return _socket = socket;
+  }
+
+  // Resume an existing chat: load only its most recent page of messages.
+  Future<void> restoreChat(int chatId) async {
+    _chatId = chatId;
+    _socket?.close(); // Bound to the previous chat
+    _socket = null;
+    _messages.clear();
+    _olderCursor = null;
+    await _loadHistoryPage(null);
+  }
+
+  // Load the next older page, e.g. when the user scrolls to the top of the list.
+  Future<void> loadOlderMessages() async {
+    if (_chatId == null || _olderCursor == null) return;
+    await _loadHistoryPage(_olderCursor);
+  }
+
+  Future<void> _loadHistoryPage(String? cursor) async {
+    if (_isLoadingHistory) return;
+    _isLoadingHistory = true;
+    try {
+      final page = await _apiService.fetchMessages(_chatId!, cursor: cursor);
+      // Pages arrive newest-first; _messages is kept oldest-first.
+      _messages.insertAll(0, page.messages.reversed);
+      _olderCursor = page.nextCursor;
+    } catch (e) {
+      _addBotMessage(e.toString(), isError: true);
+    } finally {
+      _isLoadingHistory = false;
+      notifyListeners();
+    }
+  }
+
+  @override
+  void dispose() {
+    _socket?.close();
+    super.dispose();
+  }
+
+  void _replaceMessageText(String id, String text) {
+    final index = _messages.indexWhere((m) => m.id == id);
+    if (index != -1) {
+      _messages[index] = _messages[index].copyWith(text: text);
+    }
+  }
+
   void _addBotMessage(String text, {bool isError = false}) {
     final botMessage = ChatMessage(
       id: _generateId(),
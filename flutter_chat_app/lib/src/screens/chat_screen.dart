@@ -15,6 +15,19 @@ class _ChatScreenState extends State<ChatScreen> {
   final TextEditingController _textController = TextEditingController();
   final ScrollController _scrollController = ScrollController();
 
+  @override
+  void initState() {
+    super.initState();
+    _scrollController.addListener(_loadOlderWhenAtTop);
+  }
+
+  void _loadOlderWhenAtTop() {
+    // The list is reversed, so the oldest loaded message sits at maxScrollExtent.
+    if (_scrollController.position.pixels >= _scrollController.position.maxScrollExtent - 200) {
+      Provider.of<ChatProvider>(context, listen: false).loadOlderMessages();
+    }
+  }
+
   @override
   void didChangeDependencies() {
     super.didChangeDependencies();
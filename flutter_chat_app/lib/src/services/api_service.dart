@@ -1,7 +1,27 @@
 // lib/src/services/api_service.dart
 import 'dart:convert';
 import 'package:http/http.dart' as http;
-import '../models/chat_message.dart'; // For potential use if API returns full message objects, though not strictly needed for this post.
+import '../models/chat_message.dart';
+import 'chat_socket.dart';
+
+// One Server-Sent Event from POST /api/v1/chat/stream.
+// type is 'delta' (a chunk of reply text), 'done' (reply stored, ids available) or 'error'.
+class ChatStreamEvent {
+  final String type;
+  final String? delta;
+  final int? chatId;
+  final String? error;
+
+  ChatStreamEvent({required this.type, this.delta, this.chatId, this.error});
+}
+
+// One page of GET /api/v1/chats/{chatId}/messages, newest message first.
+class MessagePage {
+  final List<ChatMessage> messages;
+  final String? nextCursor; // Pass back to fetch the next (older) page; null on the last page
+
+  MessagePage({required this.messages, this.nextCursor});
+}
 
 class ApiService {
   // Ensure your FastAPI backend is running and accessible at this URL.
@@ -15,7 +35,7 @@ class ApiService {
     defaultValue: 'http://localhost:8000', // Fallback for local development
   );
 
-  Future<String> sendMessage(String userMessage) async {
+  Future<String> sendMessage(String userMessage, {int? chatId}) async {
     // The API endpoint is now /api/v1/chat as per backend main.py
     final Uri chatUri = Uri.parse('$_baseUrl/api/v1/chat');
     
@@ -29,7 +49,7 @@ class ApiService {
           'message': userMessage,
           // TODO: Implement actual user_id and chat_id management
           'user_id': 1, // Placeholder user_id
-          'chat_id': null, // Placeholder chat_id (optional, backend creates new if null)
+          'chat_id': chatId, // Optional, backend creates a new chat if null
         }),
       );
 
@@ -62,4 +82,109 @@ class ApiService {
       return Future.error('Failed to connect to the chat service: $e');
     }
   }
+
+  // Streams the reply token by token from /api/v1/chat/stream.
+  // Note: on Flutter web the default BrowserClient buffers the whole response,
+  // so tokens arrive together there; mobile and desktop receive them incrementally.
+  Stream<ChatStreamEvent> streamMessage(String userMessage, {int? chatId}) async* {
+    final Uri streamUri = Uri.parse('$_baseUrl/api/v1/chat/stream');
+    final client = http.Client();
+
+    try {
+      final request = http.Request('POST', streamUri)
+        ..headers['Content-Type'] = 'application/json; charset=UTF-8'
+        ..headers['Accept'] = 'text/event-stream'
+        ..body = jsonEncode(<String, dynamic>{
+          'message': userMessage,
+          // TODO: Implement actual user_id management
+          'user_id': 1, // Placeholder user_id
+          'chat_id': chatId,
+        });
+
+      final response = await client.send(request);
+      if (response.statusCode != 200) {
+        final body = await response.stream.bytesToString();
+        String serverError = body;
+        try {
+          final Map<String, dynamic> errorData = jsonDecode(body);
+          if (errorData.containsKey('detail')) {
+            serverError = errorData['detail'].toString();
+          }
+        } catch (_) {
+          // Ignore if response body is not json or doesn't have detail
+        }
+        yield ChatStreamEvent(type: 'error', error: 'Failed to send message. Status: ${response.statusCode}. Error: $serverError');
+        return;
+      }
+
+      // SSE framing: "event: <name>" then "data: <json>", terminated by a blank line.
+      String eventName = 'message';
+      final lines = response.stream.transform(utf8.decoder).transform(const LineSplitter());
+      await for (final line in lines) {
+        if (line.startsWith('event:')) {
+          eventName = line.substring(6).trim();
+        } else if (line.startsWith('data:')) {
+          final Map<String, dynamic> data = jsonDecode(line.substring(5).trim());
+          switch (eventName) {
+            case 'delta':
+              yield ChatStreamEvent(type: 'delta', delta: data['content'] as String?);
+              break;
+            case 'done':
+              yield ChatStreamEvent(type: 'done', chatId: data['chat_id'] as int?);
+              break;
+            case 'error':
+              yield ChatStreamEvent(type: 'error', error: data['detail']?.toString());
+              break;
+          }
+        } else if (line.isEmpty) {
+          eventName = 'message';
+        }
+      }
+    } catch (e) {
+      yield ChatStreamEvent(type: 'error', error: 'Failed to connect to the chat service: $e');
+    } finally {
+      client.close();
+    }
+  }
+
+  // A persistent connection for one chat session (null chatId: a new chat); see ChatSocket.
+  ChatSocket openChatSocket({int? chatId}) {
+    final base = Uri.parse(_baseUrl);
+    final socketUri = base.replace(
+      scheme: base.scheme == 'https' ? 'wss' : 'ws',
+      path: '/api/v1/chat/ws',
+      queryParameters: <String, String>{
+        'user_id': '1', // Placeholder user_id
+        if (chatId != null) 'chat_id': '$chatId',
+      },
+    );
+    return ChatSocket(socketUri, chatId: chatId);
+  }
+
+  // Fetches one page of a chat's stored messages, so history can be restored
+  // incrementally instead of downloading the whole conversation.
+  Future<MessagePage> fetchMessages(int chatId, {String? cursor, int limit = 50}) async {
+    final Uri messagesUri = Uri.parse('$_baseUrl/api/v1/chats/$chatId/messages').replace(
+      queryParameters: <String, String>{
+        'user_id': '1', // Placeholder user_id
+        'limit': '$limit',
+        if (cursor != null) 'cursor': cursor,
+      },
+    );
+
+    final response = await http.get(messagesUri);
+    if (response.statusCode != 200) {
+      return Future.error('Failed to load messages. Status: ${response.statusCode}.');
+    }
+    final Map<String, dynamic> page = jsonDecode(response.body);
+    final messages = (page['items'] as List<dynamic>).map((item) {
+      return ChatMessage(
+        id: item['id'].toString(),
+        text: item['content'] as String,
+        isUserMessage: item['sender_type'] == 'user',
+        timestamp: DateTime.tryParse(item['created_at'] ?? '') ?? DateTime.now(),
+      );
+    }).toList();
+    return MessagePage(messages: messages, nextCursor: page['next_cursor'] as String?);
+  }
 }
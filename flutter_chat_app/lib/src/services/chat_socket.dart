@@ -0,0 +1,119 @@
+// lib/src/services/chat_socket.dart
+import 'dart:async';
+import 'dart:convert';
+import 'package:web_socket_channel/web_socket_channel.dart';
+import 'api_service.dart';
+
+// A persistent connection to WS /api/v1/chat/ws for one chat session.
+// The backend resolves the user and chat once per connection and streams each reply back as
+// frames tagged with the message's id, so several messages can be in flight at once.
+// Unlike the HTTP stream, tokens arrive incrementally on Flutter web too.
+class ChatSocket {
+  static const Duration _connectTimeout = Duration(seconds: 5);
+  // The server pings every 20 seconds; a connection silent for longer than this is dead.
+  static const Duration _idleTimeout = Duration(seconds: 60);
+
+  final Uri _uri;
+  WebSocketChannel? _channel;
+  StreamSubscription<dynamic>? _subscription;
+  Completer<void>? _ready;
+  Timer? _watchdog;
+  int _nextId = 0;
+  final Map<int, StreamController<ChatStreamEvent>> _replies = {};
+
+  int? chatId; // Null for a new chat until its first reply is stored
+
+  ChatSocket(this._uri, {this.chatId});
+
+  bool get isOpen => _channel != null;
+
+  // Completes once the server has resolved the user and chat; throws if the socket is unavailable.
+  Future<void> connect() async {
+    final channel = WebSocketChannel.connect(_uri);
+    final ready = Completer<void>();
+    _ready = ready;
+    _channel = channel;
+    _subscription = channel.stream.listen(
+      (raw) => _onFrame(jsonDecode(raw as String) as Map<String, dynamic>),
+      onDone: () => _onClosed(channel.closeReason ?? 'Chat connection closed.'),
+      onError: (Object e) => _onClosed('Chat connection lost: $e'),
+    );
+    _resetWatchdog();
+    try {
+      await Future.wait([channel.ready, ready.future]).timeout(_connectTimeout);
+    } catch (_) {
+      close();
+      rethrow;
+    }
+  }
+
+  // Sends one message; the stream ends after its 'done' or 'error' event.
+  Stream<ChatStreamEvent> sendMessage(String text) {
+    final channel = _channel;
+    if (channel == null) {
+      throw StateError('Chat socket is not connected.');
+    }
+    final id = _nextId++;
+    final controller = StreamController<ChatStreamEvent>();
+    _replies[id] = controller;
+    channel.sink.add(jsonEncode(<String, dynamic>{'type': 'message', 'id': id, 'message': text}));
+    return controller.stream;
+  }
+
+  void close() {
+    _subscription?.cancel();
+    _channel?.sink.close();
+    _onClosed('Chat connection closed.');
+  }
+
+  void _onFrame(Map<String, dynamic> frame) {
+    _resetWatchdog();
+    final id = frame['id'];
+    switch (frame['type']) {
+      case 'ready':
+        chatId = frame['chat_id'] as int? ?? chatId;
+        if (_ready?.isCompleted == false) _ready!.complete();
+        break;
+      case 'ping':
+        _channel?.sink.add(jsonEncode(<String, dynamic>{'type': 'pong'}));
+        break;
+      case 'delta':
+        _replies[id]?.add(ChatStreamEvent(type: 'delta', delta: frame['content'] as String?));
+        break;
+      case 'done':
+        chatId = frame['chat_id'] as int? ?? chatId;
+        _finish(id, ChatStreamEvent(type: 'done', chatId: chatId));
+        break;
+      case 'error':
+        final error = frame['detail']?.toString() ?? 'Unknown error';
+        if (id == null) {
+          // About the connection itself (e.g. chat not found); the server closes it next.
+          if (_ready?.isCompleted == false) _ready!.completeError(error);
+        } else {
+          _finish(id, ChatStreamEvent(type: 'error', error: error));
+        }
+        break;
+    }
+  }
+
+  void _finish(dynamic id, ChatStreamEvent event) {
+    final controller = _replies.remove(id);
+    controller?.add(event);
+    controller?.close();
+  }
+
+  void _onClosed(String reason) {
+    _channel = null;
+    _watchdog?.cancel();
+    if (_ready?.isCompleted == false) _ready!.completeError(reason);
+    // Replies still in flight are lost with the connection.
+    for (final id in _replies.keys.toList()) {
+      _finish(id, ChatStreamEvent(type: 'error', error: reason));
+    }
+  }
+
+  void _resetWatchdog() {
+    _watchdog?.cancel();
+    _watchdog = Timer(_idleTimeout, close);
+  }
+}